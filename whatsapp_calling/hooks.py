@@ -107,26 +107,52 @@ doctype_js = {
 # ---------------
 # Hook on document methods and events
 
-# doc_events = {
-# 	"*": {
-# 		"on_update": "method",
-# 		"on_cancel": "method",
-# 		"on_trash": "method"
-#	}
-# }
+doc_events = {
+	"User Permission": {
+		"after_insert": "whatsapp_calling.whatsapp_calling.api.agent_rooms.clear_user_rooms",
+		"on_update": "whatsapp_calling.whatsapp_calling.api.agent_rooms.clear_user_rooms",
+		"on_trash": "whatsapp_calling.whatsapp_calling.api.agent_rooms.clear_user_rooms"
+	},
+	"User": {
+		"on_update": "whatsapp_calling.whatsapp_calling.api.agent_rooms.clear_agent_rooms",
+		"on_trash": "whatsapp_calling.whatsapp_calling.api.agent_rooms.clear_agent_rooms"
+	},
+	"Lead": {
+		"after_insert": [
+			"whatsapp_calling.whatsapp_calling.utils.caller_id.invalidate_lead_caller_id"
+		],
+		"on_update": [
+			"whatsapp_calling.whatsapp_calling.utils.lead_lookup.sync_lead_phone_keys",
+			"whatsapp_calling.whatsapp_calling.utils.caller_id.invalidate_lead_caller_id"
+		],
+		"on_trash": [
+			"whatsapp_calling.whatsapp_calling.utils.lead_lookup.remove_lead_phone_keys",
+			"whatsapp_calling.whatsapp_calling.utils.caller_id.invalidate_lead_caller_id"
+		],
+		"after_rename": [
+			"whatsapp_calling.whatsapp_calling.utils.lead_lookup.rename_lead_phone_keys",
+			"whatsapp_calling.whatsapp_calling.utils.caller_id.invalidate_lead_caller_id"
+		]
+	}
+}
 
 # Scheduled Tasks
 # ---------------
 
 scheduler_events = {
-# 	"all": [
-# 		"whatsapp_calling.tasks.all"
-# 	],
+	"all": [
+		"whatsapp_calling.whatsapp_calling.utils.webhook_queue.recover_stalled_webhooks",
+		"whatsapp_calling.whatsapp_calling.utils.room_pool.refill_room_pool",
+		"whatsapp_calling.whatsapp_calling.utils.janus_nodes.poll_janus_nodes",
+		"whatsapp_calling.whatsapp_calling.utils.media_telemetry.schedule_media_sampler"
+	],
 # 	"daily": [
 # 		"whatsapp_calling.tasks.daily"
 # 	],
 	"hourly": [
-		"whatsapp_calling.whatsapp_calling.tasks.cleanup_old_recordings"
+		"whatsapp_calling.whatsapp_calling.tasks.cleanup_old_recordings",
+		"whatsapp_calling.whatsapp_calling.utils.caller_id.prewarm_caller_id_cache",
+		"whatsapp_calling.whatsapp_calling.tasks.cleanup_stale_janus_rooms"
 	],
 	"daily": [
 		"whatsapp_calling.whatsapp_calling.tasks.check_expired_permissions"
@@ -134,9 +160,9 @@ scheduler_events = {
 # 	"weekly": [
 # 		"whatsapp_calling.tasks.weekly"
 # 	],
-# 	"monthly": [
-# 		"whatsapp_calling.tasks.monthly"
-# 	],
+	"monthly": [
+		"whatsapp_calling.whatsapp_calling.tasks.update_monthly_usage"
+	],
 }
 
 # Testing
@@ -0,0 +1,11 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+import frappe
+from whatsapp_calling.whatsapp_calling.utils.lead_lookup import backfill_lead_phone_keys
+
+
+def execute():
+	"""Index phone numbers of Leads created before Lead Phone Key existed"""
+	frappe.reload_doc("whatsapp_calling", "doctype", "lead_phone_key")
+	backfill_lead_phone_keys()
@@ -125,7 +125,8 @@ function check_call_permission_status(frm) {
 	frappe.call({
 		method: 'whatsapp_calling.whatsapp_calling.api.call_control.get_company_whatsapp_number',
 		args: {
-			company: frm.doc.company
+			company: frm.doc.company,
+			customer_number: frm.doc.mobile_no
 		},
 		callback: function(r) {
 			if (r.message) {
@@ -133,14 +134,10 @@ function check_call_permission_status(frm) {
 
 				// Check permission status
 				frappe.call({
-					method: 'frappe.client.get_value',
+					method: 'whatsapp_calling.whatsapp_calling.api.permissions.get_call_permission_status',
 					args: {
-						doctype: 'Call Permission',
-						filters: {
-							customer_number: frm.doc.mobile_no,
-							business_number: wa_number
-						},
-						fieldname: ['permission_status', 'expires_at', 'calls_in_24h']
+						customer_number: frm.doc.mobile_no,
+						business_number: wa_number
 					},
 					callback: function(r) {
 						if (r.message) {
@@ -164,7 +161,7 @@ function display_permission_status(frm, permission_data) {
 		const expires_at = new Date(permission_data.expires_at);
 		const now = new Date();
 		const days_left = Math.ceil((expires_at - now) / (1000 * 60 * 60 * 24));
-		const calls_left = 5 - (permission_data.calls_in_24h || 0);
+		const calls_left = permission_data.calls_remaining;
 
 		status_html = `
 			<div class="whatsapp-permission-status" style="margin: 10px 0; padding: 10px; background-color: #d4edda; border-left: 4px solid #28a745; border-radius: 4px;">
@@ -11,16 +11,47 @@ whatsapp_calling.CallWidget = class {
 		this.call_name = null;
 		this.call_status = 'idle';
 		this.timer_interval = null;
+		this.incoming_dialog = null;
+		this.incoming_call_id = null;
 
 		this.setup_realtime_listeners();
+		this.start_heartbeat();
+	}
+
+	start_heartbeat() {
+		// Presence for call routing: agents without a recent heartbeat
+		// are not offered calls. Each tab reports on its own, so closing one
+		// tab does not take the agent offline while another is open.
+		this.tab_id = frappe.utils.get_random(10);
+		const beat = () => frappe.xcall('whatsapp_calling.whatsapp_calling.api.presence.heartbeat', {
+			tab_id: this.tab_id
+		}).catch(() => {});
+		beat();
+		this.heartbeat_interval = setInterval(beat, 15000);
+
+		window.addEventListener('beforeunload', () => {
+			clearInterval(this.heartbeat_interval);
+			navigator.sendBeacon(
+				'/api/method/whatsapp_calling.whatsapp_calling.api.presence.go_offline',
+				new URLSearchParams({ csrf_token: frappe.csrf_token, tab_id: this.tab_id })
+			);
+		});
 	}
 
 	setup_realtime_listeners() {
-		// Listen for incoming calls
+		// Listen for incoming calls (published by the server to each agent
+		// of the called WhatsApp Number)
 		frappe.realtime.on('incoming_whatsapp_call', (data) => {
 			this.show_incoming_call_dialog(data);
 		});
 
+		// Another agent answered a call that is ringing here
+		frappe.realtime.on('whatsapp_call_claimed', (data) => {
+			if (data.call_id === this.incoming_call_id && data.user !== frappe.session.user) {
+				this.close_incoming_call_dialog();
+			}
+		});
+
 		// Listen for call status updates
 		frappe.realtime.on('call_status_update', (data) => {
 			this.handle_status_update(data);
@@ -165,6 +196,11 @@ whatsapp_calling.CallWidget = class {
 	}
 
 	show_incoming_call_dialog(call_data) {
+		// The same call can reach us by a routing wave and the room fallback
+		if (this.incoming_call_id === call_data.call_id) {
+			return;
+		}
+
 		// Play ringtone
 		this.play_ringtone();
 
@@ -194,9 +230,23 @@ whatsapp_calling.CallWidget = class {
 			}
 		});
 
+		dialog.onhide = () => {
+			this.incoming_dialog = null;
+			this.incoming_call_id = null;
+		};
+
+		this.incoming_dialog = dialog;
+		this.incoming_call_id = call_data.call_id;
 		dialog.show();
 	}
 
+	close_incoming_call_dialog() {
+		this.stop_ringtone();
+		if (this.incoming_dialog) {
+			this.incoming_dialog.hide();
+		}
+	}
+
 	async answer_incoming_call(call_id) {
 		try {
 			// Request microphone
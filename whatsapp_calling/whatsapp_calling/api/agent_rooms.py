@@ -0,0 +1,132 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Realtime delivery of incoming call notifications
+
+Each WhatsApp Number has a set of agents: users who may read WhatsApp
+Calls and whose company User Permissions allow the number. A ring is
+published from the server to the user room of each of those agents, so
+the cost of a notification grows with the agents of the number, not with
+the users on the site, and nothing depends on the browser joining rooms
+(every socket of a logged-in user is in its user room, also after a
+reconnect).
+
+Both directions are cached in Redis: number -> agents and user -> numbers.
+"""
+
+import frappe
+
+ROOMS_CACHE_KEY = "whatsapp_agent_call_rooms"
+NUMBER_AGENTS_KEY = "whatsapp_number_agents"
+
+
+def get_user_numbers(user):
+	"""Return the WhatsApp Numbers of the user's companies (cached)"""
+	if user == "Guest":
+		return []
+
+	cache = frappe.cache()
+	numbers = cache.hget(ROOMS_CACHE_KEY, user)
+	if numbers is None:
+		numbers = compute_user_numbers(user)
+		cache.hset(ROOMS_CACHE_KEY, user, numbers)
+	return numbers
+
+
+def compute_user_numbers(user):
+	"""Work out a user's WhatsApp Numbers from their Company User Permissions"""
+	if not frappe.has_permission("WhatsApp Call", "read", user=user):
+		return []
+
+	companies = frappe.get_all(
+		"User Permission",
+		filters={"user": user, "allow": "Company"},
+		pluck="for_value"
+	)
+
+	filters = {"status": "Active"}
+	if companies:
+		filters["company"] = ["in", companies]
+
+	# Users without Company restrictions see every company, as elsewhere in Frappe
+	return frappe.get_all("WhatsApp Number", filters=filters, pluck="name")
+
+
+def get_number_agents(business_number):
+	"""Return the users who may receive calls of a WhatsApp Number (cached)"""
+	cache = frappe.cache()
+	agents = cache.hget(NUMBER_AGENTS_KEY, business_number)
+	if agents is None:
+		agents = compute_number_agents(business_number)
+		cache.hset(NUMBER_AGENTS_KEY, business_number, agents)
+	return agents
+
+
+def compute_number_agents(business_number):
+	"""
+	Work out a number's agents, with the rules of compute_user_numbers, in
+	a few set-based queries
+	"""
+	number = frappe.db.get_value("WhatsApp Number", business_number, ["company", "status"], as_dict=True)
+	if not number or number.status != "Active":
+		return []
+
+	# Custom DocPerms, when a doctype has any, replace the standard ones
+	perm_doctype = "Custom DocPerm" if frappe.db.exists("Custom DocPerm", {"parent": "WhatsApp Call"}) else "DocPerm"
+	roles = frappe.get_all(
+		perm_doctype,
+		filters={"parent": "WhatsApp Call", "read": 1, "permlevel": 0},
+		pluck="role"
+	)
+	if not roles:
+		return []
+
+	users = frappe.get_all(
+		"Has Role",
+		filters={"role": ["in", roles], "parenttype": "User", "parent": ["not in", ["Administrator", "Guest"]]},
+		pluck="parent",
+		distinct=True
+	)
+	users = frappe.get_all(
+		"User",
+		filters={"name": ["in", users], "enabled": 1, "user_type": "System User"},
+		pluck="name"
+	) if users else []
+
+	companies = {}
+	for row in frappe.get_all(
+		"User Permission",
+		filters={"user": ["in", users], "allow": "Company"},
+		fields=["user", "for_value"]
+	) if users else []:
+		companies.setdefault(row.user, set()).add(row.for_value)
+
+	# Users without Company restrictions see every company
+	return [user for user in users if user not in companies or number.company in companies[user]]
+
+
+def publish_to_number(event, message, business_number):
+	"""Publish a realtime event to every agent of a WhatsApp Number"""
+	for user in get_number_agents(business_number):
+		frappe.publish_realtime(event=event, message=message, user=user)
+
+
+def clear_user_rooms(doc, method=None):
+	"""User Permission doc_event: recompute the user's numbers on next request"""
+	if doc.allow == "Company":
+		cache = frappe.cache()
+		cache.hdel(ROOMS_CACHE_KEY, doc.user)
+		cache.delete_value(NUMBER_AGENTS_KEY)
+
+
+def clear_agent_rooms(doc, method=None):
+	"""User doc_event: roles or enabled state may have changed"""
+	cache = frappe.cache()
+	cache.hdel(ROOMS_CACHE_KEY, doc.name)
+	cache.delete_value(NUMBER_AGENTS_KEY)
+
+
+def clear_all_rooms(doc=None, method=None):
+	"""WhatsApp Number changes can affect every user's numbers"""
+	frappe.cache().delete_value([ROOMS_CACHE_KEY, NUMBER_AGENTS_KEY])
@@ -4,8 +4,21 @@
 import frappe
 from frappe import _
 from whatsapp_calling.whatsapp_calling.utils.whatsapp_api import WhatsAppAPI
-from whatsapp_calling.whatsapp_calling.api.janus_client import JanusClient
-from whatsapp_calling.whatsapp_calling.api.permissions import check_call_permission
+from whatsapp_calling.whatsapp_calling.api.permissions import (
+	check_call_permission,
+	get_granted_numbers,
+	get_permission_number,
+	release_call_permission
+)
+from whatsapp_calling.whatsapp_calling.utils import lead_lookup
+from whatsapp_calling.whatsapp_calling.utils.call_projector import load_call_histories, project_call
+from whatsapp_calling.whatsapp_calling.utils.call_setup import StageTimer, get_deadline, setup_outbound_call, undo_outbound_call
+from whatsapp_calling.whatsapp_calling.utils.janus_nodes import get_janus_ws_url
+from whatsapp_calling.whatsapp_calling.utils.number_selector import record_call, select_number
+from whatsapp_calling.whatsapp_calling.utils.room_pool import acquire_room, release_room
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_number
+from whatsapp_calling.whatsapp_calling.utils.call_router import claim_call, release_claim
+from whatsapp_calling.whatsapp_calling.api.presence import ON_CALL, WRAP_UP, set_agent_status
 
 
 @frappe.whitelist()
@@ -13,77 +26,111 @@ def make_call(lead_name, mobile_number):
 	"""
 	Initiate outbound call from CRM Lead
 
+	The Janus room and the Graph dial are set up concurrently, under one
+	deadline; see utils/call_setup.
+
 	Args:
 		lead_name: Name of CRM Lead
 		mobile_number: Customer's mobile number
 
 	Returns:
-		dict with call_id and webrtc_config
+		dict with call_id, webrtc_config and per-stage timings (ms)
 	"""
+	timer = StageTimer()
+	deadline = get_deadline()
+	call_id = None
+	reservation = None
+
 	try:
 		# Get lead details
-		lead = frappe.get_doc("Lead", lead_name)
+		with timer.stage("lead"):
+			lead = frappe.get_doc("Lead", lead_name)
 
 		# Validate phone number
 		if not mobile_number:
 			frappe.throw(_("Mobile number is required"))
 
-		# Get company's WhatsApp number
-		# For now, get first active number for lead's company
-		wa_number = get_company_whatsapp_number(lead.company)
+		# Spread calls over the company's numbers, among those the customer
+		# has granted call permission to
+		with timer.stage("number"):
+			wa_number = select_number(lead.company, prefer=get_granted_numbers(mobile_number))
 
 		if not wa_number:
 			frappe.throw(_("No WhatsApp number configured for company"))
 
-		# Check call permission
-		permission_check = check_call_permission(mobile_number, wa_number.name)
+		# Check call permission, taking one of the day's calls
+		with timer.stage("permission"):
+			permission_check = check_call_permission(mobile_number, wa_number.name, reserve=True)
 		if not permission_check["can_call"]:
 			frappe.throw(_(permission_check["reason"]))
-
-		# Create Janus room first
-		janus = JanusClient()
-		room_config = janus.setup_call_room()
+		reservation = permission_check["reservation"]
 
 		# Initialize WhatsApp API call
 		wa_api = WhatsAppAPI(
 			wa_number.phone_number_id,
-			wa_number.get_access_token()
+			wa_number.access_token
 		)
 
-		call_response = wa_api.make_call(mobile_number)
-
-		# Create call record
-		call_doc = frappe.get_doc({
-			"doctype": "WhatsApp Call",
-			"call_id": call_response["id"],
-			"customer_number": mobile_number,
-			"business_number": wa_number.name,
-			"company": lead.company,
-			"lead": lead_name,
-			"contact_name": lead.lead_name,
-			"direction": "Outbound",
-			"status": "Initiated",
-			"initiated_at": frappe.utils.now(),
-			"assigned_to": frappe.session.user,
-			"janus_room_id": room_config["room_id"],
-			"janus_session_id": room_config["session_id"]
-		})
-		call_doc.insert()
-		frappe.db.commit()
+		# Janus room on the least-loaded node and the dial, side by side
+		with timer.stage("setup"):
+			room_config, call_response = setup_outbound_call(wa_api, mobile_number, deadline, timer)
+		call_id = call_response["id"]
+
+		try:
+			# Create call record
+			with timer.stage("insert"):
+				call_doc = frappe.get_doc({
+					"doctype": "WhatsApp Call",
+					"call_id": call_id,
+					"customer_number": mobile_number,
+					"business_number": wa_number.name,
+					"company": lead.company,
+					"lead": lead_name,
+					"contact_name": lead.lead_name,
+					"direction": "Outbound",
+					"status": "Initiated",
+					"initiated_at": frappe.utils.now(),
+					"assigned_to": frappe.session.user,
+					"janus_room_id": room_config["room_id"],
+					"janus_session_id": room_config["session_id"],
+					"janus_node": room_config["janus_node"]
+				})
+				call_doc.insert()
+
+			with timer.stage("commit"):
+				frappe.db.commit()
+
+		except Exception:
+			frappe.db.rollback()
+			undo_outbound_call(wa_api, room_config, call_response)
+			raise
+
+		# The call is out and recorded: it counts whatever happens next
+		reservation = None
+
+		set_agent_status(frappe.session.user, ON_CALL)
+		record_call(lead.company, wa_number.name)
+		timer.log(call_id)
 
 		return {
 			"success": True,
-			"call_id": call_response["id"],
+			"call_id": call_id,
 			"call_name": call_doc.name,
 			"webrtc_config": {
-				"janus_url": frappe.get_single("WhatsApp Settings").janus_ws_url,
+				"janus_url": get_janus_ws_url(room_config["janus_node"]),
 				"room_id": room_config["room_id"],
 				"session_id": room_config["session_id"],
 				"handle_id": room_config["handle_id"]
-			}
+			},
+			"timings": timer.timings
 		}
 
 	except Exception as e:
+		if reservation:
+			# The call did not go out: it does not count against the limit
+			release_call_permission(mobile_number, wa_number.name, reservation)
+
+		timer.log(call_id, outcome="failed")
 		frappe.log_error(message=str(e), title="Make Call Error")
 		frappe.throw(_(str(e)))
 
@@ -99,6 +146,10 @@ def answer_call(call_id):
 	Returns:
 		dict with webrtc_config
 	"""
+	# Only the first agent to answer gets the call
+	if not claim_call(call_id, frappe.session.user):
+		frappe.throw(_("This call has already been answered by another agent"))
+
 	try:
 		# Get call record
 		call_doc = frappe.get_doc("WhatsApp Call", {"call_id": call_id})
@@ -110,10 +161,10 @@ def answer_call(call_id):
 
 		# Create Janus room if not exists
 		if not call_doc.janus_room_id:
-			janus = JanusClient()
-			room_config = janus.setup_call_room()
+			room_config = acquire_room()
 			call_doc.janus_room_id = room_config["room_id"]
 			call_doc.janus_session_id = room_config["session_id"]
+			call_doc.janus_node = room_config["janus_node"]
 		else:
 			room_config = {
 				"room_id": call_doc.janus_room_id,
@@ -123,30 +174,34 @@ def answer_call(call_id):
 		call_doc.save(ignore_permissions=True)
 
 		# Tell WhatsApp to connect to Janus
-		wa_number = frappe.get_doc("WhatsApp Number", call_doc.business_number)
+		wa_number = get_number(call_doc.business_number)
 		wa_api = WhatsAppAPI(
 			wa_number.phone_number_id,
-			wa_number.get_access_token()
+			wa_number.access_token
 		)
 
 		# This tells WhatsApp where to send media
+		janus_url = get_janus_ws_url(call_doc.janus_node)
 		wa_api.answer_call(call_id, {
-			"janus_url": frappe.get_single("WhatsApp Settings").janus_ws_url,
+			"janus_url": janus_url,
 			"room_id": call_doc.janus_room_id
 		})
 
 		frappe.db.commit()
 
+		set_agent_status(frappe.session.user, ON_CALL)
+
 		return {
 			"success": True,
 			"webrtc_config": {
-				"janus_url": frappe.get_single("WhatsApp Settings").janus_ws_url,
+				"janus_url": janus_url,
 				"room_id": call_doc.janus_room_id,
 				"session_id": call_doc.janus_session_id
 			}
 		}
 
 	except Exception as e:
+		release_claim(call_id, frappe.session.user)
 		frappe.log_error(message=str(e), title="Answer Call Error")
 		frappe.throw(_(str(e)))
 
@@ -157,26 +212,31 @@ def end_call(call_id):
 	try:
 		call_doc = frappe.get_doc("WhatsApp Call", {"call_id": call_id})
 
+		# Tell WhatsApp to end call; the customer's media leg stays on the
+		# room until it does
+		wa_number = get_number(call_doc.business_number)
+		wa_api = WhatsAppAPI(
+			wa_number.phone_number_id,
+			wa_number.access_token
+		)
+		wa_api.end_call(call_id)
+
 		# Update status
 		call_doc.status = "Ended"
 		call_doc.ended_at = frappe.utils.now()
 		call_doc.save()
 
-		# Close Janus room
+		# Close Janus room, recycling it through the pool when possible
 		if call_doc.janus_room_id:
-			janus = JanusClient()
-			janus.destroy_room(call_doc.janus_session_id, call_doc.janus_room_id)
-
-		# Tell WhatsApp to end call
-		wa_number = frappe.get_doc("WhatsApp Number", call_doc.business_number)
-		wa_api = WhatsAppAPI(
-			wa_number.phone_number_id,
-			wa_number.get_access_token()
-		)
-		wa_api.end_call(call_id)
+			if release_room(call_doc.janus_room_id, call_doc.janus_session_id, call_doc.janus_node):
+				# The room may serve another call now, so this one lets go of it
+				call_doc.db_set({"janus_room_id": None, "janus_session_id": None}, update_modified=False)
 
 		frappe.db.commit()
 
+		if call_doc.assigned_to == frappe.session.user:
+			set_agent_status(frappe.session.user, WRAP_UP)
+
 		return {"success": True}
 
 	except Exception as e:
@@ -184,35 +244,46 @@ def end_call(call_id):
 		return {"success": False, "error": str(e)}
 
 
+@frappe.whitelist()
+def rebuild_call_state(call_id):
+	"""Re-derive a call's state from its WhatsApp Call Event history"""
+	frappe.only_for("System Manager")
+
+	call_doc = frappe.get_doc("WhatsApp Call", {"call_id": call_id})
+	history = load_call_histories([call_id]).get(call_id, [])
+
+	project_call(call_doc, history)
+	call_doc.save(ignore_permissions=True)
+	frappe.db.commit()
+
+	return {"success": True, "status": call_doc.status, "events": len(history)}
+
+
 @frappe.whitelist()
 def find_lead_by_mobile(mobile_number):
 	"""Find CRM Lead by mobile number"""
-	# Clean number for comparison
-	clean_number = mobile_number.replace("+", "").replace("-", "").replace(" ", "")
+	return lead_lookup.find_lead_by_mobile(mobile_number)
 
-	leads = frappe.get_all(
-		"Lead",
-		filters={
-			"mobile_no": ["like", f"%{clean_number[-10:]}%"]  # Match last 10 digits
-		},
-		limit=1
-	)
 
-	return leads[0].name if leads else None
+@frappe.whitelist()
+def get_company_whatsapp_number(company, customer_number=None):
+	"""
+	WhatsApp number a call from this company would go out on
 
+	Args:
+		company: Company
+		customer_number: use the number holding this customer's call
+			permission, when they have one
 
-@frappe.whitelist()
-def get_company_whatsapp_number(company):
-	"""Get active WhatsApp number for company"""
-	numbers = frappe.get_all(
-		"WhatsApp Number",
-		filters={
-			"company": company,
-			"status": "Active"
-		},
-		limit=1
-	)
-
-	if numbers:
-		return frappe.get_doc("WhatsApp Number", numbers[0].name)
+	Returns:
+		dict with name, phone_number and display_name, or None
+	"""
+	wa_number = (get_permission_number(customer_number, company) if customer_number else None) or select_number(company)
+
+	if wa_number:
+		return {
+			"name": wa_number.name,
+			"phone_number": wa_number.phone_number,
+			"display_name": wa_number.display_name
+		}
 	return None
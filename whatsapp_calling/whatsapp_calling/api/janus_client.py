@@ -2,80 +2,92 @@
 # For license information, please see license.txt
 
 import frappe
+import os
 import requests
 import secrets
-import json
+import threading
+import time
+from whatsapp_calling.whatsapp_calling.utils.http import get_session, get_timeout
+from whatsapp_calling.whatsapp_calling.utils.janus_nodes import get_node_config
+from whatsapp_calling.whatsapp_calling.utils.janus_ws import REQUEST_TIMEOUT, get_janus_ws
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_settings
+
+KEEPALIVE_INTERVAL = 25  # seconds; Janus times sessions out after 60s by default
+DEFAULT_MANAGED_SESSIONS = 2
+
+# Janus error codes meaning our session or handle is gone
+SESSION_NOT_FOUND = 458
+HANDLE_NOT_FOUND = 459
+
+# Description prefix of the rooms this app creates, to tell them apart in a room list
+ROOM_DESCRIPTION = "WhatsApp Call Room"
+
+_managers = {}
+_managers_lock = threading.Lock()
 
 
 class JanusClient:
-	def __init__(self):
-		settings = frappe.get_single("WhatsApp Settings")
-		self.base_url = settings.janus_http_url
-		self.api_secret = settings.get_password('janus_api_secret')
+	def __init__(self, node=None):
+		"""
+		Args:
+			node: Janus Node to talk to; None for the server in WhatsApp Settings
+		"""
+		settings = get_settings()
+		config = get_node_config(node)
+		self.node = node
+		self.base_url = config["http_url"]
+		self.api_secret = config["api_secret"]
 		self.session_id = None
 		self.handle_id = None
+		self.transport_url = config["ws_url"] if settings.janus_transport == "WebSocket" else self.base_url
+
+		# WebSocket: one multiplexed connection per worker; HTTP: pooled sessions
+		if settings.janus_transport == "WebSocket":
+			self.ws = get_janus_ws(config["ws_url"], self.api_secret)
+			self.session = None
+		else:
+			self.ws = None
+			self.session = get_session("janus")
 
 	def setup_call_room(self):
 		"""
 		Setup complete Janus room for a call
 
+		The room is created through one of the worker's long-lived
+		AudioBridge handles, so this is a single Janus request.
+
 		Returns:
 			dict with session_id, handle_id, room_id
 		"""
-		# Create session
-		self.session_id = self.create_session()
-
-		# Attach AudioBridge plugin
-		self.handle_id = self.attach_plugin(self.session_id)
+		room_id = secrets.randbelow(999999)
+		data, self.session_id, self.handle_id = get_session_manager(self).request(
+			self, self._create_room_body(room_id)
+		)
 
-		# Create room
-		room_id = self.create_room(self.session_id, self.handle_id)
+		if get_plugin_data(data).get("audiobridge") != "created":
+			raise Exception(f"Failed to create room: {data}")
 
 		return {
 			"session_id": self.session_id,
 			"handle_id": self.handle_id,
-			"room_id": room_id
+			"room_id": str(room_id)
 		}
 
 	def create_session(self):
 		"""Create Janus session"""
-		url = f"{self.base_url}"
-
-		payload = {
-			"janus": "create",
-			"transaction": self._generate_transaction_id()
-		}
-
-		if self.api_secret:
-			payload["apisecret"] = self.api_secret
-
-		response = requests.post(url, json=payload, timeout=10)
-		response.raise_for_status()
-
-		data = response.json()
+		data = self._send({"janus": "create"})
 
 		if data.get("janus") == "success":
-			return str(data["data"]["id"])
+			session_id = str(data["data"]["id"])
+			if self.ws:
+				self.ws.keep_alive(session_id)
+			return session_id
 		else:
 			raise Exception(f"Failed to create Janus session: {data}")
 
 	def attach_plugin(self, session_id, plugin="janus.plugin.audiobridge"):
 		"""Attach AudioBridge plugin"""
-		url = f"{self.base_url}/{session_id}"
-
-		payload = {
-			"janus": "attach",
-			"plugin": plugin,
-			"transaction": self._generate_transaction_id()
-		}
-
-		if self.api_secret:
-			payload["apisecret"] = self.api_secret
-
-		response = requests.post(url, json=payload, timeout=10)
-		response.raise_for_status()
-
-		data = response.json()
+		data = self._send({"janus": "attach", "plugin": plugin}, session_id=session_id)
 
 		if data.get("janus") == "success":
 			return str(data["data"]["id"])
@@ -83,73 +95,288 @@ class JanusClient:
 			raise Exception(f"Failed to attach plugin: {data}")
 
 	def create_room(self, session_id, handle_id, room_id=None):
-		"""Create audio mixing room"""
-		url = f"{self.base_url}/{session_id}/{handle_id}"
-
+		"""Create audio mixing room on a given handle"""
 		if not room_id:
 			room_id = secrets.randbelow(999999)
 
-		settings = frappe.get_single("WhatsApp Settings")
-
-		payload = {
-			"janus": "message",
-			"transaction": self._generate_transaction_id(),
-			"body": {
-				"request": "create",
-				"room": room_id,
-				"description": f"WhatsApp Call Room {room_id}",
-				"sampling_rate": 48000,  # WhatsApp uses 48kHz
-				"record": settings.enable_call_recording,
-				"rec_dir": settings.recording_storage_path if settings.enable_call_recording else None
-			}
-		}
-
-		if self.api_secret:
-			payload["apisecret"] = self.api_secret
-
-		response = requests.post(url, json=payload, timeout=10)
-		response.raise_for_status()
-
-		data = response.json()
+		data = self._send(
+			{"janus": "message", "body": self._create_room_body(room_id)},
+			session_id=session_id,
+			handle_id=handle_id
+		)
 
-		if data.get("janus") == "success" or data.get("plugindata", {}).get("data", {}).get("audiobridge") == "created":
+		# "create" is a synchronous AudioBridge request: the plugin's answer
+		# comes with the reply, on either transport
+		if get_plugin_data(data).get("audiobridge") == "created":
 			return str(room_id)
 		else:
 			raise Exception(f"Failed to create room: {data}")
 
+	def _create_room_body(self, room_id):
+		settings = get_settings()
+		return {
+			"request": "create",
+			"room": room_id,
+			"description": f"{ROOM_DESCRIPTION} {room_id}",
+			"sampling_rate": 48000,  # WhatsApp uses 48kHz
+			"record": settings.enable_call_recording,
+			"rec_dir": settings.recording_storage_path if settings.enable_call_recording else None
+		}
+
 	def destroy_room(self, session_id, room_id):
-		"""Destroy room and cleanup"""
+		"""
+		Destroy a room
+
+		Rooms belong to the AudioBridge plugin, not to the session that
+		created them, so any of this worker's handles can destroy them.
+		`session_id` (the call's) is no longer needed and left alone: it may
+		be a long-lived session shared with other calls.
+		"""
 		try:
-			url = f"{self.base_url}/{session_id}/{self.handle_id}"
+			data, _session, _handle = get_session_manager(self).request(
+				self, {"request": "destroy", "room": int(room_id)}, read_timeout=5
+			)
+			result = get_plugin_data(data)
+
+			# 485: no such room, e.g. already destroyed
+			if result.get("audiobridge") != "destroyed" and result.get("error_code") != 485:
+				frappe.log_error(message=str(data), title="Janus Cleanup Error")
+
+		except Exception as e:
+			frappe.log_error(message=str(e), title="Janus Cleanup Error")
+
+	def destroy_rooms(self, room_ids):
+		"""
+		Destroy many rooms, one request after the other over a single handle
 
-			payload = {
-				"janus": "message",
-				"transaction": self._generate_transaction_id(),
-				"body": {
-					"request": "destroy",
-					"room": room_id
-				}
-			}
+		Returns:
+			int: rooms that are gone now (destroyed, or already missing)
+		"""
+		manager = get_session_manager(self)
+		index, slot = manager.get_handle(self)
+		destroyed = 0
 
-			if self.api_secret:
-				payload["apisecret"] = self.api_secret
+		for room_id in room_ids:
+			body = {"request": "destroy", "room": int(room_id)}
+			data = self._send({"janus": "message", "body": body}, session_id=slot[0], handle_id=slot[1], read_timeout=5)
 
-			requests.post(url, json=payload, timeout=5)
+			if data.get("janus") == "error" and data.get("error", {}).get("code") in (SESSION_NOT_FOUND, HANDLE_NOT_FOUND):
+				# Session lost midway: continue on a fresh one
+				manager.drop(index, slot)
+				index, slot = manager.get_handle(self)
+				data = self._send({"janus": "message", "body": body}, session_id=slot[0], handle_id=slot[1], read_timeout=5)
 
-			# Destroy session
-			url = f"{self.base_url}/{session_id}"
-			payload = {
-				"janus": "destroy",
-				"transaction": self._generate_transaction_id()
-			}
-			if self.api_secret:
-				payload["apisecret"] = self.api_secret
+			result = get_plugin_data(data)
+			if result.get("audiobridge") == "destroyed" or result.get("error_code") == 485:
+				destroyed += 1
+			else:
+				frappe.log_error(message=str(data), title="Janus Cleanup Error")
 
-			requests.post(url, json=payload, timeout=5)
+		return destroyed
 
-		except Exception as e:
-			frappe.log_error(message=str(e), title="Janus Cleanup Error")
+	def list_rooms(self):
+		"""
+		Rooms this app created that Janus has now, from one AudioBridge `list`
+
+		Returns:
+			dict of room_id (str) -> number of participants
+		"""
+		data, _session, _handle = get_session_manager(self).request(self, {"request": "list"}, read_timeout=10)
+		result = get_plugin_data(data)
+
+		if result.get("audiobridge") != "success":
+			raise Exception(f"Failed to list rooms: {data}")
+
+		return {
+			str(room["room"]): room.get("num_participants") or 0
+			for room in result.get("list", [])
+			if (room.get("description") or "").startswith(ROOM_DESCRIPTION)
+		}
+
+	def keepalive(self, session_id):
+		"""
+		Refresh a session's timeout
+
+		Returns:
+			bool: True if Janus still knows the session
+		"""
+		try:
+			return self._send({"janus": "keepalive"}, session_id=session_id, read_timeout=2).get("janus") == "ack"
+		except Exception:
+			return False
+
+	def kick_all(self, room_id):
+		"""
+		Remove every participant from a room so it can be reused
+
+		Returns:
+			bool: True if the room is empty now
+		"""
+		try:
+			data, _session, _handle = get_session_manager(self).request(
+				self, {"request": "kick_all", "room": int(room_id)}, read_timeout=5
+			)
+			return get_plugin_data(data).get("audiobridge") == "success"
+		except Exception:
+			return False
+
+	def room_exists(self, room_id):
+		"""
+		Check that Janus still has a room (it loses them on restart)
+
+		Returns:
+			bool
+		"""
+		try:
+			data, _session, _handle = get_session_manager(self).request(
+				self, {"request": "exists", "room": int(room_id)}, read_timeout=2
+			)
+			return bool(get_plugin_data(data).get("exists"))
+		except Exception:
+			return False
+
+	def _send(self, payload, session_id=None, handle_id=None, read_timeout=None):
+		"""
+		Send a Janus API request over the configured transport
+
+		Returns:
+			dict: Janus reply
+		"""
+		if self.ws:
+			return self.ws.request(payload, session_id=session_id, handle_id=handle_id, timeout=read_timeout or REQUEST_TIMEOUT)
+
+		url = "/".join(str(part) for part in (self.base_url, session_id, handle_id) if part)
+		payload = dict(payload, transaction=self._generate_transaction_id())
+
+		if self.api_secret:
+			payload["apisecret"] = self.api_secret
+
+		response = self.session.post(url, json=payload, timeout=get_timeout(read=read_timeout))
+		response.raise_for_status()
+		return response.json()
 
 	def _generate_transaction_id(self):
 		"""Generate random transaction ID"""
 		return secrets.token_hex(12)
+
+
+def get_plugin_data(data):
+	"""Plugin part of a Janus reply"""
+	return data.get("plugindata", {}).get("data", {})
+
+
+class JanusSessionManager:
+	"""
+	A few long-lived Janus sessions per worker, each with an AudioBridge handle
+
+	Room requests are spread over the sessions round-robin. Sessions are
+	created lazily, kept alive every 25s (by the WebSocket transport, or by
+	a daemon thread over HTTP), and recreated transparently when Janus
+	reports them gone, e.g. after a Janus restart.
+	"""
+
+	def __init__(self, size, base_url, api_secret, websocket):
+		self.size = size
+		self.base_url = base_url
+		self.api_secret = api_secret
+		self.websocket = websocket
+		self.slots = [None] * size
+		self.next_slot = 0
+		self.lock = threading.Lock()
+		self.keepalive_thread = None
+
+	def request(self, client, body, read_timeout=None):
+		"""
+		Send an AudioBridge request on one of the managed handles
+
+		Args:
+			client: JanusClient used to talk to Janus
+			body: plugin request body, e.g. {"request": "destroy", "room": 1234}
+
+		Returns:
+			tuple of (Janus reply, session_id, handle_id)
+		"""
+		for attempt in range(2):
+			index, (session_id, handle_id) = self.get_handle(client)
+			data = client._send({"janus": "message", "body": body}, session_id=session_id, handle_id=handle_id, read_timeout=read_timeout)
+
+			if data.get("janus") == "error" and data.get("error", {}).get("code") in (SESSION_NOT_FOUND, HANDLE_NOT_FOUND):
+				# Expired or lost on a Janus restart: reattach and try once more
+				self.drop(index, (session_id, handle_id))
+				continue
+
+			return data, session_id, handle_id
+
+		return data, session_id, handle_id
+
+	def get_handle(self, client):
+		"""Next (session_id, handle_id), creating the session if needed"""
+		with self.lock:
+			index = self.next_slot
+			self.next_slot = (self.next_slot + 1) % self.size
+
+			if self.slots[index] is None:
+				session_id = client.create_session()
+				handle_id = client.attach_plugin(session_id)
+				self.slots[index] = (session_id, handle_id)
+
+			slot = self.slots[index]
+
+		if not self.websocket:
+			self.start_keepalive()
+
+		return index, slot
+
+	def drop(self, index, slot):
+		with self.lock:
+			if self.slots[index] == slot:
+				self.slots[index] = None
+
+	def start_keepalive(self):
+		if self.keepalive_thread and self.keepalive_thread.is_alive():
+			return
+
+		self.keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+		self.keepalive_thread.start()
+
+	def _keepalive_loop(self):
+		# Runs outside any site context, so it cannot use frappe or the
+		# worker's pooled sessions; one plain Session is enough here
+		http = requests.Session()
+
+		while True:
+			time.sleep(KEEPALIVE_INTERVAL)
+
+			for index, slot in enumerate(list(self.slots)):
+				if slot is None:
+					continue
+
+				payload = {"janus": "keepalive", "transaction": secrets.token_hex(12)}
+				if self.api_secret:
+					payload["apisecret"] = self.api_secret
+
+				try:
+					alive = http.post(f"{self.base_url}/{slot[0]}", json=payload, timeout=(3.05, 5)).json().get("janus") == "ack"
+				except Exception:
+					# Janus unreachable: keep the slot, the next request will tell
+					continue
+
+				if not alive:
+					self.drop(index, slot)
+
+
+def get_session_manager(client):
+	"""Return this worker's session manager for the client's Janus server"""
+	key = (os.getpid(), frappe.local.site, client.transport_url)
+
+	with _managers_lock:
+		manager = _managers.get(key)
+		if manager is None:
+			manager = _managers[key] = JanusSessionManager(
+				size=frappe.utils.cint(frappe.conf.get("whatsapp_janus_sessions")) or DEFAULT_MANAGED_SESSIONS,
+				base_url=client.base_url,
+				api_secret=client.api_secret,
+				websocket=bool(client.ws)
+			)
+
+	return manager
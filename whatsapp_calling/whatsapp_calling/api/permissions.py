@@ -5,16 +5,55 @@ import frappe
 from frappe import _
 from datetime import datetime, timedelta
 from whatsapp_calling.whatsapp_calling.utils.whatsapp_api import WhatsAppAPI
+from whatsapp_calling.whatsapp_calling.utils.caller_id import resolve_caller_id
+from whatsapp_calling.whatsapp_calling.utils.number_selector import select_number
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_company_numbers
+from whatsapp_calling.whatsapp_calling.utils.rate_limiter import (
+	call_limiter,
+	get_subject,
+	mirror_seed,
+	permission_request_limiter
+)
+
+NO_PERMISSION = "No call permission. Please request permission first."
+PERMISSION_EXPIRED = "Permission expired. Please request permission again."
+CALL_LIMIT_REACHED = "Daily call limit (5) reached. Please try tomorrow."
+
+# Numbers per query of the bulk check
+BULK_CHUNK_SIZE = 5000
+
+PERMISSION_REQUEST_TEMPLATE = "call_permission_request"
+
+# The template's "voice call" button, which asks for call permission
+PERMISSION_REQUEST_COMPONENTS = [{
+	"type": "button",
+	"sub_type": "voice_call",
+	"index": 0,
+	"parameters": [{
+		"type": "action",
+		"action": {
+			"flow_action_type": "voice_call_request"
+		}
+	}]
+}]
 
 
-def check_call_permission(customer_number, business_number):
+def check_call_permission(customer_number, business_number, reserve=False):
 	"""
 	Check if business can call customer
 
+	Args:
+		customer_number: Customer's number
+		business_number: WhatsApp Number name
+		reserve: also take one of the 5 calls per 24h, atomically with the
+			check; give it back with release_call_permission if the call
+			does not go out
+
 	Returns:
 		{
 			"can_call": True/False,
-			"reason": "explanation"
+			"reason": "explanation",
+			"reservation": event to release (with reserve, when allowed)
 		}
 	"""
 	# Find permission record
@@ -24,14 +63,14 @@ def check_call_permission(customer_number, business_number):
 			"customer_number": customer_number,
 			"business_number": business_number
 		},
-		["name", "permission_status", "expires_at", "calls_in_24h", "last_call_at"],
+		["name", "permission_status", "expires_at", "calls_in_24h", "last_call_at", "recent_calls"],
 		as_dict=True
 	)
 
 	if not permission:
 		return {
 			"can_call": False,
-			"reason": "No call permission. Please request permission first."
+			"reason": NO_PERMISSION
 		}
 
 	# Check if permission is granted
@@ -47,20 +86,223 @@ def check_call_permission(customer_number, business_number):
 		if expires < datetime.now():
 			return {
 				"can_call": False,
-				"reason": "Permission expired. Please request permission again."
+				"reason": PERMISSION_EXPIRED
 			}
 
-	# Check 24h call limit (max 5 calls)
-	if permission.last_call_at:
-		last_call = frappe.utils.get_datetime(permission.last_call_at)
-		if (datetime.now() - last_call).total_seconds() < 86400:  # Within 24 hours
-			if permission.calls_in_24h >= 5:
-				return {
-					"can_call": False,
-					"reason": "Daily call limit (5) reached. Please try tomorrow."
-				}
+	# Check 24h call limit (max 5 calls) on the shared sliding window
+	subject = get_subject(business_number, customer_number)
+	seed = get_call_seed(permission)
+	usage = call_limiter.hit(subject, seed) if reserve else call_limiter.peek(subject, seed)
+
+	if not usage["allowed"]:
+		return {
+			"can_call": False,
+			"reason": CALL_LIMIT_REACHED
+		}
+
+	if not reserve:
+		return {"can_call": True, "reason": "OK"}
+
+	# Durable mirror of the window, without a document save
+	frappe.db.set_value("Call Permission", permission.name, {
+		"calls_in_24h": usage["counts"][0],
+		"last_call_at": frappe.utils.now(),
+		"recent_calls": call_limiter.push_recent(permission.recent_calls)
+	}, update_modified=False)
+
+	return {"can_call": True, "reason": "OK", "reservation": usage["member"]}
+
+
+def get_granted_numbers(customer_number):
+	"""Business numbers the customer has granted call permission to, unexpired"""
+	return frappe.get_all(
+		"Call Permission",
+		filters={"customer_number": customer_number, "permission_status": "Granted"},
+		or_filters=[["expires_at", "is", "not set"], ["expires_at", ">", frappe.utils.now()]],
+		pluck="business_number"
+	)
+
+
+def get_permission_number(customer_number, company):
+	"""
+	WhatsApp Number holding a customer's call permission with a company
+
+	Args:
+		customer_number: Customer's number
+		company: Company
+
+	Returns:
+		ConfigSnapshot of the WhatsApp Number: one the customer granted
+		(unexpired), else the one of their latest Call Permission record.
+		None when they have no record on the company's Active numbers.
+	"""
+	numbers = {number.name: number for number in get_company_numbers(company)}
+	if not numbers:
+		return None
+
+	rows = frappe.get_all(
+		"Call Permission",
+		filters={"customer_number": customer_number, "business_number": ["in", list(numbers)]},
+		fields=["business_number", "permission_status", "expires_at"],
+		order_by="modified desc"
+	)
+	if not rows:
+		return None
+
+	now = datetime.now()
+	granted = [
+		row.business_number for row in rows
+		if row.permission_status == "Granted" and (not row.expires_at or row.expires_at > now)
+	]
+	if granted:
+		return select_number(company, prefer=granted)
+
+	return numbers[rows[0].business_number]
+
+
+def release_call_permission(customer_number, business_number, reservation):
+	"""
+	Give back a call reserved by check_call_permission that did not go out
+
+	The call stays in the recent_calls mirror, which therefore errs on the
+	strict side until it leaves the window.
+	"""
+	call_limiter.undo(get_subject(business_number, customer_number), reservation)
+
+
+def get_call_seed(permission):
+	"""
+	Seed events for the call window from a permission's mirror: the exact
+	recent call times, or for rows without them, the 24h counter
+	"""
+	if permission.get("recent_calls"):
+		return call_limiter.recent_seed(permission.recent_calls)
+	return mirror_seed(permission.calls_in_24h, permission.last_call_at)
+
+
+@frappe.whitelist()
+def check_call_permissions(customer_numbers, business_number):
+	"""
+	check_call_permission for many customers at once, e.g. to build a dial list
+
+	Permission rows are read with set-based queries (BULK_CHUNK_SIZE numbers
+	each) and evaluated in memory. The 24h limit is judged from the recent
+	call times mirrored on Call Permission, which may be slightly stricter
+	than the live window; make_call still takes the authoritative check.
+
+	Args:
+		customer_numbers: list (or JSON list) of customer numbers
+		business_number: WhatsApp Number name
+
+	Returns:
+		dict of customer number -> {"can_call": True/False, "reason": ...}
+	"""
+	frappe.has_permission("Call Permission", "read", throw=True)
+
+	if isinstance(customer_numbers, str):
+		customer_numbers = frappe.parse_json(customer_numbers)
+	customer_numbers = list(dict.fromkeys(customer_numbers or []))
+
+	rows = []
+	for start in range(0, len(customer_numbers), BULK_CHUNK_SIZE):
+		rows += get_permission_rows(customer_numbers[start:start + BULK_CHUNK_SIZE], business_number)
+
+	return evaluate_permissions(customer_numbers, rows)
+
+
+def get_permission_rows(customer_numbers, business_number, table="tabCall Permission"):
+	"""
+	One query for the permission rows of many customers of a business number
+
+	Served by the (customer_number, business_number) index. `table` is
+	overridable for benchmarks.
+	"""
+	if not customer_numbers:
+		return []
+
+	return frappe.db.sql(f"""
+		SELECT customer_number, permission_status, expires_at, calls_in_24h, last_call_at, recent_calls
+		FROM `{table}`
+		WHERE customer_number IN %(customer_numbers)s AND business_number = %(business_number)s
+	""", {"customer_numbers": customer_numbers, "business_number": business_number}, as_dict=True)
+
+
+def evaluate_permissions(customer_numbers, rows, now=None):
+	"""
+	In-memory verdicts for get_permission_rows results, with the same rules
+	and reasons as check_call_permission
+
+	Returns:
+		dict of customer number -> {"can_call", "reason"}
+	"""
+	now = now or datetime.now()
+	max_calls = call_limiter.windows[0][1]
+	by_number = {row.customer_number: row for row in rows}
+
+	def verdict(row):
+		if row is None:
+			return False, NO_PERMISSION
+		if row.permission_status != "Granted":
+			return False, f"Permission status: {row.permission_status}"
+		if row.expires_at and row.expires_at < now:
+			return False, PERMISSION_EXPIRED
+		if count_calls_in_24h(row, now) >= max_calls:
+			return False, CALL_LIMIT_REACHED
+		return True, "OK"
+
+	results = {}
+	for number in customer_numbers:
+		can_call, reason = verdict(by_number.get(number))
+		results[number] = {"can_call": can_call, "reason": reason}
+	return results
+
+
+def count_calls_in_24h(permission, now):
+	"""
+	Calls in the last 24h from a permission's mirror: the recent call times,
+	or for rows without them, the 24h counter while its last call is recent
+	"""
+	if permission.recent_calls:
+		return call_limiter.count_recent(permission.recent_calls, now.timestamp())[0]
+	if permission.last_call_at and permission.last_call_at > now - timedelta(days=1):
+		return permission.calls_in_24h or 0
+	return 0
+
+
+@frappe.whitelist()
+def get_call_permission_status(customer_number, business_number):
+	"""
+	Call permission of a customer on a business number, for the Lead form
+
+	Args:
+		customer_number: Customer's number
+		business_number: WhatsApp Number name
+
+	Returns:
+		dict with permission_status, expires_at and calls_remaining (of the
+		5 per 24h, from the recent call times), or None without a record
+	"""
+	frappe.has_permission("Call Permission", "read", throw=True)
 
-	return {"can_call": True, "reason": "OK"}
+	permission = frappe.db.get_value(
+		"Call Permission",
+		{
+			"customer_number": customer_number,
+			"business_number": business_number
+		},
+		["permission_status", "expires_at", "calls_in_24h", "last_call_at", "recent_calls"],
+		as_dict=True
+	)
+
+	if not permission:
+		return None
+
+	max_calls = call_limiter.windows[0][1]
+	return {
+		"permission_status": permission.permission_status,
+		"expires_at": permission.expires_at,
+		"calls_remaining": max(max_calls - count_calls_in_24h(permission, datetime.now()), 0)
+	}
 
 
 @frappe.whitelist()
@@ -72,9 +314,14 @@ def request_call_permission(lead_name, mobile_number):
 		lead_name: CRM Lead name
 		mobile_number: Customer mobile number
 	"""
+	reservation = None
+
 	try:
 		lead = frappe.get_doc("Lead", lead_name)
-		wa_number = get_company_whatsapp_number(lead.company)
+
+		# Ask again on the number the customer already has a record with;
+		# only first requests are spread over the company's numbers
+		wa_number = get_permission_number(mobile_number, lead.company) or select_number(lead.company)
 
 		if not wa_number:
 			frappe.throw(_("No WhatsApp number configured"))
@@ -90,25 +337,22 @@ def request_call_permission(lead_name, mobile_number):
 			as_dict=True
 		)
 
-		# Check request limits
-		if existing:
-			last_request = frappe.utils.get_datetime(existing.request_sent_at)
-			hours_since = (datetime.now() - last_request).total_seconds() / 3600
+		# Check request limits (1 per 24h, 2 per 7 days) and take a request,
+		# atomically across workers
+		subject = get_subject(wa_number.name, mobile_number)
+		usage = permission_request_limiter.hit(
+			subject,
+			seed=mirror_seed(existing.requests_in_7d, existing.request_sent_at) if existing else None
+		)
 
-			if hours_since < 24 and existing.requests_in_24h >= 1:
+		if not usage["allowed"]:
+			if usage["counts"][0] >= 1:
 				frappe.throw(_("Can only send 1 request per 24 hours"))
+			frappe.throw(_("Can only send 2 requests per 7 days"))
 
-			if hours_since < 168 and existing.requests_in_7d >= 2:  # 7 days
-				frappe.throw(_("Can only send 2 requests per 7 days"))
+		reservation = usage["member"]
 
-			permission_doc = frappe.get_doc("Call Permission", existing.name)
-
-			# Reset counters if needed
-			if hours_since >= 24:
-				permission_doc.requests_in_24h = 0
-			if hours_since >= 168:
-				permission_doc.requests_in_7d = 0
-		else:
+		if not existing:
 			# Create new permission record
 			permission_doc = frappe.get_doc({
 				"doctype": "Call Permission",
@@ -124,34 +368,27 @@ def request_call_permission(lead_name, mobile_number):
 		# Send WhatsApp template
 		wa_api = WhatsAppAPI(
 			wa_number.phone_number_id,
-			wa_number.get_access_token()
+			wa_number.access_token
 		)
 
 		# Template must be pre-approved in Meta Business Manager
 		wa_api.send_template(
 			to_number=mobile_number,
-			template_name="call_permission_request",
-			components=[{
-				"type": "button",
-				"sub_type": "voice_call",
-				"index": 0,
-				"parameters": [{
-					"type": "action",
-					"action": {
-						"flow_action_type": "voice_call_request"
-					}
-				}]
-			}]
+			template_name=PERMISSION_REQUEST_TEMPLATE,
+			components=PERMISSION_REQUEST_COMPONENTS
 		)
 
-		# Update permission record
-		permission_doc.requests_in_24h += 1
-		permission_doc.requests_in_7d += 1
-		permission_doc.request_sent_at = frappe.utils.now()
+		# Mirror the request windows on the permission record
+		mirror = {
+			"requests_in_24h": usage["counts"][0],
+			"requests_in_7d": usage["counts"][1],
+			"request_sent_at": frappe.utils.now()
+		}
 
 		if existing:
-			permission_doc.save()
+			frappe.db.set_value("Call Permission", existing.name, mirror)
 		else:
+			permission_doc.update(mirror)
 			permission_doc.insert()
 
 		frappe.db.commit()
@@ -160,6 +397,10 @@ def request_call_permission(lead_name, mobile_number):
 		return {"success": True}
 
 	except Exception as e:
+		if reservation:
+			# The request did not go out: it does not count
+			permission_request_limiter.undo(subject, reservation)
+
 		frappe.log_error(message=str(e), title="Request Permission Error")
 		frappe.throw(_(str(e)))
 
@@ -175,16 +416,13 @@ def update_permission_on_grant(customer_number, business_number):
 	permission.granted_at = frappe.utils.now()
 	permission.expires_at = frappe.utils.add_days(frappe.utils.now(), 7)
 	permission.calls_in_24h = 0
+	permission.recent_calls = None
 	permission.save()
 
 	frappe.db.commit()
 
+	# A new grant starts a new call allowance
+	call_limiter.reset(get_subject(business_number, customer_number))
 
-def get_company_whatsapp_number(company):
-	"""Helper to get company's WhatsApp number"""
-	numbers = frappe.get_all(
-		"WhatsApp Number",
-		filters={"company": company, "status": "Active"},
-		limit=1
-	)
-	return frappe.get_doc("WhatsApp Number", numbers[0].name) if numbers else None
+	# The customer is now likely to call; have their caller ID ready
+	resolve_caller_id(customer_number)
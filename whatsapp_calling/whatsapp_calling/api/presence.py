@@ -0,0 +1,184 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Agent presence registry
+
+The CallWidget sends a heartbeat every few seconds while the desk is open,
+from every tab. Presence lives in Redis only: when heartbeats stop, the
+agent simply ages out and is treated as offline. Closing a tab only takes
+the agent offline when no other tab is still sending heartbeats.
+"""
+
+import frappe
+import time
+from frappe import _
+from frappe.utils import cint
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_settings
+
+LAST_SEEN_KEY = "whatsapp_agent_last_seen"
+STATUS_KEY = "whatsapp_agent_status"
+LAST_CALL_KEY = "whatsapp_agent_last_call"
+TABS_KEY = "whatsapp_agent_tabs:{0}"
+
+HEARTBEAT_TIMEOUT = 45  # seconds without heartbeat before an agent is offline
+DEFAULT_WRAP_UP_SECONDS = 30
+
+AVAILABLE = "Available"
+ON_CALL = "On Call"
+WRAP_UP = "Wrap Up"
+AGENT_STATUSES = (AVAILABLE, ON_CALL, WRAP_UP)
+
+# Set by calls, not by heartbeats
+BUSY_STATUSES = (ON_CALL, WRAP_UP)
+
+
+@frappe.whitelist()
+def heartbeat(status=None, tab_id=None):
+	"""
+	Called periodically by the CallWidget
+
+	Args:
+		status: optional status the agent picked; ignored while On Call or
+			in Wrap Up
+		tab_id: id of the sending browser tab
+
+	Returns:
+		dict with the agent's effective status
+	"""
+	user = frappe.session.user
+	cache = frappe.cache()
+	now = time.time()
+
+	cache.hset(LAST_SEEN_KEY, user, now)
+	if tab_id:
+		cache.hset(TABS_KEY.format(user), tab_id, now)
+
+	current = cache.hget(STATUS_KEY, user)
+	if not current:
+		# First heartbeat after going online: idle from now on
+		set_agent_status(user, status or AVAILABLE)
+	elif status and status != current[0] and current[0] not in BUSY_STATUSES:
+		set_agent_status(user, status)
+
+	return {"status": get_agent_state(user)["status"]}
+
+
+@frappe.whitelist()
+def go_offline(tab_id=None):
+	"""
+	Called by the CallWidget when a tab is closed
+
+	The agent goes offline only when no other tab has sent a heartbeat
+	within HEARTBEAT_TIMEOUT. A call in progress keeps its status.
+	"""
+	user = frappe.session.user
+	cache = frappe.cache()
+	tabs_key = TABS_KEY.format(user)
+
+	if tab_id:
+		cache.hdel(tabs_key, tab_id)
+
+	now = time.time()
+	if any(now - seen <= HEARTBEAT_TIMEOUT for seen in (cache.hgetall(tabs_key) or {}).values()):
+		return
+
+	cache.delete_value(tabs_key)
+	cache.hdel(LAST_SEEN_KEY, user)
+
+	state = cache.hget(STATUS_KEY, user)
+	if state and state[0] not in BUSY_STATUSES:
+		cache.hdel(STATUS_KEY, user)
+
+
+def set_agent_status(user, status):
+	"""Record a status change and since when it applies"""
+	if status not in AGENT_STATUSES:
+		frappe.throw(_("Invalid agent status: {0}").format(status))
+
+	frappe.cache().hset(STATUS_KEY, user, (status, time.time()))
+
+	if status == ON_CALL:
+		frappe.cache().hset(LAST_CALL_KEY, user, time.time())
+
+
+def finish_agent_call(user):
+	"""
+	Move an agent from On Call to Wrap Up once the transaction commits, for
+	calls that end without them (the customer hung up, the call failed or
+	was not answered)
+	"""
+	if not user:
+		return
+
+	def finish():
+		state = frappe.cache().hget(STATUS_KEY, user)
+		if state and state[0] == ON_CALL:
+			set_agent_status(user, WRAP_UP)
+
+	frappe.db.after_commit.add(finish)
+
+
+def get_agent_state(user, now=None, last_seen=None, status=None, last_call=None, wrap_up=None):
+	"""
+	Effective state of an agent
+
+	Wrap-up ends by itself after the configured number of seconds, and an
+	agent without a recent heartbeat is Offline whatever they last set.
+
+	Returns:
+		dict with status, idle_since and last_call_at (unix timestamps)
+	"""
+	cache = frappe.cache()
+	now = now or time.time()
+	last_seen = last_seen if last_seen is not None else cache.hget(LAST_SEEN_KEY, user)
+	status, since = status or cache.hget(STATUS_KEY, user) or (AVAILABLE, last_seen or now)
+	last_call = last_call if last_call is not None else cache.hget(LAST_CALL_KEY, user)
+	wrap_up = wrap_up if wrap_up is not None else get_wrap_up_seconds()
+
+	if not last_seen or now - last_seen > HEARTBEAT_TIMEOUT:
+		return {"status": "Offline", "idle_since": None, "last_call_at": last_call}
+
+	if status == WRAP_UP and now - since >= wrap_up:
+		status, since = AVAILABLE, since + wrap_up
+
+	return {
+		"status": status,
+		"idle_since": since if status == AVAILABLE else None,
+		"last_call_at": last_call
+	}
+
+
+def get_online_agents():
+	"""
+	States of every agent with a live heartbeat, read in three HGETALLs
+
+	Returns:
+		dict of user -> state (see get_agent_state)
+	"""
+	cache = frappe.cache()
+	last_seen, statuses, last_calls = (
+		{frappe.safe_decode(user): value for user, value in (cache.hgetall(key) or {}).items()}
+		for key in (LAST_SEEN_KEY, STATUS_KEY, LAST_CALL_KEY)
+	)
+	wrap_up = get_wrap_up_seconds()
+	now = time.time()
+
+	agents = {}
+	for user, seen in last_seen.items():
+		state = get_agent_state(
+			user,
+			now=now,
+			last_seen=seen,
+			status=statuses.get(user) or (AVAILABLE, seen),
+			last_call=last_calls.get(user) or 0,
+			wrap_up=wrap_up
+		)
+		if state["status"] != "Offline":
+			agents[user] = state
+
+	return agents
+
+
+def get_wrap_up_seconds():
+	return cint(get_settings().agent_wrap_up_seconds) or DEFAULT_WRAP_UP_SECONDS
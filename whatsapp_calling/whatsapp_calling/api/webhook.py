@@ -4,7 +4,22 @@
 import frappe
 import json
 from frappe import _
+from frappe.utils import cint
 from werkzeug.wrappers import Response
+from whatsapp_calling.whatsapp_calling.utils.dedup import get_deduplicator, get_event_fingerprint
+from whatsapp_calling.whatsapp_calling.utils.locks import call_locks
+from whatsapp_calling.whatsapp_calling.utils.call_router import route_call
+from whatsapp_calling.whatsapp_calling.utils.caller_id import resolve_caller_ids
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_settings
+from whatsapp_calling.whatsapp_calling.api.presence import finish_agent_call
+from whatsapp_calling.whatsapp_calling.utils.call_projector import (
+	FINAL_RANK,
+	STATUS_RANK,
+	get_event_time,
+	load_call_histories,
+	project_call,
+	record_call_events
+)
 
 
 @frappe.whitelist(allow_guest=True, methods=['GET', 'POST'])
@@ -25,15 +40,22 @@ def whatsapp_webhook():
 		return {"status": "error", "message": str(e)}
 
 
+@frappe.whitelist()
+def get_dedup_stats():
+	"""Show how many redelivered webhook events were dropped"""
+	frappe.only_for("System Manager")
+	return get_deduplicator().stats()
+
+
 def verify_webhook():
 	"""Verify webhook with Meta"""
 	mode = frappe.form_dict.get('hub.mode')
 	token = frappe.form_dict.get('hub.verify_token')
 	challenge = frappe.form_dict.get('hub.challenge')
 
-	settings = frappe.get_single("WhatsApp Settings")
+	settings = get_settings()
 
-	if mode == 'subscribe' and token == settings.get_password('webhook_verify_token'):
+	if mode == 'subscribe' and token and token == settings.webhook_verify_token:
 		# Return challenge as plain text using werkzeug Response
 		frappe.local.response = Response(challenge, status=200, content_type='text/plain')
 		return
@@ -47,17 +69,17 @@ def process_webhook():
 	try:
 		data = json.loads(frappe.request.data)
 
-		for entry in data.get("entry", []):
-			for change in entry.get("changes", []):
-				value = change.get("value", {})
+		if not is_valid_payload(data):
+			frappe.local.response.http_status_code = 400
+			return {"status": "error", "message": "Invalid payload"}
 
-				# Handle call events
-				if "calls" in value:
-					handle_call_event(value["calls"][0], value.get("metadata", {}))
+		# Background mode: store the payload and let workers do the rest
+		settings = get_settings()
+		if settings.webhook_processing_mode == "Background":
+			from whatsapp_calling.whatsapp_calling.utils.webhook_queue import enqueue_webhook
+			return enqueue_webhook(data, raw_body=frappe.safe_decode(frappe.request.data))
 
-				# Handle message events (for unified thread)
-				if "messages" in value:
-					handle_message_event(value["messages"][0])
+		handle_events(extract_events(data))
 
 		return {"status": "success"}
 
@@ -66,101 +88,359 @@ def process_webhook():
 		return {"status": "error"}
 
 
+def is_valid_payload(data):
+	"""Cheap structural check before anything is stored or queued"""
+	return isinstance(data, dict) and isinstance(data.get("entry", []), list)
+
+
+def extract_events(data):
+	"""
+	Flatten a webhook payload into a list of events
+
+	Every call and message of every entry/change is returned, in payload
+	order. Each event carries the key used to keep events of one call in order:
+		{"type": "call" | "message", "key": ..., "data": ..., "metadata": ...}
+	"""
+	events = []
+
+	for entry in data.get("entry", []):
+		for change in entry.get("changes", []):
+			value = change.get("value", {})
+			metadata = value.get("metadata", {})
+
+			# Handle call events
+			for call in value.get("calls", []):
+				events.append({
+					"type": "call",
+					"key": call.get("id"),
+					"data": call,
+					"metadata": metadata
+				})
+
+			# Handle message events (for unified thread)
+			for message in value.get("messages", []):
+				events.append({
+					"type": "message",
+					"key": message.get("from"),
+					"data": message,
+					"metadata": metadata
+				})
+
+	return events
+
+
+def handle_events(events):
+	"""
+	Process a batch of extracted events in a single transaction
+
+	Args:
+		events: list of events from extract_events, in arrival order
+	"""
+	# Drop Meta redeliveries before touching the database
+	deduplicator = get_deduplicator()
+	fingerprints = [get_event_fingerprint(event) for event in events]
+	fresh = deduplicator.filter_new(fingerprints)
+
+	events = [event for event, is_new in zip(events, fresh) if is_new]
+	fingerprints = [fingerprint for fingerprint, is_new in zip(fingerprints, fresh) if is_new]
+
+	if not events:
+		return
+
+	call_events = [event for event in events if event["type"] == "call" and event["key"]]
+
+	try:
+		# Serialize with other workers touching the same calls until commit
+		with call_locks([event["key"] for event in call_events]) as fence_tokens:
+			# Start a fresh snapshot so rows committed by the previous
+			# holder of these locks are visible to our reads
+			frappe.db.commit()
+
+			if call_events:
+				handle_call_events(call_events, fence_tokens)
+
+			for event in events:
+				if event["type"] == "message":
+					handle_message_event(event["data"])
+
+			# Seen for good only once the events are really stored
+			frappe.db.after_commit.add(lambda: deduplicator.confirm(fingerprints))
+			frappe.db.commit()
+
+	except Exception:
+		# Let a redelivery or replay of these events through again
+		deduplicator.forget(fingerprints)
+		raise
+
+
 def handle_call_event(call_data, metadata):
-	"""Process call webhook event"""
-	call_id = call_data.get("id")
-	status = call_data.get("status")  # ringing, answered, ended
-	from_number = call_data.get("from")
-	to_number = metadata.get("display_phone_number")
-	timestamp = call_data.get("timestamp")
+	"""Process a single call webhook event"""
+	handle_events([{
+		"type": "call",
+		"key": call_data.get("id"),
+		"data": call_data,
+		"metadata": metadata
+	}])
 
-	# Get or create call record
-	existing = frappe.db.get_value("WhatsApp Call", {"call_id": call_id}, "name")
 
-	if existing:
-		call_doc = frappe.get_doc("WhatsApp Call", existing)
-	else:
-		# New inbound call
-		# Get WhatsApp Number details
-		wa_number = frappe.get_doc("WhatsApp Number", {"phone_number": to_number})
-
-		# Try to find linked lead
-		lead = find_lead_by_mobile(from_number)
-
-		call_doc = frappe.get_doc({
-			"doctype": "WhatsApp Call",
-			"call_id": call_id,
-			"customer_number": from_number,
-			"business_number": wa_number.name,
-			"company": wa_number.company,
-			"direction": "Inbound",
-			"status": "Ringing",
-			"initiated_at": frappe.utils.now(),
-			"lead": lead
-		})
-		call_doc.insert(ignore_permissions=True)
+def handle_call_events(events, fence_tokens):
+	"""
+	Apply call events with grouped lookups and batched writes
 
-	# Update status
-	if status == "ringing" and call_doc.direction == "Inbound":
-		# Notify available agents
-		notify_agents(call_doc)
+	Events are appended to the WhatsApp Call Event log, then each call's
+	state is projected from its whole history onto one in-memory document,
+	so each call is written at most once however many events it received.
+
+	Args:
+		events: call events, in arrival order
+		fence_tokens: dict of call_id -> fencing token of the held lock
+	"""
+	events_by_call = {}
+	for event in events:
+		events_by_call.setdefault(event["key"], []).append(event)
+
+	# Cheap append-only insert, then read back full histories in one query
+	record_call_events(events)
+	histories = load_call_histories(list(events_by_call))
 
-	elif status == "answered":
-		call_doc.status = "Answered"
-		call_doc.answered_at = frappe.utils.now()
+	# One query for every call we already know about
+	existing = get_calls_by_id(list(events_by_call))
+
+	# One query for the business numbers of new inbound calls
+	new_events = [event for event in events if event["key"] not in existing]
+	wa_numbers = get_whatsapp_numbers_by_phone({
+		event["metadata"].get("display_phone_number") for event in new_events
+	})
+
+	# Caller IDs of new callers, normally straight from cache
+	callers = resolve_caller_ids([event["data"].get("from") for event in new_events])
+
+	updated = []
+	ringing = []
+	doc_updates = {}
+
+	for call_id, call_events in events_by_call.items():
+		if call_id in existing:
+			call_doc = load_call_from_row(existing[call_id])
+		else:
+			first = call_events[0]
+			call_doc = new_inbound_call(first["data"], first["metadata"], wa_numbers, callers)
+
+		is_ringing = apply_call_events(call_doc, call_events, histories[call_id])
+		call_doc.fence_token = fence_tokens[call_id]
+
+		if call_doc.is_new():
+			inserted = upsert_call(call_doc)
+			if inserted:
+				if is_ringing:
+					ringing.append(call_doc)
+				continue
+
+			# Someone else created it meanwhile: replay onto their row instead
+			row = frappe.db.get_value("WhatsApp Call", {"call_id": call_id}, "*", as_dict=True, for_update=True)
+			call_doc = load_call_from_row(row)
+			is_ringing = apply_call_events(call_doc, call_events, histories[call_id])
+			call_doc.fence_token = fence_tokens[call_id]
 
-	elif status == "ended":
-		call_doc.status = "Ended"
-		call_doc.ended_at = frappe.utils.now()
 		call_doc.validate()  # Calculate duration and cost
+		changes = get_call_changes(call_doc)
+		if changes:
+			changes["fence_token"] = call_doc.fence_token
+			doc_updates[call_doc.name] = changes
+			updated.append(call_doc)
 
-	call_doc.save(ignore_permissions=True)
-	frappe.db.commit()
+		if is_ringing:
+			ringing.append(call_doc)
 
+	# Single fenced UPDATE for all existing calls
+	applied = apply_fenced_updates(doc_updates) if doc_updates else set()
 
-def find_lead_by_mobile(mobile_number):
-	"""Find CRM Lead by mobile number"""
-	# Clean number for comparison
-	clean_number = mobile_number.replace("+", "").replace("-", "").replace(" ", "")
+	for call_doc in updated:
+		if call_doc.name in applied:
+			call_doc.on_update()
 
-	leads = frappe.get_all(
-		"Lead",
-		filters={
-			"mobile_no": ["like", f"%{clean_number[-10:]}%"]  # Match last 10 digits
-		},
-		limit=1
+			# The call ended on the customer's side: free its agent
+			if "status" in doc_updates[call_doc.name] and STATUS_RANK.get(call_doc.status) == FINAL_RANK:
+				finish_agent_call(call_doc.assigned_to)
+
+	for call_doc in ringing:
+		notify_agents(call_doc)
+
+
+def apply_call_events(call_doc, events, history):
+	"""
+	Project a call's event history onto its document
+
+	Args:
+		call_doc: WhatsApp Call document
+		events: events of this batch for the call
+		history: all logged events of the call, in Meta timestamp order
+
+	Returns:
+		True if this batch rang an inbound call that is still ringing
+	"""
+	project_call(call_doc, history)
+
+	# Notify available agents once the record is written
+	return (
+		call_doc.direction == "Inbound"
+		and call_doc.status == "Ringing"
+		and any(event["data"].get("status") == "ringing" for event in events)
 	)
 
-	return leads[0].name if leads else None
 
+def upsert_call(call_doc):
+	"""
+	Insert a new call record unless another writer got there first
 
-def notify_agents(call_doc):
-	"""Send real-time notification to agents"""
-	# Find users with access to this company
-	users = frappe.get_all(
-		"User",
-		filters={
-			"enabled": 1,
-			"user_type": "System User"
-		},
-		pluck="name"
+	Returns:
+		True if inserted, False if a row with the same call_id already exists
+	"""
+	frappe.db.savepoint("whatsapp_call_upsert")
+	try:
+		call_doc.insert(ignore_permissions=True)
+		return True
+	except (frappe.UniqueValidationError, frappe.DuplicateEntryError):
+		frappe.db.rollback(save_point="whatsapp_call_upsert")
+		return False
+
+
+def apply_fenced_updates(doc_updates):
+	"""
+	Write many calls in one UPDATE, skipping rows fenced by a newer lock holder
+
+	Args:
+		doc_updates: dict of name -> {fieldname: value}, each with fence_token
+
+	Returns:
+		set of names whose update was applied
+	"""
+	names = list(doc_updates)
+	fields = sorted({field for changes in doc_updates.values() for field in changes})
+
+	assignments = []
+	values = []
+	for field in fields:
+		cases = []
+		for name in names:
+			if field in doc_updates[name]:
+				cases.append("WHEN %s THEN %s")
+				values.extend([name, doc_updates[name][field]])
+		assignments.append(f"`{field}` = CASE name {' '.join(cases)} ELSE `{field}` END")
+
+	fence_cases = " ".join("WHEN %s THEN %s" for name in names)
+	fence_values = [value for name in names for value in (name, doc_updates[name]["fence_token"])]
+	placeholders = ", ".join(["%s"] * len(names))
+
+	frappe.db.sql(f"""
+		UPDATE `tabWhatsApp Call`
+		SET {", ".join(assignments)}, modified = %s, modified_by = %s
+		WHERE name IN ({placeholders})
+			AND IFNULL(fence_token, 0) <= CASE name {fence_cases} END
+	""", values + [frappe.utils.now(), frappe.session.user] + names + fence_values)
+
+	# Rows now carrying our token are the ones we wrote
+	written = frappe.get_all(
+		"WhatsApp Call",
+		filters={"name": ["in", names]},
+		fields=["name", "fence_token"]
+	)
+	return {
+		row.name for row in written
+		if cint(row.fence_token) == cint(doc_updates[row.name]["fence_token"])
+	}
+
+
+def get_calls_by_id(call_ids):
+	"""Fetch WhatsApp Call rows for many call_ids in one query"""
+	if not call_ids:
+		return {}
+
+	rows = frappe.get_all(
+		"WhatsApp Call",
+		filters={"call_id": ["in", call_ids]},
+		fields=["*"]
+	)
+	return {row.call_id: row for row in rows}
+
+
+CALL_STATE_FIELDS = ("status", "answered_at", "ended_at", "duration_seconds", "cost")
+
+
+def load_call_from_row(row):
+	"""Build a WhatsApp Call document from an already fetched row"""
+	call_doc = frappe.get_doc(dict(row, doctype="WhatsApp Call"))
+
+	# Lets has_value_changed() in on_update work without reloading the row
+	call_doc._doc_before_save = frappe.get_doc(dict(row, doctype="WhatsApp Call"))
+	return call_doc
+
+
+def get_call_changes(call_doc):
+	"""Return the state fields that differ from the stored row"""
+	before = call_doc.get_doc_before_save()
+	return {
+		field: call_doc.get(field)
+		for field in CALL_STATE_FIELDS
+		if str(call_doc.get(field) or "") != str(before.get(field) or "")
+	}
+
+
+def new_inbound_call(call_data, metadata, wa_numbers, callers):
+	"""Prepare (but do not insert) a record for a call we have not seen"""
+	to_number = metadata.get("display_phone_number")
+	wa_number = wa_numbers.get(to_number)
+
+	if not wa_number:
+		frappe.throw(_("WhatsApp Number {0} not found").format(to_number), frappe.DoesNotExistError)
+
+	from_number = call_data.get("from")
+
+	# Linked lead, if any (resolved for the whole batch up front)
+	caller = callers.get(from_number) or {}
+
+	return frappe.get_doc({
+		"doctype": "WhatsApp Call",
+		"call_id": call_data.get("id"),
+		"customer_number": from_number,
+		"business_number": wa_number.name,
+		"company": wa_number.company,
+		"direction": "Inbound",
+		"status": "Ringing",
+		"initiated_at": get_event_time(call_data) or frappe.utils.now(),
+		"lead": caller.get("lead"),
+		"contact_name": caller.get("lead_name") or caller.get("company_name")
+	})
+
+
+def get_whatsapp_numbers_by_phone(phone_numbers):
+	"""Resolve display phone numbers to WhatsApp Number rows in one query"""
+	phone_numbers = [number for number in phone_numbers if number]
+	if not phone_numbers:
+		return {}
+
+	rows = frappe.get_all(
+		"WhatsApp Number",
+		filters={"phone_number": ["in", phone_numbers]},
+		fields=["name", "phone_number", "company"]
 	)
+	return {row.phone_number: row for row in rows}
+
 
-	for user in users:
-		# Check if user has permission for this company
-		# TODO: Implement proper permission check
-
-		frappe.publish_realtime(
-			event='incoming_whatsapp_call',
-			message={
-				'call_id': call_doc.call_id,
-				'call_name': call_doc.name,
-				'customer_number': call_doc.customer_number,
-				'customer_name': call_doc.contact_name or "Unknown",
-				'lead': call_doc.lead
-			},
-			user=user
-		)
+def notify_agents(call_doc):
+	"""Send real-time notification to agents of the called number"""
+	# Ring All publishes to each agent allowed on the number; other
+	# strategies ring available agents of that number in waves
+	route_call(
+		call_doc,
+		{
+			'call_id': call_doc.call_id,
+			'call_name': call_doc.name,
+			'customer_number': call_doc.customer_number,
+			'customer_name': call_doc.contact_name or "Unknown",
+			'lead': call_doc.lead
+		}
+	)
 
 
 def handle_message_event(message_data):
@@ -0,0 +1,268 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Benchmarks for hot paths of the app
+
+Run against a site with bench, e.g.:
+
+	bench --site mysite execute whatsapp_calling.whatsapp_calling.benchmarks.benchmark_lead_lookup
+
+Each benchmark returns its results, which bench execute prints.
+
+Benchmarks work on their own scratch tables and never touch real data;
+transport benchmarks only send read-only requests (Janus /info).
+"""
+
+import frappe
+import json
+import random
+import requests
+import time
+from datetime import datetime, timedelta
+from whatsapp_calling.whatsapp_calling.api.permissions import BULK_CHUNK_SIZE, evaluate_permissions, get_permission_rows
+from whatsapp_calling.whatsapp_calling.utils.http import close_sessions, get_session
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_settings
+from whatsapp_calling.whatsapp_calling.utils.validators import get_phone_lookup_keys
+
+INSERT_CHUNK_SIZE = 10000
+
+
+def _timed(fn, repeat):
+	"""Run fn `repeat` times and return per-call timings in milliseconds"""
+	timings = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		fn()
+		timings.append((time.perf_counter() - start) * 1000)
+	return timings
+
+
+def _summary(timings):
+	timings = sorted(timings)
+	return {
+		"mean_ms": round(sum(timings) / len(timings), 3),
+		"p50_ms": round(timings[len(timings) // 2], 3),
+		"p95_ms": round(timings[int(len(timings) * 0.95) - 1], 3),
+		"max_ms": round(timings[-1], 3)
+	}
+
+
+def _random_mobile(rng):
+	"""Indian-style mobile number in a mix of the formats found in Leads"""
+	digits = f"{rng.randint(6, 9)}{rng.randint(0, 999999999):09d}"
+	return rng.choice([f"+91{digits}", f"+91 {digits[:5]} {digits[5:]}", digits, f"0{digits}"])
+
+
+def benchmark_lead_lookup(leads=1000000, probes=200, seed=42):
+	"""
+	Compare the old LIKE '%<last10>%' Lead scan with the Lead Phone Key probe
+
+	Builds `leads` synthetic rows in scratch tables shaped like `tabLead`
+	(mobile_no, unindexed) and `tabLead Phone Key` (phone_key, indexed), then
+	times `probes` lookups of existing numbers with both strategies.
+	"""
+	rng = random.Random(seed)
+
+	frappe.db.sql_ddl("DROP TABLE IF EXISTS `_bench_lead`")
+	frappe.db.sql_ddl("DROP TABLE IF EXISTS `_bench_lead_phone_key`")
+	frappe.db.sql_ddl("""
+		CREATE TABLE `_bench_lead` (
+			name VARCHAR(140) PRIMARY KEY,
+			mobile_no VARCHAR(140)
+		) ENGINE=InnoDB
+	""")
+	frappe.db.sql_ddl("""
+		CREATE TABLE `_bench_lead_phone_key` (
+			name VARCHAR(140) PRIMARY KEY,
+			phone_key VARCHAR(140),
+			lead VARCHAR(140),
+			KEY phone_key (phone_key)
+		) ENGINE=InnoDB
+	""")
+
+	try:
+		sample = []
+		for offset in range(0, leads, INSERT_CHUNK_SIZE):
+			lead_rows = []
+			key_rows = []
+			for i in range(offset, min(offset + INSERT_CHUNK_SIZE, leads)):
+				name = f"CRM-LEAD-{i:08d}"
+				mobile = _random_mobile(rng)
+				lead_rows.append((name, mobile))
+				for n, (key, key_type) in enumerate(get_phone_lookup_keys(mobile)):
+					key_rows.append((f"{name}-{n}", key, name))
+				if rng.random() < probes / leads:
+					sample.append(mobile)
+
+			frappe.db.sql(
+				"INSERT INTO `_bench_lead` (name, mobile_no) VALUES " + ", ".join(["(%s, %s)"] * len(lead_rows)),
+				[v for row in lead_rows for v in row]
+			)
+			frappe.db.sql(
+				"INSERT INTO `_bench_lead_phone_key` (name, phone_key, lead) VALUES " + ", ".join(["(%s, %s, %s)"] * len(key_rows)),
+				[v for row in key_rows for v in row]
+			)
+			frappe.db.commit()
+
+		sample = sample[:probes] or [_random_mobile(rng)]
+		numbers = iter(sample * 2)
+
+		def like_scan():
+			clean = next(numbers).replace("+", "").replace("-", "").replace(" ", "")
+			frappe.db.sql("""
+				SELECT name FROM `_bench_lead` WHERE mobile_no LIKE %s LIMIT 1
+			""", (f"%{clean[-10:]}%",))
+
+		def indexed_probe():
+			keys = [key for key, key_type in get_phone_lookup_keys(next(numbers))]
+			frappe.db.sql("""
+				SELECT lead FROM `_bench_lead_phone_key` WHERE phone_key IN %s LIMIT 1
+			""", (keys,))
+
+		result = {
+			"leads": leads,
+			"probes": len(sample),
+			"like_scan": _summary(_timed(like_scan, len(sample))),
+			"indexed_probe": _summary(_timed(indexed_probe, len(sample)))
+		}
+		result["speedup"] = round(result["like_scan"]["mean_ms"] / max(result["indexed_probe"]["mean_ms"], 0.001), 1)
+
+		return result
+
+	finally:
+		frappe.db.sql_ddl("DROP TABLE IF EXISTS `_bench_lead`")
+		frappe.db.sql_ddl("DROP TABLE IF EXISTS `_bench_lead_phone_key`")
+
+
+def benchmark_make_call_transport(url=None, calls=50, requests_per_call=4):
+	"""
+	Compare fresh connections with the pooled transport for make_call's HTTP legs
+
+	make_call makes four sequential requests: Janus create session, attach,
+	create room, then the Graph call. Each simulated call sends
+	`requests_per_call` sequential GETs to `url` (the configured Janus
+	/info endpoint by default), first opening a new connection for every
+	request as bare `requests.get` does, then through the keep-alive pool.
+	Point `url` at an HTTPS endpoint to include the TLS handshake.
+	"""
+	url = url or f"{get_settings().janus_http_url}/info"
+
+	def fresh_connections():
+		for _ in range(requests_per_call):
+			requests.get(url, timeout=10).raise_for_status()
+
+	def pooled():
+		session = get_session("benchmark")
+		for _ in range(requests_per_call):
+			session.get(url).raise_for_status()
+
+	try:
+		# Open the pool outside the measurement, as a warm worker would have
+		pooled()
+
+		result = {
+			"url": url,
+			"calls": calls,
+			"requests_per_call": requests_per_call,
+			"fresh_connections": _summary(_timed(fresh_connections, calls)),
+			"pooled": _summary(_timed(pooled, calls))
+		}
+		result["speedup"] = round(result["fresh_connections"]["mean_ms"] / max(result["pooled"]["mean_ms"], 0.001), 1)
+
+		return result
+
+	finally:
+		close_sessions()
+
+
+def benchmark_bulk_permission_check(numbers=100000, business_number="BENCH-WA-1", seed=42):
+	"""
+	Compare per-number permission checks with the bulk eligibility check
+
+	Builds `numbers` synthetic Call Permission rows for one business number
+	in a scratch table with the (customer_number, business_number) index,
+	in a mix of states (granted, expired, at the 24h limit, requested,
+	denied), then checks every number (plus 5% without a row) one query
+	at a time, as check_call_permission does, and in bulk.
+	"""
+	rng = random.Random(seed)
+	now = datetime.now()
+	table = "_bench_call_permission"
+
+	frappe.db.sql_ddl(f"DROP TABLE IF EXISTS `{table}`")
+	frappe.db.sql_ddl(f"""
+		CREATE TABLE `{table}` (
+			name VARCHAR(140) PRIMARY KEY,
+			customer_number VARCHAR(140),
+			business_number VARCHAR(140),
+			permission_status VARCHAR(140),
+			expires_at DATETIME(6),
+			calls_in_24h INT,
+			last_call_at DATETIME(6),
+			recent_calls TEXT,
+			KEY customer_number_business_number (customer_number, business_number)
+		) ENGINE=InnoDB
+	""")
+
+	try:
+		customers = []
+		for offset in range(0, numbers, INSERT_CHUNK_SIZE):
+			rows = []
+			for i in range(offset, min(offset + INSERT_CHUNK_SIZE, numbers)):
+				customer = f"+91{rng.randint(6000000000, 9999999999)}"
+				status = rng.choices(["Granted", "Requested", "Denied", "Expired"], weights=[70, 15, 5, 10])[0]
+				expires_at = now + timedelta(hours=rng.randint(-48, 168))
+				calls = sorted(now.timestamp() - rng.randint(0, 72 * 3600) for _ in range(rng.randint(0, 5)))
+				last_call_at = datetime.fromtimestamp(calls[-1]) if calls else None
+				rows.append((f"PERM-{i:08d}", customer, business_number, status, expires_at, len(calls), last_call_at, json.dumps(calls) if calls else None))
+				customers.append(customer)
+
+			frappe.db.sql(
+				f"INSERT INTO `{table}` (name, customer_number, business_number, permission_status, expires_at, calls_in_24h, last_call_at, recent_calls) VALUES "
+				+ ", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s)"] * len(rows)),
+				[v for row in rows for v in row]
+			)
+			frappe.db.commit()
+
+		# Some numbers have never been asked
+		customers += [f"+1{rng.randint(2000000000, 9999999999)}" for _ in range(numbers // 20)]
+		customers = list(dict.fromkeys(customers))
+
+		def per_number():
+			rows = []
+			for customer in customers:
+				rows += frappe.db.sql(f"""
+					SELECT customer_number, permission_status, expires_at, calls_in_24h, last_call_at, recent_calls
+					FROM `{table}`
+					WHERE customer_number = %s AND business_number = %s
+				""", (customer, business_number), as_dict=True)
+			return evaluate_permissions(customers, rows, now)
+
+		def bulk():
+			rows = []
+			for start in range(0, len(customers), BULK_CHUNK_SIZE):
+				rows += get_permission_rows(customers[start:start + BULK_CHUNK_SIZE], business_number, table=table)
+			return evaluate_permissions(customers, rows, now)
+
+		start = time.perf_counter()
+		per_number_result = per_number()
+		per_number_ms = (time.perf_counter() - start) * 1000
+
+		start = time.perf_counter()
+		bulk_result = bulk()
+		bulk_ms = (time.perf_counter() - start) * 1000
+
+		result = {
+			"numbers": len(customers),
+			"callable": sum(1 for verdict in bulk_result.values() if verdict["can_call"]),
+			"same_verdicts": per_number_result == bulk_result,
+			"per_number_ms": round(per_number_ms, 1),
+			"bulk_ms": round(bulk_ms, 1),
+			"speedup": round(per_number_ms / max(bulk_ms, 0.001), 1)
+		}
+
+		return result
+
+	finally:
+		frappe.db.sql_ddl(f"DROP TABLE IF EXISTS `{table}`")
@@ -3,7 +3,9 @@
 
 import frappe
 from frappe.model.document import Document
-from datetime import datetime, timedelta
+from datetime import datetime
+from whatsapp_calling.whatsapp_calling.api.permissions import get_call_seed
+from whatsapp_calling.whatsapp_calling.utils.rate_limiter import call_limiter, get_subject
 
 
 class CallPermission(Document):
@@ -35,26 +37,21 @@ class CallPermission(Document):
 			if expires < datetime.now():
 				return False, "Permission expired"
 
-		# Check 24h call limit
-		if self.last_call_at:
-			last_call = frappe.utils.get_datetime(self.last_call_at)
-			hours_since = (datetime.now() - last_call).total_seconds() / 3600
-
-			# Reset counter if 24h passed
-			if hours_since >= 24:
-				self.calls_in_24h = 0
-				self.save(ignore_permissions=True)
-			elif self.calls_in_24h >= 5:
-				return False, "Daily call limit (5) reached"
+		# Check 24h call limit, on the window as it is now (read-only)
+		usage = call_limiter.peek(
+			get_subject(self.business_number, self.customer_number),
+			get_call_seed(self)
+		)
+		if not usage["allowed"]:
+			return False, "Daily call limit (5) reached"
 
 		return True, "OK"
 
-	def reset_daily_counters(self):
-		"""Reset 24h counters (called by scheduled task)"""
-		if self.last_call_at:
-			last_call = frappe.utils.get_datetime(self.last_call_at)
-			hours_since = (datetime.now() - last_call).total_seconds() / 3600
 
-			if hours_since >= 24:
-				self.calls_in_24h = 0
-				self.save(ignore_permissions=True)
+def on_doctype_update():
+	"""
+	Permission checks look up (customer, business number) pairs, one or many
+	at a time; the daily expiry job scans by status and expiry
+	"""
+	frappe.db.add_index("Call Permission", ["customer_number", "business_number"])
+	frappe.db.add_index("Call Permission", ["permission_status", "expires_at"])
@@ -0,0 +1,24 @@
+// Copyright (c) 2024, Your Company and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Janus Node', {
+	refresh: function(frm) {
+		if (frm.doc.status === 'Draining') {
+			frm.dashboard.set_headline_alert('Draining: no new calls are placed on this node', 'orange');
+		}
+
+		if (!frm.is_new()) {
+			frm.add_custom_button(__('Check Health'), function() {
+				frappe.call({
+					method: 'check_health',
+					doc: frm.doc,
+					callback: function(r) {
+						if (!r.exc) {
+							frm.reload_doc();
+						}
+					}
+				});
+			});
+		}
+	}
+});
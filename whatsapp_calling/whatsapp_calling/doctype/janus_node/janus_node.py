@@ -0,0 +1,40 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe import _
+from frappe.model.document import Document
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import bump_settings_version, is_config_change
+
+# Written by the health poller; not configuration
+HEALTH_FIELDS = ("is_healthy", "last_health_check", "health_error")
+
+
+class JanusNode(Document):
+	def validate(self):
+		self.http_url = (self.http_url or "").rstrip("/")
+		self.ws_url = (self.ws_url or "").rstrip("/")
+		self.admin_url = (self.admin_url or "").rstrip("/")
+
+		if self.weight is not None and self.weight <= 0:
+			frappe.throw(_("Weight must be greater than 0"))
+
+		if self.max_rooms and self.max_rooms < 0:
+			frappe.throw(_("Max Rooms cannot be negative"))
+
+		self.flags.config_changed = is_config_change(self, ignore=HEALTH_FIELDS)
+
+	def on_update(self):
+		"""Workers keep the node list in their settings snapshot"""
+		if self.flags.config_changed:
+			bump_settings_version()
+
+	def on_trash(self):
+		bump_settings_version()
+
+	@frappe.whitelist()
+	def check_health(self):
+		"""Poll this node's /info now and return the result"""
+		from whatsapp_calling.whatsapp_calling.utils.janus_nodes import check_node
+
+		return check_node(self.name)
@@ -0,0 +1,41 @@
+// Copyright (c) 2024, Your Company and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Permission Request Campaign', {
+	refresh: function(frm) {
+		if (frm.is_new()) {
+			return;
+		}
+
+		if (frm.doc.total_leads) {
+			const percent = Math.min(100, Math.round((frm.doc.processed_leads || 0) * 100 / frm.doc.total_leads));
+			frm.dashboard.add_progress(__('Progress'), percent, __('{0} of {1} leads', [frm.doc.processed_leads || 0, frm.doc.total_leads]));
+		}
+
+		if (frm.doc.status === 'Failed') {
+			frm.dashboard.set_headline_alert('Campaign Failed: resume to continue from the checkpoint', 'red');
+		}
+
+		const actions = {
+			'Draft': [['Start', 'start']],
+			'Queued': [['Pause', 'pause']],
+			'Running': [['Pause', 'pause'], ['Resume', 'resume']],
+			'Paused': [['Resume', 'resume']],
+			'Failed': [['Resume', 'resume']]
+		};
+
+		(actions[frm.doc.status] || []).forEach(function([label, method]) {
+			frm.add_custom_button(__(label), function() {
+				frappe.call({
+					method: method,
+					doc: frm.doc,
+					callback: function(r) {
+						if (!r.exc) {
+							frm.reload_doc();
+						}
+					}
+				});
+			});
+		});
+	}
+});
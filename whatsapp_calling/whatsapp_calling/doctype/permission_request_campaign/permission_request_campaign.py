@@ -0,0 +1,50 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+import frappe
+import json
+from frappe import _
+from frappe.model.document import Document
+from whatsapp_calling.whatsapp_calling.utils.permission_campaign import enqueue_campaign
+
+
+class PermissionRequestCampaign(Document):
+	def validate(self):
+		if self.lead_filters:
+			try:
+				filters = json.loads(self.lead_filters)
+			except ValueError:
+				frappe.throw(_("Lead Filters must be valid JSON"))
+
+			if not isinstance(filters, (dict, list)):
+				frappe.throw(_("Lead Filters must be a JSON object or list of filters"))
+
+		number_company = frappe.db.get_value("WhatsApp Number", self.business_number, "company")
+		if number_company and number_company != self.company:
+			frappe.throw(_("WhatsApp Number {0} belongs to {1}").format(self.business_number, number_company))
+
+	@frappe.whitelist()
+	def start(self):
+		"""Queue the campaign's background job"""
+		if self.status != "Draft":
+			frappe.throw(_("Only draft campaigns can be started"))
+
+		self.db_set("status", "Queued")
+		enqueue_campaign(self.name)
+
+	@frappe.whitelist()
+	def pause(self):
+		"""Stop after the current batch; progress is kept"""
+		if self.status not in ("Queued", "Running"):
+			frappe.throw(_("Only queued or running campaigns can be paused"))
+
+		self.db_set("status", "Paused")
+
+	@frappe.whitelist()
+	def resume(self):
+		"""Continue from the checkpoint (also restarts a job that died while Running)"""
+		if self.status not in ("Paused", "Failed", "Running"):
+			frappe.throw(_("Only paused, failed or running campaigns can be resumed"))
+
+		self.db_set("status", "Queued")
+		enqueue_campaign(self.name)
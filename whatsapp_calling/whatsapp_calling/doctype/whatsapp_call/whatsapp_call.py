@@ -43,28 +43,13 @@ class WhatsAppCall(Document):
 	def on_update(self):
 		"""Update related records on status change"""
 		if self.has_value_changed('status'):
-			# Update call permission usage
-			if self.status == 'Answered':
-				self.update_call_permission_usage()
+			# Call permission usage is counted when the call is dialled
+			# (utils/rate_limiter via check_call_permission)
 
 			# Update WhatsApp Number last_used
 			if self.business_number:
 				self.update_business_number_usage()
 
-	def update_call_permission_usage(self):
-		"""Increment call counter in permission record"""
-		try:
-			permission = frappe.get_doc("Call Permission", {
-				"customer_number": self.customer_number,
-				"business_number": self.business_number
-			})
-
-			permission.calls_in_24h = (permission.calls_in_24h or 0) + 1
-			permission.last_call_at = frappe.utils.now()
-			permission.save(ignore_permissions=True)
-		except Exception as e:
-			frappe.log_error(f"Failed to update call permission: {str(e)}")
-
 	def update_business_number_usage(self):
 		"""Update last_used timestamp and monthly usage"""
 		try:
@@ -79,3 +64,12 @@ class WhatsAppCall(Document):
 			wa_number.save(ignore_permissions=True)
 		except Exception as e:
 			frappe.log_error(f"Failed to update business number: {str(e)}")
+
+
+def on_doctype_update():
+	"""
+	Room reconciliation looks calls up by node and room; number selection
+	counts each number's calls of the day
+	"""
+	frappe.db.add_index("WhatsApp Call", ["janus_node", "janus_room_id"])
+	frappe.db.add_index("WhatsApp Call", ["business_number", "initiated_at"])
@@ -0,0 +1,14 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class WhatsAppCallEvent(Document):
+	pass
+
+
+def on_doctype_update():
+	"""History of one call is always read in Meta timestamp order"""
+	frappe.db.add_index("WhatsApp Call Event", ["call_id", "event_timestamp"])
@@ -4,6 +4,13 @@
 import frappe
 from frappe.model.document import Document
 import re
+from whatsapp_calling.whatsapp_calling.api.agent_rooms import clear_all_rooms
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import (
+	NUMBER_USAGE_FIELDS,
+	bump_settings_version,
+	get_number,
+	is_config_change
+)
 
 
 class WhatsAppNumber(Document):
@@ -11,6 +18,7 @@ class WhatsAppNumber(Document):
 		"""Validate phone number format and extract country code"""
 		self.validate_phone_number()
 		self.extract_country_code()
+		self.flags.config_changed = is_config_change(self, ignore=NUMBER_USAGE_FIELDS)
 
 	def validate_phone_number(self):
 		"""Ensure phone number is in E.164 format"""
@@ -43,11 +51,22 @@ class WhatsAppNumber(Document):
 			self.country_code = f"+{match.group(1)}"
 
 	def on_update(self):
-		"""Update last_used when number is modified"""
-		pass
+		"""Agents' call rooms depend on the number's company and status"""
+		clear_all_rooms()
+
+		# Usage counters change on every call; only configuration reloads snapshots
+		if self.flags.config_changed:
+			bump_settings_version()
+
+	def on_trash(self):
+		clear_all_rooms()
+		bump_settings_version()
 
 	def get_access_token(self):
 		"""Get access token for this number or fall back to default"""
+		if not self.is_new():
+			return get_number(self.name).access_token
+
 		if self.access_token:
 			return self.get_password('access_token')
 		else:
@@ -3,6 +3,7 @@
 
 import frappe
 from frappe.model.document import Document
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import bump_settings_version
 
 
 class WhatsAppSettings(Document):
@@ -16,6 +17,10 @@ class WhatsAppSettings(Document):
 		if self.janus_http_url:
 			self.test_janus_connection()
 
+	def on_update(self):
+		"""Make every worker reload its settings snapshot"""
+		bump_settings_version()
+
 	@frappe.whitelist()
 	def test_janus_connection(self):
 		"""Test if Janus is accessible"""
@@ -0,0 +1,27 @@
+// Copyright (c) 2024, Your Company and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('WhatsApp Webhook Log', {
+	refresh: function(frm) {
+		if (frm.doc.status === 'Failed') {
+			frm.dashboard.set_headline_alert('Processing Failed', 'red');
+		} else if (frm.doc.status === 'Queued') {
+			frm.dashboard.set_headline_alert('Waiting for Worker', 'orange');
+		}
+
+		// Allow replaying a payload that failed or got stuck
+		if (!frm.is_new() && frm.doc.status !== 'Processed') {
+			frm.add_custom_button(__('Reprocess'), function() {
+				frappe.call({
+					method: 'reprocess',
+					doc: frm.doc,
+					callback: function(r) {
+						if (!r.exc) {
+							frm.reload_doc();
+						}
+					}
+				});
+			});
+		}
+	}
+});
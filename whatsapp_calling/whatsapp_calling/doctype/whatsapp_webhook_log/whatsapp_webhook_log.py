@@ -0,0 +1,15 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+
+class WhatsAppWebhookLog(Document):
+	@frappe.whitelist()
+	def reprocess(self):
+		"""Push the stored payload through the background queue again"""
+		from whatsapp_calling.whatsapp_calling.utils.webhook_queue import requeue_log
+
+		requeue_log(self.name)
+		frappe.msgprint("Webhook re-queued for processing")
@@ -4,6 +4,11 @@
 import frappe
 from datetime import datetime, timedelta
 import os
+import time
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_settings
+
+# Rows per UPDATE (and commit) in the maintenance jobs
+CHUNK_SIZE = 5000
 
 
 def cleanup_old_recordings():
@@ -12,7 +17,7 @@ def cleanup_old_recordings():
 	Runs hourly
 	"""
 	try:
-		settings = frappe.get_single("WhatsApp Settings")
+		settings = get_settings()
 
 		if not settings.enable_call_recording or settings.retention_days == 0:
 			return  # No cleanup needed
@@ -64,129 +69,97 @@ def check_expired_permissions():
 	Runs daily
 	"""
 	try:
-		# Find granted permissions that have expired
-		expired_permissions = frappe.get_all(
+		started = time.monotonic()
+		now = frappe.utils.now()
+
+		expired = update_in_chunks(
 			"Call Permission",
-			filters={
-				"permission_status": "Granted",
-				"expires_at": ["<", frappe.utils.now()]
-			},
-			pluck="name"
+			lambda permission: (permission.permission_status == "Granted") & (permission.expires_at < now),
+			{"permission_status": "Expired", "modified": now}
 		)
 
-		for permission_name in expired_permissions:
-			permission = frappe.get_doc("Call Permission", permission_name)
-			permission.permission_status = "Expired"
-			permission.save(ignore_permissions=True)
-
-		if expired_permissions:
-			frappe.db.commit()
-			frappe.logger().info(f"Marked {len(expired_permissions)} permissions as expired")
+		log_task_run("Marked expired permissions", expired, started)
 
 	except Exception as e:
 		frappe.log_error(message=str(e), title="Check Expired Permissions Error")
 
 
-def reset_daily_counters():
+def update_monthly_usage():
 	"""
-	Scheduled task: Reset daily call counters
-	Runs daily at midnight
+	Scheduled task: Reset monthly usage counters
+	Runs monthly (on the 1st)
 	"""
 	try:
-		# Reset calls_in_24h for permissions where last_call_at is more than 24h ago
-		cutoff_time = frappe.utils.add_hours(frappe.utils.now(), -24)
+		started = time.monotonic()
 
-		permissions = frappe.get_all(
-			"Call Permission",
-			filters={
-				"last_call_at": ["<", cutoff_time],
-				"calls_in_24h": [">", 0]
-			},
-			pluck="name"
+		reset = update_in_chunks(
+			"WhatsApp Number",
+			lambda number: number.current_month_usage != 0,
+			{"current_month_usage": 0}
 		)
 
-		for permission_name in permissions:
-			frappe.db.set_value("Call Permission", permission_name, "calls_in_24h", 0)
-
-		if permissions:
-			frappe.db.commit()
-			frappe.logger().info(f"Reset daily counters for {len(permissions)} permissions")
+		log_task_run("Reset monthly usage", reset, started)
 
 	except Exception as e:
-		frappe.log_error(message=str(e), title="Reset Daily Counters Error")
+		frappe.log_error(message=str(e), title="Update Monthly Usage Error")
 
 
-def update_monthly_usage():
-	"""
-	Scheduled task: Reset monthly usage counters on 1st of each month
-	Runs daily (checks if it's the 1st)
+def update_in_chunks(doctype, condition, values):
 	"""
-	try:
-		from datetime import date
+	Set `values` on every row matching `condition`, CHUNK_SIZE rows per
+	UPDATE and commit, so no long transaction or lock is held
 
-		today = date.today()
+	Args:
+		doctype: DocType to update
+		condition: function of the query builder table, returning the criterion;
+			`values` must make a row stop matching it
+		values: dict of field -> new value
 
-		# Only run on 1st of the month
-		if today.day != 1:
-			return
+	Returns:
+		int: rows updated
+	"""
+	table = frappe.qb.DocType(doctype)
+	updated = 0
 
-		# Reset current_month_usage for all WhatsApp Numbers
-		wa_numbers = frappe.get_all("WhatsApp Number", pluck="name")
+	while True:
+		names = frappe.qb.from_(table).select(table.name).where(condition(table)).limit(CHUNK_SIZE).run(pluck=True)
+		if not names:
+			break
 
-		for wa_number in wa_numbers:
-			frappe.db.set_value("WhatsApp Number", wa_number, "current_month_usage", 0)
+		query = frappe.qb.update(table).where(table.name.isin(names))
+		for field, value in values.items():
+			query = query.set(table.field(field), value)
+		query.run()
 
 		frappe.db.commit()
-		frappe.logger().info("Reset monthly usage for all WhatsApp numbers")
+		updated += len(names)
 
-	except Exception as e:
-		frappe.log_error(message=str(e), title="Update Monthly Usage Error")
+		if len(names) < CHUNK_SIZE:
+			break
+
+	return updated
+
+
+def log_task_run(action, rows, started):
+	if rows:
+		frappe.logger().info(f"{action}: {rows} rows in {round((time.monotonic() - started) * 1000)} ms")
 
 
 def cleanup_stale_janus_rooms():
 	"""
-	Scheduled task: Cleanup Janus rooms that are stuck in limbo
-	Runs hourly
+	Scheduled task: Destroy leaked Janus rooms and clear stale room references
+	Runs hourly; see utils/room_reconciler
 	"""
 	try:
-		from whatsapp_calling.whatsapp_calling.api.janus_client import JanusClient
-
-		# Find calls that ended more than 1 hour ago but still have Janus room
-		cutoff_time = frappe.utils.add_hours(frappe.utils.now(), -1)
-
-		stale_calls = frappe.get_all(
-			"WhatsApp Call",
-			filters={
-				"status": "Ended",
-				"ended_at": ["<", cutoff_time],
-				"janus_room_id": ["is", "set"]
-			},
-			fields=["name", "janus_session_id", "janus_room_id"]
-		)
+		from whatsapp_calling.whatsapp_calling.utils.room_reconciler import reconcile_janus_rooms
 
-		janus = JanusClient()
-		cleaned_count = 0
+		report = reconcile_janus_rooms()
 
-		for call in stale_calls:
-			try:
-				# Try to destroy the Janus room
-				janus.destroy_room(call.janus_session_id, call.janus_room_id)
-
-				# Clear Janus room info from call
-				frappe.db.set_value("WhatsApp Call", call.name, {
-					"janus_room_id": None,
-					"janus_session_id": None
-				})
-
-				cleaned_count += 1
-
-			except Exception as e:
-				# Log but continue with other rooms
-				frappe.log_error(f"Failed to cleanup Janus room for {call.name}: {str(e)}")
-
-		if cleaned_count > 0:
-			frappe.db.commit()
-			frappe.logger().info(f"Cleaned up {cleaned_count} stale Janus rooms")
+		if report:
+			destroyed = sum(counts["destroyed"] for counts in report.values())
+			cleared = sum(counts["cleared_refs"] for counts in report.values())
+			if destroyed or cleared:
+				frappe.logger().info(f"Destroyed {destroyed} leaked Janus rooms, cleared {cleared} stale room references")
 
 	except Exception as e:
 		frappe.log_error(message=str(e), title="Cleanup Stale Janus Rooms Error")
@@ -0,0 +1,150 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Append-only call event log and the projection of WhatsApp Call state
+
+Webhook call events are stored as-is in WhatsApp Call Event. The state of a
+WhatsApp Call (status, answered_at, ended_at and from those duration and
+cost) is derived from the full history ordered by Meta's timestamp, so an
+`ended` that arrives before its `answered` still produces the right result.
+"""
+
+import frappe
+from datetime import datetime
+from frappe.utils import cint
+
+# Meta call status -> WhatsApp Call status
+STATUS_MAP = {
+	"ringing": "Ringing",
+	"answered": "Answered",
+	"ended": "Ended",
+	"failed": "Failed",
+	"rejected": "Declined",
+	"missed": "No Answer"
+}
+
+# Status can only move forward; all final states share the top rank
+STATUS_RANK = {
+	"Initiated": 0,
+	"Ringing": 1,
+	"Answered": 2,
+	"Ended": 3,
+	"Failed": 3,
+	"No Answer": 3,
+	"Declined": 3
+}
+FINAL_RANK = 3
+
+EVENT_FIELDS = [
+	"name", "creation", "modified", "owner", "modified_by",
+	"call_id", "status", "event_timestamp", "received_at"
+]
+
+
+def record_call_events(events):
+	"""
+	Append call events to the log with a single multi-row INSERT
+
+	Args:
+		events: extracted call events (see webhook.extract_events)
+	"""
+	now = frappe.utils.now()
+	user = frappe.session.user
+
+	values = []
+	for event in events:
+		data = event["data"]
+		values.append((
+			frappe.generate_hash(length=12), now, now, user, user,
+			data.get("id"),
+			(data.get("status") or "").lower(),
+			get_event_time(data) or now,
+			now
+		))
+
+	frappe.db.bulk_insert("WhatsApp Call Event", fields=EVENT_FIELDS, values=values)
+
+
+def get_event_time(call_data):
+	"""Convert Meta's unix timestamp to a system-timezone datetime"""
+	timestamp = cint(call_data.get("timestamp"))
+	if not timestamp:
+		return None
+
+	utc = datetime.utcfromtimestamp(timestamp)
+	return frappe.utils.convert_utc_to_system_timezone(utc).replace(tzinfo=None)
+
+
+def load_call_histories(call_ids):
+	"""
+	Fetch the event history of many calls in one query
+
+	Returns:
+		dict of call_id -> list of events in Meta timestamp order
+	"""
+	if not call_ids:
+		return {}
+
+	rows = frappe.get_all(
+		"WhatsApp Call Event",
+		filters={"call_id": ["in", list(call_ids)]},
+		fields=["call_id", "status", "event_timestamp", "received_at"],
+		order_by="event_timestamp asc, received_at asc"
+	)
+
+	histories = {}
+	for row in rows:
+		histories.setdefault(row.call_id, []).append(row)
+	return histories
+
+
+def derive_call_state(history):
+	"""
+	Fold an ordered event history into call state
+
+	Returns:
+		dict with status, answered_at and ended_at (None where unknown)
+	"""
+	state = {"status": None, "answered_at": None, "ended_at": None}
+	rank = -1
+
+	for event in history:
+		status = STATUS_MAP.get(event.status)
+		if not status:
+			continue
+
+		if status == "Answered" and not state["answered_at"]:
+			state["answered_at"] = event.event_timestamp
+
+		if STATUS_RANK[status] == FINAL_RANK and not state["ended_at"]:
+			state["ended_at"] = event.event_timestamp
+
+		# Monotonic: a late or duplicate event never moves the call back
+		if STATUS_RANK[status] > rank:
+			state["status"] = status
+			rank = STATUS_RANK[status]
+
+	return state
+
+
+def project_call(call_doc, history):
+	"""
+	Apply the state derived from history to a WhatsApp Call document
+
+	Status is only moved forward, so updates made elsewhere (e.g. an agent
+	answering from the widget) are never rolled back by the projection, and
+	a final status (e.g. Ended) is never replaced by another one.
+	"""
+	state = derive_call_state(history)
+
+	status = state["status"]
+	if status and STATUS_RANK[status] > STATUS_RANK.get(call_doc.status, -1):
+		call_doc.status = status
+
+	# Meta's timestamps are authoritative for timing
+	for field in ("answered_at", "ended_at"):
+		if state[field]:
+			call_doc.set(field, state[field])
+
+	return call_doc
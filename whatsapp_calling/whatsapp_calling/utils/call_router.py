@@ -0,0 +1,183 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Automatic call distribution for inbound calls
+
+Instead of ringing every agent, the router rings a few available agents at a
+time (a wave), picked by the configured strategy, and moves on to the next
+wave if nobody answers in time. The first agent to claim the call wins;
+everyone else gets a `whatsapp_call_claimed` event that closes their popup.
+
+Each wave is a short background job that schedules the next one Ring Wave
+Timeout seconds later (RQ's scheduler, which Frappe's workers run), so no
+worker sits waiting for an answer while webhooks queue up behind it.
+"""
+
+import frappe
+from datetime import timedelta
+from frappe.utils import cint
+from frappe.utils.background_jobs import execute_job, get_queue
+from whatsapp_calling.whatsapp_calling.api.agent_rooms import get_user_numbers, publish_to_number
+from whatsapp_calling.whatsapp_calling.api.presence import AVAILABLE, get_online_agents
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_settings
+
+CLAIM_KEY = "whatsapp_call_claim:{0}"
+CLAIM_TTL = 6 * 60 * 60
+
+RING_ALL = "Ring All"
+LONGEST_IDLE = "Longest Idle"
+LEAST_RECENT_CALL = "Least Recent Call"
+
+DEFAULT_WAVE_SIZE = 3
+DEFAULT_WAVE_TIMEOUT = 15  # seconds
+MAX_WAVES = 5
+
+RING_WAVE_METHOD = "whatsapp_calling.whatsapp_calling.utils.call_router.ring_wave"
+RING_WAVE_TIMEOUT = 60  # job timeout, seconds
+
+
+def route_call(call_doc, message):
+	"""
+	Ring agents for an inbound call according to WhatsApp Settings
+
+	Args:
+		call_doc: WhatsApp Call being rung
+		message: realtime payload for the incoming call popup
+	"""
+	settings = get_settings()
+	strategy = settings.call_routing or RING_ALL
+
+	if strategy == RING_ALL:
+		publish_to_number("incoming_whatsapp_call", message, call_doc.business_number)
+		return
+
+	frappe.enqueue(
+		RING_WAVE_METHOD,
+		queue="short",
+		timeout=RING_WAVE_TIMEOUT,
+		enqueue_after_commit=True,
+		call_id=call_doc.call_id,
+		business_number=call_doc.business_number,
+		message=message,
+		strategy=strategy,
+		wave_size=cint(settings.ring_wave_size) or DEFAULT_WAVE_SIZE,
+		wave_timeout=cint(settings.ring_wave_timeout) or DEFAULT_WAVE_TIMEOUT
+	)
+
+
+def pick_agents(business_number, strategy, exclude=()):
+	"""
+	Available agents for a number, best candidate first
+
+	Longest Idle prefers whoever has been available the longest; Least
+	Recent Call prefers whoever finished their last call the longest ago.
+	"""
+	candidates = [
+		(user, state) for user, state in get_online_agents().items()
+		if state["status"] == AVAILABLE
+		and user not in exclude
+		and business_number in get_user_numbers(user)
+	]
+
+	if strategy == LEAST_RECENT_CALL:
+		candidates.sort(key=lambda c: c[1]["last_call_at"] or 0)
+	else:
+		candidates.sort(key=lambda c: c[1]["idle_since"] or 0)
+
+	return [user for user, state in candidates]
+
+
+def ring_wave(call_id, business_number, message, strategy, wave_size, wave_timeout, wave=0, rung=None):
+	"""
+	Background job: ring one wave of agents, then schedule the next wave
+
+	Falls back to ringing every agent of the number when no available agent
+	is left (or after MAX_WAVES), so a call is never silently dropped by
+	the router.
+
+	Args:
+		wave: waves rung so far
+		rung: agents rung so far
+	"""
+	rung = rung or []
+
+	if get_claim(call_id) or not is_still_ringing(call_id):
+		return
+
+	agents = pick_agents(business_number, strategy, exclude=rung)[:wave_size] if wave < MAX_WAVES else []
+	if not agents:
+		publish_to_number("incoming_whatsapp_call", message, business_number)
+		return
+
+	for user in agents:
+		frappe.publish_realtime("incoming_whatsapp_call", dict(message, wave=wave + 1), user=user)
+
+	schedule_wave(wave_timeout, {
+		"call_id": call_id,
+		"business_number": business_number,
+		"message": message,
+		"strategy": strategy,
+		"wave_size": wave_size,
+		"wave_timeout": wave_timeout,
+		"wave": wave + 1,
+		"rung": rung + agents
+	})
+
+
+def schedule_wave(delay, kwargs):
+	"""Enqueue ring_wave to run `delay` seconds from now, as frappe.enqueue would"""
+	get_queue("short").enqueue_in(
+		timedelta(seconds=delay),
+		execute_job,
+		job_timeout=RING_WAVE_TIMEOUT,
+		site=frappe.local.site,
+		user=frappe.session.user,
+		method=RING_WAVE_METHOD,
+		event=None,
+		job_name=RING_WAVE_METHOD,
+		is_async=True,
+		kwargs=kwargs
+	)
+
+
+def is_still_ringing(call_id):
+	# Read committed data, not a snapshot from before the caller hung up
+	frappe.db.rollback()
+	return frappe.db.get_value("WhatsApp Call", {"call_id": call_id}, "status") == "Ringing"
+
+
+def claim_call(call_id, user):
+	"""
+	Atomically make `user` the agent answering `call_id`
+
+	Returns:
+		True if the user holds the claim (also when they already held it)
+	"""
+	cache = frappe.cache()
+	key = cache.make_key(CLAIM_KEY.format(call_id))
+
+	if cache.set(key, user, nx=True, ex=CLAIM_TTL):
+		# Close the popup for everyone else who is being rung
+		publish_to_number("whatsapp_call_claimed", {"call_id": call_id, "user": user}, get_business_number(call_id))
+		return True
+
+	return frappe.safe_decode(cache.get(key)) == user
+
+
+def release_claim(call_id, user):
+	"""Give up a claim, e.g. when answering failed half-way"""
+	cache = frappe.cache()
+	key = cache.make_key(CLAIM_KEY.format(call_id))
+	if frappe.safe_decode(cache.get(key)) == user:
+		cache.delete(key)
+
+
+def get_claim(call_id):
+	"""User currently holding the claim on a call, if any"""
+	cache = frappe.cache()
+	return frappe.safe_decode(cache.get(cache.make_key(CLAIM_KEY.format(call_id))))
+
+
+def get_business_number(call_id):
+	return frappe.db.get_value("WhatsApp Call", {"call_id": call_id}, "business_number")
@@ -0,0 +1,154 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Outbound call setup with overlapping legs
+
+Allocating the Janus room and asking Graph to dial the customer do not
+depend on each other, so make_call runs them at the same time: the dial,
+a plain HTTPS request, goes to a helper thread, while the request thread,
+which has the site context, takes a room. Both legs share one deadline
+(`whatsapp_call_setup_deadline` in site_config.json, default 8 seconds).
+
+If either leg fails, or the call record cannot be saved, whatever the
+other leg set up is undone: the room is released and a placed call is
+hung up.
+
+Each stage is timed (milliseconds) and logged to the whatsapp_calling
+logger, so click-to-ring latency can be broken down.
+"""
+
+import frappe
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from frappe import _
+from frappe.utils import flt
+from whatsapp_calling.whatsapp_calling.utils.http import get_timeout
+from whatsapp_calling.whatsapp_calling.utils.room_pool import acquire_room, release_room
+
+DEFAULT_DEADLINE = 8  # seconds
+DIAL_WORKERS = 4
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+class StageTimer:
+	"""Milliseconds spent in each stage of a call setup"""
+
+	def __init__(self):
+		self.started = time.perf_counter()
+		self.timings = {}
+
+	@contextmanager
+	def stage(self, name):
+		"""Time a block; safe to use from the dial thread too"""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.timings[name] = elapsed_ms(start)
+
+	def log(self, call_id, outcome="ok"):
+		self.timings["total"] = elapsed_ms(self.started)
+		frappe.logger("whatsapp_calling").info(f"make_call {call_id or '-'} {outcome} timings (ms): {self.timings}")
+
+
+def get_deadline():
+	"""Monotonic time by which the call must be set up"""
+	return time.monotonic() + (flt(frappe.conf.get("whatsapp_call_setup_deadline")) or DEFAULT_DEADLINE)
+
+
+def setup_outbound_call(wa_api, mobile_number, deadline, timer):
+	"""
+	Take a Janus room and dial the customer concurrently
+
+	Args:
+		wa_api: WhatsAppAPI of the business number
+		mobile_number: customer's number
+		deadline: from get_deadline()
+		timer: StageTimer; gets "janus" and "dial"
+
+	Returns:
+		tuple of (room_config, call_response)
+	"""
+	left = remaining(deadline)
+	connect_timeout = get_timeout()[0]
+	dial = get_executor().submit(
+		dial_customer, wa_api, mobile_number, (min(connect_timeout, left), left), timer
+	)
+
+	room_config = None
+	try:
+		with timer.stage("janus"):
+			room_config = acquire_room()
+
+		call_response = dial.result(timeout=remaining(deadline))
+
+	except FutureTimeout:
+		undo_outbound_call(wa_api, room_config, dial=dial)
+		raise Exception(_("Call setup did not finish within the deadline"))
+
+	except Exception:
+		undo_outbound_call(wa_api, room_config, dial=dial)
+		raise
+
+	return room_config, call_response
+
+
+def dial_customer(wa_api, mobile_number, timeout, timer):
+	"""Dial leg; runs on a helper thread, so it must not use the site context"""
+	with timer.stage("dial"):
+		return wa_api.make_call(mobile_number, timeout=timeout)
+
+
+def undo_outbound_call(wa_api, room_config=None, call_response=None, dial=None):
+	"""
+	Roll back a partly set up call
+
+	Args:
+		wa_api: WhatsAppAPI the call was dialled with
+		room_config: room from acquire_room, if one was taken
+		call_response: Graph reply, if the dial succeeded
+		dial: dial future still to be settled; waited for (its HTTP
+			timeouts bound the wait) so a late success is hung up too
+	"""
+	if room_config:
+		try:
+			release_room(room_config["room_id"], room_config["session_id"], room_config["janus_node"])
+		except Exception as e:
+			frappe.log_error(message=str(e), title="Call Setup Rollback Error")
+
+	if dial is not None and call_response is None:
+		try:
+			call_response = dial.result()
+		except Exception:
+			# The dial failed: nothing to hang up
+			pass
+
+	if call_response:
+		try:
+			wa_api.end_call(call_response["id"])
+		except Exception as e:
+			frappe.log_error(message=str(e), title="Call Setup Rollback Error")
+
+
+def get_executor():
+	"""This process's dial threads (forked workers get their own)"""
+	pid = os.getpid()
+	with _executors_lock:
+		executor = _executors.get(pid)
+		if executor is None:
+			executor = _executors[pid] = ThreadPoolExecutor(max_workers=DIAL_WORKERS, thread_name_prefix="whatsapp-dial")
+	return executor
+
+
+def remaining(deadline):
+	return max(deadline - time.monotonic(), 0)
+
+
+def elapsed_ms(start):
+	return round((time.perf_counter() - start) * 1000, 1)
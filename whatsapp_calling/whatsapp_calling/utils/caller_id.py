@@ -0,0 +1,218 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Caller-ID cache: phone number -> Lead, display name and company
+
+Two tiers: a short-lived in-process LRU in front of a Redis hash per
+national suffix (last 10 digits). Entries are keyed by suffix so a Lead
+change can drop every cached variant of its numbers in one DELETE. Unknown
+callers are cached too, as an empty entry, and a new Lead with their
+number clears that.
+"""
+
+import frappe
+import json
+from whatsapp_calling.whatsapp_calling.utils.lead_lookup import LEAD_PHONE_FIELDS, find_leads_by_mobile
+from whatsapp_calling.whatsapp_calling.utils.lru import TTLCache
+from whatsapp_calling.whatsapp_calling.utils.validators import normalize_phone_number
+
+CACHE_KEY = "whatsapp_caller_id:{0}"
+
+REDIS_TTL = 24 * 60 * 60
+# Other workers' LRUs only learn about Lead changes when entries expire
+LOCAL_TTL = 60
+LOCAL_SIZE = 5000
+PREWARM_CHUNK_SIZE = 1000
+
+# Lead fields that change what the agent sees for a caller
+CALLER_FIELDS = ("lead_name", "company_name")
+
+_local_caches = {}
+
+
+def get_local_cache():
+	site = frappe.local.site
+	if site not in _local_caches:
+		_local_caches[site] = TTLCache(LOCAL_SIZE, LOCAL_TTL)
+	return _local_caches[site]
+
+
+def get_caller_keys(phone_number):
+	"""Return (E.164 key, national suffix) for a number, or (None, None)"""
+	digits = normalize_phone_number(phone_number)
+	if not digits:
+		return None, None
+	return f"+{digits}", digits[-10:]
+
+
+def resolve_caller_ids(phone_numbers):
+	"""
+	Identify many callers at once
+
+	Args:
+		phone_numbers: list of caller numbers as sent by Meta
+
+	Returns:
+		dict of number -> {"lead", "lead_name", "company_name"}, or {} for
+		callers with no matching Lead
+	"""
+	local = get_local_cache()
+	callers = {}
+	misses = {}
+
+	# Tier 1: this process
+	for number in set(filter(None, phone_numbers)):
+		e164, suffix = get_caller_keys(number)
+		if not suffix:
+			continue
+
+		entry = local.get(suffix) or {}
+		if e164 in entry:
+			callers[number] = entry[e164]
+		else:
+			misses[number] = (e164, suffix)
+
+	if not misses:
+		return callers
+
+	# Tier 2: Redis, one pipelined round-trip
+	cache = frappe.cache()
+	try:
+		pipe = cache.pipeline(transaction=False)
+		for e164, suffix in misses.values():
+			pipe.hget(cache.make_key(CACHE_KEY.format(suffix)), e164)
+		cached = pipe.execute()
+	except Exception:
+		cached = [None] * len(misses)
+
+	unresolved = {}
+	for (number, (e164, suffix)), value in zip(misses.items(), cached):
+		if value is None:
+			unresolved[number] = (e164, suffix)
+			continue
+
+		callers[number] = json.loads(value)
+		_remember_locally(suffix, e164, callers[number])
+
+	if not unresolved:
+		return callers
+
+	# Tier 3: database, then fill both tiers
+	found = lookup_callers(list(unresolved))
+
+	try:
+		pipe = cache.pipeline(transaction=False)
+		for number, (e164, suffix) in unresolved.items():
+			key = cache.make_key(CACHE_KEY.format(suffix))
+			pipe.hset(key, e164, json.dumps(found.get(number, {})))
+			pipe.expire(key, REDIS_TTL)
+		pipe.execute()
+	except Exception:
+		pass
+
+	for number, (e164, suffix) in unresolved.items():
+		callers[number] = found.get(number, {})
+		_remember_locally(suffix, e164, callers[number])
+
+	return callers
+
+
+def resolve_caller_id(phone_number):
+	"""Identify a single caller; see resolve_caller_ids"""
+	return resolve_caller_ids([phone_number]).get(phone_number) or {}
+
+
+def lookup_callers(phone_numbers):
+	"""Resolve numbers to Lead details straight from the database"""
+	leads = find_leads_by_mobile(phone_numbers)
+	if not leads:
+		return {}
+
+	fields = ["name"] + [f for f in CALLER_FIELDS if frappe.db.has_column("Lead", f)]
+	rows = {
+		row.name: row for row in frappe.get_all(
+			"Lead",
+			filters={"name": ["in", list(set(leads.values()))]},
+			fields=fields
+		)
+	}
+
+	callers = {}
+	for number, lead in leads.items():
+		row = rows.get(lead)
+		if row:
+			callers[number] = {
+				"lead": lead,
+				"lead_name": row.get("lead_name"),
+				"company_name": row.get("company_name")
+			}
+	return callers
+
+
+def _remember_locally(suffix, e164, caller):
+	local = get_local_cache()
+	entry = dict(local.get(suffix) or {})
+	entry[e164] = caller
+	local.set(suffix, entry)
+
+
+def invalidate_numbers(phone_numbers):
+	"""Drop cached caller-ID entries for these numbers on every tier"""
+	suffixes = {get_caller_keys(number)[1] for number in phone_numbers}
+	suffixes.discard(None)
+	if not suffixes:
+		return
+
+	local = get_local_cache()
+	for suffix in suffixes:
+		local.pop(suffix)
+
+	try:
+		cache = frappe.cache()
+		cache.delete(*[cache.make_key(CACHE_KEY.format(suffix)) for suffix in suffixes])
+	except Exception:
+		pass
+
+
+def invalidate_lead_caller_id(doc, method=None):
+	"""Lead doc_event: forget cached caller IDs for the Lead's numbers"""
+	before = doc.get_doc_before_save() if method == "on_update" else None
+
+	if before and not any(
+		doc.has_value_changed(field) for field in LEAD_PHONE_FIELDS + CALLER_FIELDS
+	):
+		return
+
+	numbers = [doc.get(field) for field in LEAD_PHONE_FIELDS]
+	if before:
+		numbers += [before.get(field) for field in LEAD_PHONE_FIELDS]
+
+	# Deleting before commit would let a webhook cache the old row again
+	frappe.db.after_commit.add(lambda: invalidate_numbers(numbers))
+
+
+def prewarm_caller_id_cache():
+	"""
+	Scheduled task: Load caller IDs of customers holding an active call
+	permission, so their calls are identified from cache when they ring
+	"""
+	try:
+		numbers = frappe.get_all(
+			"Call Permission",
+			filters={
+				"permission_status": "Granted",
+				"expires_at": [">", frappe.utils.now()]
+			},
+			pluck="customer_number",
+			distinct=True
+		)
+
+		for start in range(0, len(numbers), PREWARM_CHUNK_SIZE):
+			resolve_caller_ids(numbers[start:start + PREWARM_CHUNK_SIZE])
+
+		if numbers:
+			frappe.logger().info(f"Pre-warmed caller ID cache for {len(numbers)} numbers")
+
+	except Exception as e:
+		frappe.log_error(message=str(e), title="Prewarm Caller ID Cache Error")
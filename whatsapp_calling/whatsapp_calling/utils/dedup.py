@@ -0,0 +1,173 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Deduplication of Meta webhook redeliveries
+
+Meta redelivers a webhook whenever it does not get a timely 200, so the same
+event can arrive several times. Every event is fingerprinted by
+(id, status, timestamp) and remembered for a while; repeats are dropped
+before any database work happens.
+
+A fingerprint is first claimed for a few minutes only, and remembered for
+the full TTL once the transaction that handled its event has committed. An
+event whose worker died before committing is therefore accepted again when
+its webhook log is re-queued.
+"""
+
+import frappe
+from frappe.utils import cint
+from whatsapp_calling.whatsapp_calling.utils.lru import TTLCache
+
+SEEN_KEY = "whatsapp_webhook_seen:{0}"
+STATS_KEY = "whatsapp_webhook_dedup_stats"
+
+DEFAULT_TTL = 24 * 60 * 60  # Meta stops retrying well before this
+
+# Claim on an event being handled; shorter than the delay after which
+# webhook_queue.recover_stalled_webhooks re-queues an unfinished log
+CLAIM_TTL = 5 * 60
+CLAIMED = "claimed"
+DEFAULT_LOCAL_SIZE = 10000
+
+_deduplicators = {}
+
+
+def get_deduplicator():
+	"""Return the per-site deduplicator for this process"""
+	site = frappe.local.site
+	if site not in _deduplicators:
+		_deduplicators[site] = WebhookDeduplicator(
+			ttl=cint(frappe.conf.get("whatsapp_webhook_dedup_ttl")) or DEFAULT_TTL,
+			local_size=cint(frappe.conf.get("whatsapp_webhook_dedup_local_size")) or DEFAULT_LOCAL_SIZE
+		)
+	return _deduplicators[site]
+
+
+def get_event_fingerprint(event):
+	"""Identify an extracted webhook event by (id, status, timestamp)"""
+	data = event["data"]
+	return "|".join([
+		event["type"],
+		str(data.get("id") or ""),
+		str(data.get("status") or data.get("type") or ""),
+		str(data.get("timestamp") or "")
+	])
+
+
+class WebhookDeduplicator:
+	"""
+	Remembers webhook fingerprints in a Redis TTL set
+
+	Falls back to an in-process LRU when Redis is unreachable, which still
+	catches redeliveries that land on the same worker.
+	"""
+
+	def __init__(self, ttl=DEFAULT_TTL, local_size=DEFAULT_LOCAL_SIZE):
+		self.ttl = ttl
+		self.local = TTLCache(local_size, ttl)
+		self.hits = 0
+		self.misses = 0
+
+	def filter_new(self, fingerprints):
+		"""
+		Claim fingerprints and return the ones not seen (or claimed) before
+
+		Call confirm once the events are committed; until then the claim
+		lapses after CLAIM_TTL.
+
+		Args:
+			fingerprints: list of event fingerprints
+
+		Returns:
+			list of booleans, True where the event is new
+		"""
+		if not fingerprints:
+			return []
+
+		try:
+			fresh = self._mark_in_redis(fingerprints)
+		except Exception:
+			fresh = [self.local.add(fingerprint) for fingerprint in fingerprints]
+
+		hits = fresh.count(False)
+		self.hits += hits
+		self.misses += len(fresh) - hits
+		self._record(hits, len(fresh) - hits)
+		return fresh
+
+	def confirm(self, fingerprints):
+		"""Remember fingerprints for the full TTL, once their events are committed"""
+		try:
+			cache = frappe.cache()
+			pipe = cache.pipeline(transaction=False)
+			for fingerprint in fingerprints:
+				pipe.set(cache.make_key(SEEN_KEY.format(fingerprint)), 1, ex=self.ttl)
+			pipe.execute()
+		except Exception:
+			pass
+
+	def seen(self, fingerprints):
+		"""
+		Which fingerprints belong to events already handled and committed;
+		read-only, unlike filter_new
+
+		Returns:
+			list of booleans
+		"""
+		if not fingerprints:
+			return []
+
+		try:
+			cache = frappe.cache()
+			values = cache.mget([cache.make_key(SEEN_KEY.format(f)) for f in fingerprints])
+			return [value is not None and frappe.safe_decode(value) != CLAIMED for value in values]
+		except Exception:
+			return [False] * len(fingerprints)
+
+	def forget(self, fingerprints):
+		"""Unmark fingerprints, e.g. when their processing was rolled back"""
+		for fingerprint in fingerprints:
+			self.local.pop(fingerprint)
+
+		try:
+			cache = frappe.cache()
+			cache.delete(*[cache.make_key(SEEN_KEY.format(f)) for f in fingerprints])
+		except Exception:
+			pass
+
+	def stats(self):
+		"""Hit/miss counters for this process and across all workers"""
+		stats = {
+			"process": {"hits": self.hits, "misses": self.misses, "local_entries": len(self.local)},
+			"ttl": self.ttl
+		}
+
+		try:
+			# Raw read: RedisWrapper.hgetall would unpickle the counters
+			cache = frappe.cache()
+			pipe = cache.pipeline(transaction=False)
+			pipe.hgetall(cache.make_key(STATS_KEY))
+			totals = pipe.execute()[0]
+			stats["total"] = {k.decode(): cint(v) for k, v in totals.items()}
+		except Exception:
+			stats["total"] = None
+
+		return stats
+
+	def _mark_in_redis(self, fingerprints):
+		cache = frappe.cache()
+		pipe = cache.pipeline(transaction=False)
+		for fingerprint in fingerprints:
+			pipe.set(cache.make_key(SEEN_KEY.format(fingerprint)), CLAIMED, nx=True, ex=CLAIM_TTL)
+		return [bool(result) for result in pipe.execute()]
+
+	def _record(self, hits, misses):
+		try:
+			cache = frappe.cache()
+			pipe = cache.pipeline(transaction=False)
+			pipe.hincrby(cache.make_key(STATS_KEY), "hits", hits)
+			pipe.hincrby(cache.make_key(STATS_KEY), "misses", misses)
+			pipe.execute()
+		except Exception:
+			pass
@@ -0,0 +1,117 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Pooled HTTP transport for the Graph API and Janus
+
+Bare `requests.post` opens a new TCP (and TLS) connection for every call.
+A shared Session per worker keeps connections alive between requests and
+jobs. Each thread gets its own Session, because requests.Session is not
+thread-safe.
+
+Tuning via site_config.json:
+	whatsapp_http_pool_size: connections kept per host (default 10)
+	whatsapp_http_retries: retries for connection errors and for
+		idempotent requests that fail with 429/5xx (default 2)
+	whatsapp_http_connect_timeout / whatsapp_http_read_timeout: seconds
+		(default 3.05 / 10)
+"""
+
+import frappe
+import random
+import threading
+import requests
+from frappe.utils import cint, flt
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_RETRIES = 2
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+BACKOFF_FACTOR = 0.2
+MAX_JITTER = 0.25  # seconds
+
+# POSTs are never replayed after they reached the server: creating a call,
+# a Janus session or a room twice is worse than failing once
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS", "PUT", "DELETE"])
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_local = threading.local()
+
+
+class JitterRetry(Retry):
+	"""Exponential backoff plus random jitter, so workers do not retry in lockstep"""
+
+	def get_backoff_time(self):
+		backoff = super().get_backoff_time()
+		return backoff + random.uniform(0, MAX_JITTER) if backoff else backoff
+
+
+class PooledSession(requests.Session):
+	"""Session with split connect/read timeouts applied by default"""
+
+	def __init__(self, timeout):
+		super().__init__()
+		self.default_timeout = timeout
+
+	def request(self, method, url, **kwargs):
+		kwargs.setdefault("timeout", self.default_timeout)
+		return super().request(method, url, **kwargs)
+
+
+def get_session(name):
+	"""
+	Return this thread's pooled session for a service
+
+	Args:
+		name: pool name, e.g. "graph" or "janus"
+
+	Returns:
+		PooledSession
+	"""
+	sessions = getattr(_local, "sessions", None)
+	if sessions is None:
+		sessions = _local.sessions = {}
+
+	if name not in sessions:
+		sessions[name] = make_session()
+	return sessions[name]
+
+
+def make_session():
+	conf = frappe.conf
+	pool_size = cint(conf.get("whatsapp_http_pool_size")) or DEFAULT_POOL_SIZE
+	retries = cint(conf.get("whatsapp_http_retries", DEFAULT_RETRIES))
+
+	retry = JitterRetry(
+		total=retries,
+		connect=retries,
+		read=retries,
+		status=retries,
+		backoff_factor=BACKOFF_FACTOR,
+		status_forcelist=RETRY_STATUSES,
+		allowed_methods=IDEMPOTENT_METHODS,
+		raise_on_status=False,
+		respect_retry_after_header=True
+	)
+	adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+
+	session = PooledSession(timeout=get_timeout())
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	return session
+
+
+def get_timeout(read=None):
+	"""(connect, read) timeout tuple; `read` overrides the configured read timeout"""
+	conf = frappe.conf
+	connect = flt(conf.get("whatsapp_http_connect_timeout")) or DEFAULT_CONNECT_TIMEOUT
+	return (connect, read or flt(conf.get("whatsapp_http_read_timeout")) or DEFAULT_READ_TIMEOUT)
+
+
+def close_sessions():
+	"""Drop this thread's sessions and their connections"""
+	for session in (getattr(_local, "sessions", None) or {}).values():
+		session.close()
+	_local.sessions = {}
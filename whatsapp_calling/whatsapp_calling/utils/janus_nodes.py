@@ -0,0 +1,183 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Janus node registry and room placement
+
+With Janus Node records, calls are spread over several Janus servers: each
+new room goes to the least-loaded Active, healthy node, relative to its
+Max Rooms and Weight. The node is stored on the WhatsApp Call, and every
+later request for that call goes to the same node.
+
+Without any Janus Node, the app uses the single server configured in
+WhatsApp Settings, as before.
+
+Node health comes from polling each node's /info endpoint; results live in
+Redis (and are mirrored on the Janus Node record for the desk).
+"""
+
+import frappe
+import time
+from frappe import _
+from frappe.utils import flt
+from whatsapp_calling.whatsapp_calling.utils.http import get_session, get_timeout
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_janus_nodes, get_settings
+
+HEALTH_KEY = "whatsapp_janus_node_health"
+
+# A health result older than this is ignored (the poller may be stopped);
+# the node is then assumed healthy rather than taken out of rotation
+HEALTH_TTL = 5 * 60  # seconds
+HEALTH_CHECK_TIMEOUT = 3  # seconds
+
+# Load of nodes without a room limit is measured against this many rooms
+UNLIMITED_CAPACITY = 1000
+
+
+def get_node_config(node=None):
+	"""
+	Connection details of a Janus node
+
+	Args:
+		node: Janus Node name, or None for the server in WhatsApp Settings
+
+	Returns:
+		dict with name, http_url, ws_url, api_secret, admin_url, admin_secret
+	"""
+	if node:
+		config = get_janus_nodes().get(node)
+		if config is None:
+			frappe.throw(_("Janus Node {0} not found").format(node))
+
+		return {
+			"name": node,
+			"http_url": config.http_url,
+			"ws_url": config.ws_url,
+			"api_secret": config.api_secret,
+			"admin_url": config.admin_url,
+			"admin_secret": config.admin_secret
+		}
+
+	settings = get_settings()
+	return {
+		"name": None,
+		"http_url": settings.janus_http_url,
+		"ws_url": settings.janus_ws_url,
+		"api_secret": settings.janus_api_secret,
+		"admin_url": settings.janus_admin_url,
+		"admin_secret": settings.janus_admin_secret
+	}
+
+
+def get_janus_ws_url(node=None):
+	"""WebSocket URL that browsers and WhatsApp use to reach a call's node"""
+	return get_node_config(node)["ws_url"]
+
+
+def get_placement_nodes():
+	"""Names of nodes that may take new rooms (Active and healthy)"""
+	health = get_health()
+	return [
+		node.name for node in get_janus_nodes().values()
+		if node.status == "Active" and is_healthy(node.name, health)
+	]
+
+
+def pick_node(count_rooms):
+	"""
+	Choose the node for a new room
+
+	Args:
+		count_rooms: callable returning the rooms a node holds now
+
+	Returns:
+		Janus Node name, or None when no nodes are registered
+	"""
+	nodes = get_janus_nodes()
+	if not nodes:
+		return None
+
+	best, best_load = None, None
+	for name in get_placement_nodes():
+		node = nodes[name]
+		rooms = count_rooms(name)
+
+		if node.max_rooms and rooms >= node.max_rooms:
+			continue
+
+		load = rooms / (node.max_rooms or UNLIMITED_CAPACITY) / (flt(node.weight) or 1)
+		if best is None or load < best_load:
+			best, best_load = name, load
+
+	if best is None:
+		frappe.throw(_("No Janus node is available for a new call"))
+
+	return best
+
+
+def get_health():
+	"""Latest health results of all nodes: {node: {"healthy", "checked_at", "error"}}"""
+	try:
+		health = frappe.cache().hgetall(HEALTH_KEY) or {}
+	except Exception:
+		return {}
+	return {frappe.safe_decode(node): result for node, result in health.items()}
+
+
+def is_healthy(node, health=None):
+	result = (health if health is not None else get_health()).get(node)
+	if not result or time.time() - result["checked_at"] > HEALTH_TTL:
+		return True
+	return result["healthy"]
+
+
+def check_node(node):
+	"""
+	Poll a node's /info endpoint and record the result
+
+	Returns:
+		dict with healthy and error
+	"""
+	config = get_node_config(node)
+	error = None
+
+	try:
+		response = get_session("janus").get(f"{config['http_url']}/info", timeout=get_timeout(read=HEALTH_CHECK_TIMEOUT))
+		response.raise_for_status()
+		if response.json().get("janus") != "server_info":
+			error = f"Unexpected /info reply: {response.text[:200]}"
+	except Exception as e:
+		error = str(e)[:500]
+
+	healthy = error is None
+	frappe.cache().hset(HEALTH_KEY, node, {"healthy": healthy, "checked_at": time.time(), "error": error})
+
+	# Mirror on the record without a save, so configuration snapshots stay valid
+	frappe.db.set_value("Janus Node", node, {
+		"is_healthy": int(healthy),
+		"last_health_check": frappe.utils.now(),
+		"health_error": error
+	}, update_modified=False)
+
+	return {"healthy": healthy, "error": error}
+
+
+def poll_janus_nodes():
+	"""
+	Scheduled task: Health-check every Janus node that is not Disabled
+	"""
+	try:
+		unhealthy = []
+		for node in get_janus_nodes().values():
+			if node.status == "Disabled":
+				continue
+			if not check_node(node.name)["healthy"]:
+				unhealthy.append(node.name)
+
+		frappe.db.commit()
+
+		if unhealthy:
+			frappe.logger().info(f"Unhealthy Janus nodes: {', '.join(unhealthy)}")
+
+	except Exception as e:
+		frappe.log_error(message=str(e), title="Poll Janus Nodes Error")
@@ -0,0 +1,236 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Janus WebSocket transport
+
+One persistent connection to `janus_ws_url` per worker process carries the
+requests of every call. Requests are matched to their replies by
+transaction ID, so any number of threads can have requests in flight on
+the same socket. A reader thread routes each incoming message:
+
+- replies go back to the caller waiting on that transaction. Plugin
+  requests are acknowledged first ("ack") and answered later by an
+  "event" carrying the same transaction; the caller gets the final one.
+- asynchronous events (plugin events without a transaction, webrtcup,
+  hangup, media, slowlink, detached, timeout) go to handlers registered
+  for the handle or session they come from.
+
+Sessions registered with keep_alive() get a keepalive every 25 seconds
+so Janus does not time them out.
+"""
+
+import frappe
+import json
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+import websocket
+
+KEEPALIVE_INTERVAL = 25  # seconds; Janus times sessions out after 60s by default
+CONNECT_TIMEOUT = 5
+REQUEST_TIMEOUT = 10
+
+# Requests whose "ack" is the final reply
+ACK_ONLY_REQUESTS = ("keepalive", "trickle")
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+class JanusTransportError(Exception):
+	"""The WebSocket to Janus failed; pending requests cannot complete"""
+
+
+class JanusWebSocket:
+	"""Multiplexed Janus API connection shared by a worker's threads"""
+
+	def __init__(self, url, api_secret=None):
+		self.url = url
+		self.api_secret = api_secret
+		self.ws = None
+		self.send_lock = threading.Lock()
+		self.state_lock = threading.Lock()
+		self.pending = {}
+		self.handlers = {}
+		self.sessions = set()
+		self.reader = None
+		self.keepalive_thread = None
+		self.closed = False
+
+	def connect(self):
+		"""Open the socket and start the reader and keepalive threads"""
+		with self.state_lock:
+			if self.connected:
+				return
+
+			try:
+				self.ws = websocket.create_connection(
+					self.url,
+					subprotocols=["janus-protocol"],
+					timeout=CONNECT_TIMEOUT
+				)
+			except Exception as e:
+				raise JanusTransportError(f"Could not connect to Janus at {self.url}: {e}")
+
+			# The reader blocks on recv; request timeouts are enforced by callers
+			self.ws.settimeout(None)
+
+			self.reader = threading.Thread(target=self._read_loop, args=(self.ws,), daemon=True)
+			self.reader.start()
+
+			if not self.keepalive_thread or not self.keepalive_thread.is_alive():
+				self.keepalive_thread = threading.Thread(target=self._keepalive_loop, daemon=True)
+				self.keepalive_thread.start()
+
+	@property
+	def connected(self):
+		return self.ws is not None and self.ws.connected and self.reader is not None and self.reader.is_alive()
+
+	def request(self, payload, session_id=None, handle_id=None, timeout=REQUEST_TIMEOUT):
+		"""
+		Send a Janus API request and wait for its final reply
+
+		Args:
+			payload: request body, e.g. {"janus": "attach", "plugin": ...}
+			session_id: Janus session the request targets, if any
+			handle_id: plugin handle the request targets, if any
+			timeout: seconds to wait for the reply
+
+		Returns:
+			dict: the reply ("success", "event", "ack" for keepalives, or "error")
+		"""
+		self.connect()
+
+		transaction = secrets.token_hex(12)
+		message = dict(payload, transaction=transaction)
+		if session_id:
+			message["session_id"] = int(session_id)
+		if handle_id:
+			message["handle_id"] = int(handle_id)
+		if self.api_secret:
+			message["apisecret"] = self.api_secret
+
+		future = Future()
+		future.ack_only = payload.get("janus") in ACK_ONLY_REQUESTS
+		self.pending[transaction] = future
+
+		try:
+			self._send(message)
+			return future.result(timeout=timeout)
+		except FutureTimeout:
+			raise JanusTransportError(f"Janus did not answer {payload.get('janus')} within {timeout}s")
+		finally:
+			self.pending.pop(transaction, None)
+
+	def on_event(self, sender, handler):
+		"""
+		Route asynchronous events of a handle or session to `handler`
+
+		Args:
+			sender: handle ID (plugin events) or session ID (session events)
+			handler: callable receiving the event dict. It runs on the reader
+				thread, outside any site context, so it must not use the database.
+		"""
+		self.handlers[str(sender)] = handler
+
+	def off_event(self, sender):
+		self.handlers.pop(str(sender), None)
+
+	def keep_alive(self, session_id):
+		"""Send keepalives for a session until forget_session is called"""
+		self.sessions.add(str(session_id))
+
+	def forget_session(self, session_id):
+		self.sessions.discard(str(session_id))
+		self.handlers.pop(str(session_id), None)
+
+	def close(self):
+		self.closed = True
+		with self.state_lock:
+			if self.ws:
+				self.ws.close()
+		self._fail_pending(JanusTransportError("Janus connection closed"))
+
+	def _send(self, message):
+		with self.send_lock:
+			try:
+				self.ws.send(json.dumps(message))
+			except Exception as e:
+				raise JanusTransportError(f"Could not send to Janus: {e}")
+
+	def _read_loop(self, ws):
+		try:
+			while True:
+				raw = ws.recv()
+				if not raw:
+					break
+				self._dispatch(json.loads(raw))
+		except Exception:
+			pass
+		finally:
+			self._fail_pending(JanusTransportError("Janus connection lost"))
+
+	def _dispatch(self, message):
+		future = self.pending.get(message.get("transaction"))
+
+		if future is not None and not future.done():
+			# Plugin requests are acknowledged before they are answered
+			if message.get("janus") != "ack" or future.ack_only:
+				future.set_result(message)
+			return
+
+		if message.get("janus") == "ack":
+			# e.g. acknowledgements of our own fire-and-forget keepalives
+			return
+
+		handler = self.handlers.get(str(message.get("sender"))) or self.handlers.get(str(message.get("session_id")))
+		if handler:
+			try:
+				handler(message)
+			except Exception:
+				# No site context on this thread, so no Error Log either
+				frappe.logger("whatsapp_calling").exception("Janus event handler failed")
+
+	def _fail_pending(self, error):
+		for future in list(self.pending.values()):
+			if not future.done():
+				future.set_exception(error)
+
+	def _keepalive_loop(self):
+		while not self.closed:
+			time.sleep(KEEPALIVE_INTERVAL)
+			if not self.connected:
+				continue
+
+			for session_id in list(self.sessions):
+				message = {
+					"janus": "keepalive",
+					"session_id": int(session_id),
+					"transaction": secrets.token_hex(12)
+				}
+				if self.api_secret:
+					message["apisecret"] = self.api_secret
+
+				try:
+					self._send(message)
+				except JanusTransportError:
+					break
+
+
+def get_janus_ws(url, api_secret=None):
+	"""
+	Return this process's connection to a Janus WebSocket endpoint
+
+	Forked workers get their own connection rather than sharing the parent's.
+	"""
+	key = (os.getpid(), url)
+	with _connections_lock:
+		connection = _connections.get(key)
+		if connection is None or connection.api_secret != api_secret:
+			if connection is not None:
+				connection.close()
+			connection = _connections[key] = JanusWebSocket(url, api_secret)
+	return connection
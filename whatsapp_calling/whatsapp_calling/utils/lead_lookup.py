@@ -0,0 +1,145 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Lead lookup by phone number through the indexed Lead Phone Key table
+
+Every Lead number is stored in normalized form (E.164 and the last 10
+digits), so finding the Lead for a caller is an indexed equality probe
+instead of a `LIKE '%...%'` scan over the whole Lead table.
+"""
+
+import frappe
+from whatsapp_calling.whatsapp_calling.utils.validators import get_phone_lookup_keys
+
+# Lead fields that hold a number customers may call from
+LEAD_PHONE_FIELDS = ("mobile_no", "whatsapp_no")
+
+KEY_FIELDS = ["name", "creation", "modified", "owner", "modified_by", "phone_key", "key_type", "lead"]
+BACKFILL_CHUNK_SIZE = 10000
+
+
+def find_lead_by_mobile(mobile_number):
+	"""Find CRM Lead by mobile number"""
+	return find_leads_by_mobile([mobile_number]).get(mobile_number)
+
+
+def find_leads_by_mobile(mobile_numbers):
+	"""
+	Resolve many phone numbers to Leads with a single indexed query
+
+	An exact E.164 match wins over a match on the last 10 digits.
+
+	Returns:
+		dict of phone number -> Lead name (numbers without a match are omitted)
+	"""
+	keys_by_number = {
+		number: get_phone_lookup_keys(number)
+		for number in set(mobile_numbers) if number
+	}
+
+	all_keys = list({key for keys in keys_by_number.values() for key, key_type in keys})
+	if not all_keys:
+		return {}
+
+	rows = frappe.get_all(
+		"Lead Phone Key",
+		filters={"phone_key": ["in", all_keys]},
+		fields=["phone_key", "lead"],
+		order_by="creation asc"
+	)
+
+	lead_by_key = {}
+	for row in rows:
+		lead_by_key.setdefault(row.phone_key, row.lead)
+
+	leads = {}
+	for number, keys in keys_by_number.items():
+		for key, key_type in keys:
+			if key in lead_by_key:
+				leads[number] = lead_by_key[key]
+				break
+
+	return leads
+
+
+def get_lead_key_rows(lead_name, numbers):
+	"""Build Lead Phone Key rows for one Lead"""
+	now = frappe.utils.now()
+	user = frappe.session.user
+
+	rows = []
+	seen = set()
+	for number in numbers:
+		for key, key_type in get_phone_lookup_keys(number):
+			if key not in seen:
+				seen.add(key)
+				rows.append((frappe.generate_hash(length=12), now, now, user, user, key, key_type, lead_name))
+	return rows
+
+
+def sync_lead_phone_keys(doc, method=None):
+	"""
+	Lead doc_event (on_update, which also runs on insert): keep Lead Phone
+	Key in step with the Lead's numbers
+	"""
+	if not any(doc.has_value_changed(f) for f in LEAD_PHONE_FIELDS):
+		return
+
+	frappe.db.delete("Lead Phone Key", {"lead": doc.name})
+
+	rows = get_lead_key_rows(doc.name, [doc.get(field) for field in LEAD_PHONE_FIELDS])
+	if rows:
+		frappe.db.bulk_insert("Lead Phone Key", fields=KEY_FIELDS, values=rows)
+
+
+def remove_lead_phone_keys(doc, method=None):
+	"""Lead doc_event: drop the keys of a deleted Lead"""
+	frappe.db.delete("Lead Phone Key", {"lead": doc.name})
+
+
+def rename_lead_phone_keys(doc, method=None, old=None, new=None, merge=False):
+	"""Lead doc_event: follow a renamed Lead"""
+	frappe.db.sql("""
+		UPDATE `tabLead Phone Key` SET lead = %s WHERE lead = %s
+	""", (new, old))
+
+
+def backfill_lead_phone_keys(chunk_size=BACKFILL_CHUNK_SIZE):
+	"""
+	Build Lead Phone Key for every existing Lead
+
+	Walks the Lead table in primary-key order, one chunk per transaction,
+	so it can run on millions of Leads without holding long locks.
+	"""
+	phone_fields = [f for f in LEAD_PHONE_FIELDS if frappe.db.has_column("Lead", f)]
+	last_name = ""
+	total = 0
+
+	frappe.db.sql("DELETE FROM `tabLead Phone Key`")
+
+	while True:
+		leads = frappe.db.sql(f"""
+			SELECT name, {", ".join(phone_fields)}
+			FROM `tabLead`
+			WHERE name > %s
+			ORDER BY name
+			LIMIT %s
+		""", (last_name, chunk_size), as_dict=True)
+
+		if not leads:
+			break
+
+		rows = []
+		for lead in leads:
+			rows.extend(get_lead_key_rows(lead.name, [lead.get(f) for f in phone_fields]))
+
+		if rows:
+			frappe.db.bulk_insert("Lead Phone Key", fields=KEY_FIELDS, values=rows)
+
+		frappe.db.commit()
+		total += len(leads)
+		last_name = leads[-1].name
+
+	frappe.logger().info(f"Indexed phone numbers of {total} Leads")
+	return total
@@ -0,0 +1,174 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Per-call distributed locks with fencing tokens
+
+Webhook workers on different nodes take a short lease on every call_id they
+are about to write. Each successful acquire returns a fencing token from a
+single monotonic counter; writers store it on the WhatsApp Call row and
+only overwrite rows holding an older token, so a worker whose lease expired
+mid-write cannot clobber a newer holder's changes.
+"""
+
+import frappe
+import itertools
+import random
+import threading
+import time
+from contextlib import contextmanager
+from frappe.utils import cint
+
+LOCK_KEY = "whatsapp_call_lock:{0}"
+FENCE_KEY = "whatsapp_call_lock_fence"
+
+DEFAULT_LEASE_MS = 10000
+DEFAULT_WAIT_MS = 5000
+
+# Take the lease and hand out the next fencing token in one step
+ACQUIRE_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 then
+	return 0
+end
+local token = redis.call('incr', KEYS[2])
+redis.call('set', KEYS[1], token, 'PX', ARGV[1])
+return token
+"""
+
+# Only the current holder may release
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+	return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class CallLockTimeout(frappe.ValidationError):
+	pass
+
+
+class RedisLockBackend:
+	"""Leases stored as Redis keys with a PX expiry"""
+
+	def __init__(self):
+		self.cache = frappe.cache()
+		self.acquire_script = self.cache.register_script(ACQUIRE_SCRIPT)
+		self.release_script = self.cache.register_script(RELEASE_SCRIPT)
+
+	def try_acquire(self, call_id, lease_ms):
+		token = self.acquire_script(
+			keys=[self.cache.make_key(LOCK_KEY.format(call_id)), self.cache.make_key(FENCE_KEY)],
+			args=[lease_ms]
+		)
+		return cint(token) or None
+
+	def release(self, call_id, token):
+		self.release_script(keys=[self.cache.make_key(LOCK_KEY.format(call_id))], args=[token])
+
+
+class LocalLockBackend:
+	"""In-process stand-in for RedisLockBackend, used by tests"""
+
+	def __init__(self):
+		self.leases = {}
+		self.counter = itertools.count(1)
+		self.mutex = threading.Lock()
+
+	def try_acquire(self, call_id, lease_ms):
+		now = time.monotonic()
+		with self.mutex:
+			lease = self.leases.get(call_id)
+			if lease and lease[1] > now:
+				return None
+
+			token = next(self.counter)
+			self.leases[call_id] = (token, now + lease_ms / 1000.0)
+			return token
+
+	def release(self, call_id, token):
+		with self.mutex:
+			lease = self.leases.get(call_id)
+			if lease and lease[0] == cint(token):
+				del self.leases[call_id]
+
+
+_local_backend = LocalLockBackend()
+
+
+def get_lock_backend():
+	if frappe.conf.get("whatsapp_lock_backend") == "local":
+		return _local_backend
+	return RedisLockBackend()
+
+
+class CallLock:
+	"""
+	Short lease on a single call_id
+
+	Usage:
+		with CallLock(call_id) as token:
+			... write rows with fence_token = token ...
+	"""
+
+	def __init__(self, call_id, lease_ms=DEFAULT_LEASE_MS, wait_ms=DEFAULT_WAIT_MS, backend=None):
+		self.call_id = call_id
+		self.lease_ms = lease_ms
+		self.wait_ms = wait_ms
+		self.backend = backend or get_lock_backend()
+		self.token = None
+
+	def acquire(self):
+		"""Wait up to wait_ms for the lease and return its fencing token"""
+		deadline = time.monotonic() + self.wait_ms / 1000.0
+		delay = 0.01
+
+		while True:
+			self.token = self.backend.try_acquire(self.call_id, self.lease_ms)
+			if self.token:
+				return self.token
+
+			if time.monotonic() >= deadline:
+				raise CallLockTimeout(f"Timed out waiting for lock on call {self.call_id}")
+
+			# Jittered backoff so waiting workers do not retry in lockstep
+			time.sleep(delay * random.uniform(0.5, 1.5))
+			delay = min(delay * 2, 0.2)
+
+	def release(self):
+		if self.token:
+			self.backend.release(self.call_id, self.token)
+			self.token = None
+
+	def __enter__(self):
+		return self.acquire()
+
+	def __exit__(self, *args):
+		self.release()
+
+
+@contextmanager
+def call_locks(call_ids, lease_ms=DEFAULT_LEASE_MS, wait_ms=DEFAULT_WAIT_MS):
+	"""
+	Hold leases on several calls at once
+
+	Locks are taken in sorted order so two batches sharing calls cannot
+	deadlock each other.
+
+	Yields:
+		dict of call_id -> fencing token
+	"""
+	backend = get_lock_backend()
+	locks = []
+
+	try:
+		for call_id in sorted(set(call_ids)):
+			lock = CallLock(call_id, lease_ms=lease_ms, wait_ms=wait_ms, backend=backend)
+			lock.acquire()
+			locks.append(lock)
+
+		yield {lock.call_id: lock.token for lock in locks}
+
+	finally:
+		for lock in reversed(locks):
+			lock.release()
@@ -0,0 +1,73 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+	"""
+	Bounded, thread-safe LRU mapping with per-entry expiry
+
+	Used as the in-process tier in front of Redis. Entries are dropped when
+	they expire or when the cache grows past maxsize (least recently used
+	first).
+	"""
+
+	def __init__(self, maxsize, ttl):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.entries = OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key, default=None):
+		now = time.monotonic()
+		with self.lock:
+			entry = self.entries.get(key, _MISSING)
+			if entry is _MISSING:
+				return default
+
+			expires, value = entry
+			if expires <= now:
+				del self.entries[key]
+				return default
+
+			self.entries.move_to_end(key)
+			return value
+
+	def set(self, key, value):
+		with self.lock:
+			self.entries[key] = (time.monotonic() + self.ttl, value)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+
+	def add(self, key, value=True):
+		"""Store key only if absent (or expired); returns True if stored"""
+		now = time.monotonic()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry and entry[0] > now:
+				self.entries.move_to_end(key)
+				return False
+
+			self.entries[key] = (now + self.ttl, value)
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.maxsize:
+				self.entries.popitem(last=False)
+			return True
+
+	def pop(self, key, default=None):
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			return entry[1] if entry else default
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+
+	def __len__(self):
+		return len(self.entries)
@@ -0,0 +1,356 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Media quality telemetry from the Janus Admin API
+
+A long-running background job samples every answered call every few
+seconds (Media Sample Interval in WhatsApp Settings): it walks the
+sessions and handles of each Janus node through the Admin API, matches
+AudioBridge participant handles to calls by room, and reads their audio
+RTP/RTCP stats (jitter, packet loss, RTT, bitrate).
+
+Samples stay in the job's memory, in fixed-size ring buffers per call plus
+running totals, so there is no database write per sample. When a call is
+no longer answered, its summary is written to `media_stats` along with a
+`call_quality` derived from an estimated MOS (simplified E-model).
+
+The job runs for half an hour at a time and is restarted by the
+scheduler. Calls still in progress are handed over to the next run
+through Redis.
+"""
+
+import frappe
+import json
+import secrets
+import time
+from collections import deque
+from frappe.utils import cint, flt
+from whatsapp_calling.whatsapp_calling.utils.http import get_session, get_timeout
+from whatsapp_calling.whatsapp_calling.utils.janus_nodes import get_node_config
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_settings
+
+AUDIOBRIDGE = "janus.plugin.audiobridge"
+
+SAMPLES_PER_CALL = 360  # ring buffer size: the last 30 minutes at 5s
+DEFAULT_SAMPLE_INTERVAL = 5  # seconds
+ADMIN_TIMEOUT = 3  # seconds
+
+RUN_FOR = 30 * 60  # seconds per job
+LOCK_KEY = "whatsapp_media_telemetry"
+HANDOVER_KEY = "whatsapp_media_telemetry_handover"
+HANDOVER_TTL = 15 * 60
+
+METRICS = ("jitter", "loss", "rtt", "bitrate")
+
+# Lowest estimated MOS for each quality, best first
+QUALITY_THRESHOLDS = (("Excellent", 4.2), ("Good", 3.8), ("Fair", 3.1))
+
+
+class JanusAdmin:
+	"""Minimal client for the Janus Admin API of one node"""
+
+	def __init__(self, url, admin_secret=None):
+		self.url = url.rstrip("/")
+		self.admin_secret = admin_secret
+		self.session = get_session("janus")
+
+	def request(self, janus, session_id=None, handle_id=None):
+		url = "/".join(str(part) for part in (self.url, session_id, handle_id) if part)
+		payload = {"janus": janus, "transaction": secrets.token_hex(12)}
+		if self.admin_secret:
+			payload["admin_secret"] = self.admin_secret
+
+		response = self.session.post(url, json=payload, timeout=get_timeout(read=ADMIN_TIMEOUT))
+		response.raise_for_status()
+		data = response.json()
+
+		if data.get("janus") != "success":
+			raise Exception(f"Janus Admin API {janus} failed: {data}")
+
+		return data
+
+	def list_sessions(self):
+		return self.request("list_sessions").get("sessions") or []
+
+	def list_handles(self, session_id):
+		return self.request("list_handles", session_id).get("handles") or []
+
+	def handle_info(self, session_id, handle_id):
+		return self.request("handle_info", session_id, handle_id).get("info") or {}
+
+
+class CallMedia:
+	"""Samples of one call, over all of its participant handles"""
+
+	def __init__(self):
+		self.recent = {metric: deque(maxlen=SAMPLES_PER_CALL) for metric in METRICS}
+		self.totals = {metric: [0, 0.0, 0.0] for metric in METRICS}  # count, sum, max
+		self.counters = {}  # handle -> (packets received, packets lost)
+		self.samples = 0
+
+	def add(self, handle_id, stats):
+		"""Add one handle's stats (cumulative counters from read_media_stats)"""
+		previous = self.counters.get(handle_id)
+		self.counters[handle_id] = (stats["packets"], stats["lost"])
+
+		if previous:
+			# Loss over the last interval, not since the start of the call
+			received = stats["packets"] - previous[0]
+			lost = max(stats["lost"] - previous[1], 0)
+			if received + lost > 0:
+				self.record("loss", lost * 100 / (received + lost))
+
+		self.record("jitter", stats["jitter"])
+		if stats["rtt"]:
+			self.record("rtt", stats["rtt"])
+		self.record("bitrate", stats["bitrate"])
+		self.samples += 1
+
+	def record(self, metric, value):
+		self.recent[metric].append(value)
+		total = self.totals[metric]
+		total[0] += 1
+		total[1] += value
+		total[2] = max(total[2], value)
+
+	def summary(self):
+		"""Compact summary for the call record, with its derived quality"""
+		summary = {"samples": self.samples}
+		for metric in METRICS:
+			count, value_sum, value_max = self.totals[metric]
+			summary[metric] = {
+				"avg": round(value_sum / count, 2) if count else None,
+				"p95": round(percentile(self.recent[metric], 95), 2) if count else None,
+				"max": round(value_max, 2) if count else None
+			}
+
+		mos = estimate_mos(
+			rtt=summary["rtt"]["avg"] or 0,
+			jitter=summary["jitter"]["avg"] or 0,
+			loss=summary["loss"]["avg"] or 0
+		)
+		summary["mos"] = round(mos, 2)
+		summary["quality"] = get_quality(mos)
+		return summary
+
+	def to_dict(self):
+		return {
+			"recent": {metric: list(values) for metric, values in self.recent.items()},
+			"totals": self.totals,
+			"counters": self.counters,
+			"samples": self.samples
+		}
+
+	@classmethod
+	def from_dict(cls, data):
+		media = cls()
+		for metric in METRICS:
+			media.recent[metric].extend(data["recent"][metric])
+		media.totals = data["totals"]
+		media.counters = data["counters"]
+		media.samples = data["samples"]
+		return media
+
+
+class MediaSampler:
+	"""Samples answered calls and writes their summary when they end"""
+
+	def __init__(self):
+		self.calls = {}  # WhatsApp Call name -> CallMedia
+
+	def tick(self):
+		"""Take one sample of every answered call and finish calls that ended"""
+		active = frappe.get_all(
+			"WhatsApp Call",
+			filters={"status": "Answered", "janus_room_id": ["is", "set"]},
+			fields=["name", "janus_room_id", "janus_node"]
+		)
+
+		rooms_by_node = {}
+		for call in active:
+			rooms_by_node.setdefault(call.janus_node or None, {})[str(call.janus_room_id)] = call.name
+
+		for node, rooms in rooms_by_node.items():
+			try:
+				self.sample_node(node, rooms)
+			except Exception as e:
+				frappe.log_error(message=str(e), title=f"Media Telemetry Error ({node or 'default'})")
+
+		for name in set(self.calls) - {call.name for call in active}:
+			self.finish(name)
+
+	def sample_node(self, node, rooms):
+		"""Read the stats of the participant handles in `rooms` (room_id -> call)"""
+		config = get_node_config(node)
+		if not config["admin_url"]:
+			return
+
+		admin = JanusAdmin(config["admin_url"], config["admin_secret"])
+
+		for session_id in admin.list_sessions():
+			for handle_id in admin.list_handles(session_id):
+				info = admin.handle_info(session_id, handle_id)
+				if info.get("plugin") != AUDIOBRIDGE:
+					continue
+
+				call = rooms.get(str((info.get("plugin_specific") or {}).get("room") or ""))
+				stats = read_media_stats(info) if call else None
+				if stats:
+					self.calls.setdefault(call, CallMedia()).add(str(handle_id), stats)
+
+	def finish(self, name):
+		"""Write an ended call's summary and quality"""
+		media = self.calls.pop(name)
+		if not media.samples:
+			return
+
+		summary = media.summary()
+		frappe.db.set_value("WhatsApp Call", name, {
+			"media_stats": json.dumps(summary),
+			"call_quality": summary["quality"]
+		}, update_modified=False)
+
+	def hand_over(self):
+		"""Leave calls still in progress for the next run"""
+		if self.calls:
+			frappe.cache().set_value(
+				HANDOVER_KEY,
+				{name: media.to_dict() for name, media in self.calls.items()},
+				expires_in_sec=HANDOVER_TTL
+			)
+
+	def restore(self):
+		cache = frappe.cache()
+		for name, data in (cache.get_value(HANDOVER_KEY) or {}).items():
+			self.calls[name] = CallMedia.from_dict(data)
+		cache.delete_value(HANDOVER_KEY)
+
+
+def read_media_stats(info):
+	"""
+	Audio stats of a handle from its handle_info
+
+	Understands Janus 1.x ("webrtc" > "media") and 0.x ("streams" >
+	"components") layouts.
+
+	Returns:
+		dict with packets, lost (cumulative), jitter and rtt (ms), bitrate
+		(kbps), or None if the handle has no audio yet
+	"""
+	media = (info.get("webrtc") or {}).get("media")
+	if media:
+		for stream in (media.values() if isinstance(media, dict) else media):
+			if stream.get("type") == "audio":
+				return parse_stats(stream.get("in_stats") or {}, (stream.get("rtcp") or {}).get("main") or {}, "")
+
+	for stream in info.get("streams") or []:
+		for component in stream.get("components") or []:
+			rtcp = (component.get("rtcp_stats") or {}).get("audio")
+			if rtcp is not None:
+				return parse_stats(component.get("in_stats") or {}, rtcp, "audio_")
+
+	return None
+
+
+def parse_stats(in_stats, rtcp, prefix):
+	return {
+		"packets": cint(in_stats.get(f"{prefix}packets")),
+		"lost": cint(rtcp.get("lost")),
+		"jitter": flt(rtcp.get("jitter-local")),
+		"rtt": flt(rtcp.get("rtt")),
+		"bitrate": flt(in_stats.get(f"{prefix}bytes_lastsec")) * 8 / 1000
+	}
+
+
+def estimate_mos(rtt, jitter, loss):
+	"""
+	Mean Opinion Score (1-4.5) from a simplified ITU-T G.107 E-model
+
+	Args:
+		rtt: round-trip time, ms
+		jitter: ms
+		loss: packet loss, percent
+	"""
+	effective_latency = rtt / 2 + 2 * jitter + 10
+
+	if effective_latency < 160:
+		r = 93.2 - effective_latency / 40
+	else:
+		r = 93.2 - (effective_latency - 120) / 10
+
+	r = min(max(r - 2.5 * loss, 0), 100)
+	return 1 + 0.035 * r + 0.000007 * r * (r - 60) * (100 - r)
+
+
+def get_quality(mos):
+	for quality, threshold in QUALITY_THRESHOLDS:
+		if mos >= threshold:
+			return quality
+	return "Poor"
+
+
+def percentile(values, pct):
+	ordered = sorted(values)
+	if not ordered:
+		return 0
+	return ordered[min(int(len(ordered) * pct / 100), len(ordered) - 1)]
+
+
+def run_media_sampler():
+	"""
+	Background job: sample answered calls every few seconds for RUN_FOR
+	seconds, then hand unfinished calls over to the next run
+	"""
+	if not cint(get_settings().enable_media_telemetry):
+		return
+
+	cache = frappe.cache()
+	lock = cache.lock(cache.make_key(LOCK_KEY), timeout=RUN_FOR + 120)
+	if not lock.acquire(blocking=False):
+		return
+
+	sampler = MediaSampler()
+	try:
+		sampler.restore()
+		until = time.monotonic() + RUN_FOR
+
+		while time.monotonic() < until:
+			started = time.monotonic()
+
+			# Pick up settings changes: the version is otherwise cached per job
+			frappe.local.whatsapp_settings_version = None
+			settings = get_settings()
+			if not cint(settings.enable_media_telemetry):
+				break
+
+			sampler.tick()
+
+			# Also ends the transaction, so the next tick sees new calls
+			frappe.db.commit()
+
+			interval = cint(settings.media_sample_interval) or DEFAULT_SAMPLE_INTERVAL
+			time.sleep(max(interval - (time.monotonic() - started), 0))
+
+	except Exception as e:
+		frappe.log_error(message=str(e), title="Media Telemetry Error")
+
+	finally:
+		sampler.hand_over()
+		lock.release()
+
+
+def schedule_media_sampler():
+	"""
+	Scheduled task: keep the sampler job running while telemetry is enabled
+	"""
+	if not cint(get_settings().enable_media_telemetry):
+		return
+
+	frappe.enqueue(
+		"whatsapp_calling.whatsapp_calling.utils.media_telemetry.run_media_sampler",
+		queue="long",
+		timeout=RUN_FOR + 300,
+		job_id="whatsapp_media_telemetry",
+		deduplicate=True
+	)
@@ -0,0 +1,173 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Outbound WhatsApp Number selection
+
+Spreads a company's outbound traffic over its Active numbers instead of
+always using the first one. Each number is weighted by its headroom:
+
+- daily calls left under Daily Call Limit
+- budget left under Monthly Budget (Current Month Usage)
+- 1 / (1 + calls in progress on it)
+
+and one is drawn at random in proportion to its weight, so workers picking
+at the same moment do not all land on the same number.
+
+The number table comes from the process-local configuration snapshots
+(settings_cache.get_company_numbers). Load figures are kept per company in
+one Redis hash, rebuilt from the database at most every LOAD_TTL seconds
+and bumped for every call placed in between, so a pick costs one Redis
+round trip and no database query.
+"""
+
+import frappe
+import random
+import time
+from frappe.utils import cint, flt
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_company_numbers
+
+LOAD_KEY = "whatsapp_number_load:{0}"
+LOAD_TTL = 10  # seconds
+
+# Calls still holding a line on the number
+ACTIVE_STATUSES = ("Initiated", "Ringing", "Answered")
+
+
+def select_number(company, prefer=None):
+	"""
+	Pick the outbound WhatsApp Number with the most headroom (weighted draw)
+
+	Args:
+		company: company of the lead
+		prefer: names of numbers to choose among when the company has any of
+			them, e.g. those holding the customer's call permission
+
+	Returns:
+		ConfigSnapshot of the WhatsApp Number, or None if the company has no
+		Active number. When every number is out of headroom, the least busy
+		one is returned and limits are left to the callers.
+	"""
+	numbers = get_company_numbers(company)
+	if not numbers:
+		return None
+
+	load = get_load(company, numbers)
+
+	if prefer:
+		numbers = tuple(number for number in numbers if number.name in prefer) or numbers
+
+	weights = [get_weight(number, load.get(number.name)) for number in numbers]
+	if any(weights):
+		return random.choices(numbers, weights=weights)[0]
+
+	return min(numbers, key=lambda n: (load[n.name]["active"], load[n.name]["today"]))
+
+
+def get_weight(number, load):
+	"""Relative share of new calls for a number, 0 when it has no headroom"""
+	load = load or {"today": 0, "active": 0, "usage": 0}
+	weight = 1 / (1 + load["active"])
+
+	daily_limit = cint(number.daily_call_limit)
+	if daily_limit:
+		weight *= max(daily_limit - load["today"], 0) / daily_limit
+
+	budget = flt(number.monthly_budget)
+	if budget:
+		weight *= max(budget - load["usage"], 0) / budget
+
+	return weight
+
+
+def get_load(company, numbers):
+	"""
+	Calls today, calls in progress and month usage per number
+
+	Returns:
+		dict of number name -> {"today", "active", "usage"}
+	"""
+	try:
+		cache = frappe.cache()
+		key = cache.make_key(LOAD_KEY.format(company))
+
+		# Raw read: RedisWrapper.hgetall would unpickle the values
+		pipe = cache.pipeline(transaction=False)
+		pipe.hgetall(key)
+		values = {k.decode(): v.decode() for k, v in pipe.execute()[0].items()}
+
+		if time.time() - flt(values.get("refreshed_at")) < LOAD_TTL:
+			return {
+				number.name: {
+					"today": cint(values.get(f"{number.name}:today")),
+					"active": cint(values.get(f"{number.name}:active")),
+					"usage": flt(values.get(f"{number.name}:usage"))
+				}
+				for number in numbers
+			}
+
+	except Exception:
+		# Without Redis, read the database every time
+		return load_from_db(numbers)
+
+	load = load_from_db(numbers)
+	store_load(key, load)
+	return load
+
+
+def load_from_db(numbers):
+	"""One grouped query over today's calls, one over the numbers' usage"""
+	names = [number.name for number in numbers]
+	load = {name: {"today": 0, "active": 0, "usage": 0} for name in names}
+
+	for row in frappe.db.sql("""
+		SELECT
+			business_number,
+			SUM(CASE WHEN direction = 'Outbound' THEN 1 ELSE 0 END) as today,
+			SUM(CASE WHEN status IN %(active)s THEN 1 ELSE 0 END) as active
+		FROM `tabWhatsApp Call`
+		WHERE business_number IN %(names)s AND initiated_at >= %(today)s
+		GROUP BY business_number
+	""", {"names": names, "active": ACTIVE_STATUSES, "today": frappe.utils.today()}, as_dict=True):
+		load[row.business_number].update(today=cint(row.today), active=cint(row.active))
+
+	for row in frappe.get_all(
+		"WhatsApp Number",
+		filters={"name": ["in", names]},
+		fields=["name", "current_month_usage"]
+	):
+		load[row.name]["usage"] = flt(row.current_month_usage)
+
+	return load
+
+
+def store_load(key, load):
+	try:
+		cache = frappe.cache()
+		mapping = {"refreshed_at": time.time()}
+		for name, figures in load.items():
+			for field, value in figures.items():
+				mapping[f"{name}:{field}"] = value
+
+		pipe = cache.pipeline(transaction=False)
+		pipe.delete(key)
+		pipe.hset(key, mapping=mapping)
+		pipe.expire(key, LOAD_TTL * 6)
+		pipe.execute()
+	except Exception:
+		pass
+
+
+def record_call(company, name):
+	"""Count a call placed on a number in the cached load, until the next rebuild"""
+	try:
+		cache = frappe.cache()
+		key = cache.make_key(LOAD_KEY.format(company))
+
+		pipe = cache.pipeline(transaction=False)
+		pipe.hincrby(key, f"{name}:today", 1)
+		pipe.hincrby(key, f"{name}:active", 1)
+		pipe.expire(key, LOAD_TTL * 6)
+		pipe.execute()
+	except Exception:
+		pass
@@ -0,0 +1,294 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Permission request campaigns
+
+Sends the call permission template to every Lead matching a campaign's
+filters, from a background job on the `long` queue:
+
+- Leads are read in batches in name order; after each batch the campaign
+  records the last Lead and its counters (checkpoint), so a paused,
+  failed or interrupted campaign resumes where it stopped.
+- Each batch is prechecked in bulk against the Call Permission rows
+  (already granted, or at the 1 per 24h / 2 per 7 days request limits on
+  the mirrored counters), then every remaining number takes a request on
+  the shared sliding-window limiter, atomically (utils/rate_limiter).
+- Templates go out concurrently through AsyncWhatsAppAPI, paced by a
+  token bucket per WhatsApp Number (Template Sends per Second) shared by
+  all workers.
+- Call Permission rows are upserted per batch: one UPDATE for existing
+  rows and one bulk INSERT for new ones.
+"""
+
+import frappe
+import json
+from frappe import _
+from frappe.query_builder import Case
+from frappe.utils import flt
+from whatsapp_calling.whatsapp_calling.api.permissions import PERMISSION_REQUEST_COMPONENTS
+from whatsapp_calling.whatsapp_calling.utils.rate_limiter import (
+	TokenBucket,
+	get_subject,
+	mirror_seed,
+	permission_request_limiter
+)
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_number
+from whatsapp_calling.whatsapp_calling.utils.whatsapp_async import AsyncWhatsAppAPI, run_async
+
+BATCH_SIZE = 200
+JOB_TIMEOUT = 6 * 60 * 60
+DEFAULT_SEND_RATE = 20  # templates per second per number
+
+PERMISSION_FIELDS = [
+	"name", "creation", "modified", "owner", "modified_by",
+	"customer_number", "business_number", "company", "lead", "permission_status",
+	"request_sent_at", "requests_in_24h", "requests_in_7d", "calls_in_24h"
+]
+
+
+def enqueue_campaign(campaign):
+	"""Start (or resume) a campaign's job once the current transaction commits"""
+	frappe.enqueue(
+		"whatsapp_calling.whatsapp_calling.utils.permission_campaign.run_campaign",
+		queue="long",
+		timeout=JOB_TIMEOUT,
+		job_id=f"permission_request_campaign::{campaign}",
+		deduplicate=True,
+		enqueue_after_commit=True,
+		campaign=campaign
+	)
+
+
+def run_campaign(campaign):
+	"""
+	Background job: send a campaign's permission requests from its checkpoint
+
+	Stops between batches when the campaign is paused.
+	"""
+	doc = frappe.get_doc("Permission Request Campaign", campaign)
+	if doc.status not in ("Queued", "Running"):
+		return
+
+	try:
+		doc.db_set({
+			"status": "Running",
+			"started_at": doc.started_at or frappe.utils.now(),
+			"total_leads": frappe.db.count("Lead", get_lead_filters(doc)),
+			"error": None
+		})
+		frappe.db.commit()
+
+		number = get_number(doc.business_number)
+		if not number:
+			frappe.throw(_("WhatsApp Number {0} not found").format(doc.business_number))
+
+		bucket = TokenBucket("template_sends", flt(number.template_send_rate) or DEFAULT_SEND_RATE)
+
+		while True:
+			# Paused (or otherwise stopped) from the desk
+			if frappe.db.get_value("Permission Request Campaign", campaign, "status") not in ("Queued", "Running"):
+				return
+
+			leads = frappe.get_all(
+				"Lead",
+				filters=get_lead_filters(doc, after=doc.last_lead),
+				fields=["name", "mobile_no"],
+				order_by="name asc",
+				limit_page_length=BATCH_SIZE
+			)
+			if not leads:
+				break
+
+			counts = process_batch(doc, number, bucket, leads)
+
+			# Checkpoint
+			doc.db_set({
+				"last_lead": leads[-1].name,
+				"processed_leads": (doc.processed_leads or 0) + len(leads),
+				"sent_count": (doc.sent_count or 0) + counts["sent"],
+				"skipped_count": (doc.skipped_count or 0) + counts["skipped"],
+				"failed_count": (doc.failed_count or 0) + counts["failed"]
+			}, update_modified=False)
+			frappe.db.commit()
+
+		doc.db_set({"status": "Completed", "completed_at": frappe.utils.now()})
+		frappe.db.commit()
+
+		frappe.logger().info(f"Permission request campaign {campaign}: sent {doc.sent_count}, skipped {doc.skipped_count}, failed {doc.failed_count}")
+
+	except Exception as e:
+		frappe.db.rollback()
+		frappe.db.set_value("Permission Request Campaign", campaign, {"status": "Failed", "error": str(e)})
+		frappe.db.commit()
+		frappe.log_error(message=frappe.get_traceback(), title="Permission Request Campaign Error")
+
+
+def get_lead_filters(doc, after=None):
+	"""The campaign's Lead filters as a list, scoped to its company"""
+	filters = [["company", "=", doc.company], ["mobile_no", "is", "set"]]
+
+	custom = json.loads(doc.lead_filters) if doc.lead_filters else {}
+	if isinstance(custom, dict):
+		for field, value in custom.items():
+			filters.append([field, *value] if isinstance(value, list) else [field, "=", value])
+	else:
+		filters += custom
+
+	if after:
+		filters.append(["name", ">", after])
+
+	return filters
+
+
+def process_batch(doc, number, bucket, leads):
+	"""
+	Precheck, send and record one batch of Leads
+
+	Returns:
+		dict with sent, skipped, failed counts
+	"""
+	counts = {"sent": 0, "skipped": 0, "failed": 0}
+
+	# One request per number; the first Lead with it gets the row
+	lead_by_number = {}
+	for lead in leads:
+		mobile = (lead.mobile_no or "").strip()
+		if not mobile or mobile in lead_by_number:
+			counts["skipped"] += 1
+			continue
+		lead_by_number[mobile] = lead.name
+
+	existing = {
+		row.customer_number: row
+		for row in frappe.get_all(
+			"Call Permission",
+			filters={"customer_number": ["in", list(lead_by_number)], "business_number": doc.business_number},
+			fields=["name", "customer_number", "permission_status", "expires_at", "requests_in_24h", "requests_in_7d", "request_sent_at"]
+		)
+	} if lead_by_number else {}
+
+	# Bulk precheck on the mirrored counters, then the atomic limiter
+	now = frappe.utils.now_datetime()
+	reserved = {}
+	for mobile in lead_by_number:
+		row = existing.get(mobile)
+		if row and not needs_request(row, now):
+			counts["skipped"] += 1
+			continue
+
+		usage = permission_request_limiter.hit(
+			get_subject(doc.business_number, mobile),
+			seed=mirror_seed(row.requests_in_7d, row.request_sent_at) if row else None
+		)
+		if not usage["allowed"]:
+			counts["skipped"] += 1
+			continue
+
+		reserved[mobile] = usage
+
+	results = run_async(send_templates(number, bucket, doc.template_name, list(reserved))) if reserved else {}
+
+	sent = {}
+	for mobile, result in results.items():
+		if isinstance(result, Exception):
+			# Not sent: the request does not count
+			permission_request_limiter.undo(get_subject(doc.business_number, mobile), reserved[mobile]["member"])
+			counts["failed"] += 1
+		else:
+			sent[mobile] = reserved[mobile]["counts"]
+
+	upsert_permissions(doc, sent, lead_by_number, existing)
+	counts["sent"] = len(sent)
+	return counts
+
+
+def needs_request(permission, now):
+	"""Whether a number with a Call Permission row can be asked again"""
+	if permission.permission_status == "Granted" and (not permission.expires_at or permission.expires_at > now):
+		return False
+
+	if permission.request_sent_at:
+		hours_since = (now - permission.request_sent_at).total_seconds() / 3600
+		if hours_since < 24 and (permission.requests_in_24h or 0) >= 1:
+			return False
+		if hours_since < 168 and (permission.requests_in_7d or 0) >= 2:
+			return False
+
+	return True
+
+
+async def send_templates(number, bucket, template_name, mobiles):
+	"""
+	Send the permission template to many numbers, paced by the number's bucket
+
+	Returns:
+		dict of number -> Graph reply, or the exception it failed with
+	"""
+	api = AsyncWhatsAppAPI(number.phone_number_id, number.access_token)
+	results = {}
+
+	async with api:
+		for start in range(0, len(mobiles), bucket.burst):
+			group = mobiles[start:start + bucket.burst]
+			await bucket.wait_async(number.name, len(group))
+
+			replies = await api.gather(
+				api.send_template(mobile, template_name, PERMISSION_REQUEST_COMPONENTS) for mobile in group
+			)
+			results.update(zip(group, replies))
+
+	return results
+
+
+def upsert_permissions(doc, sent, lead_by_number, existing):
+	"""
+	Record sent requests: one UPDATE for existing rows, one INSERT for new ones
+
+	Args:
+		sent: number -> limiter counts (requests in 24h, in 7d) after the send
+	"""
+	now = frappe.utils.now()
+	user = frappe.session.user
+
+	updates = {existing[mobile].name: window for mobile, window in sent.items() if mobile in existing}
+	if updates:
+		Permission = frappe.qb.DocType("Call Permission")
+		in_24h, in_7d = Case(), Case()
+		for name, window in updates.items():
+			in_24h = in_24h.when(Permission.name == name, window[0])
+			in_7d = in_7d.when(Permission.name == name, window[1])
+
+		(
+			frappe.qb.update(Permission)
+			.set(Permission.requests_in_24h, in_24h)
+			.set(Permission.requests_in_7d, in_7d)
+			.set(Permission.request_sent_at, now)
+			.set(Permission.modified, now)
+			.set(Permission.modified_by, user)
+			.where(Permission.name.isin(list(updates)))
+		).run()
+
+	values = []
+	for mobile, window in sent.items():
+		if mobile in existing:
+			continue
+
+		permission = frappe.get_doc({
+			"doctype": "Call Permission",
+			"customer_number": mobile,
+			"business_number": doc.business_number,
+			"company": doc.company,
+			"lead": lead_by_number[mobile],
+			"permission_status": "Requested"
+		})
+		permission.set_new_name()
+
+		values.append((
+			permission.name, now, now, user, user,
+			mobile, doc.business_number, doc.company, lead_by_number[mobile], "Requested",
+			now, window[0], window[1], 0
+		))
+
+	if values:
+		frappe.db.bulk_insert("Call Permission", fields=PERMISSION_FIELDS, values=values)
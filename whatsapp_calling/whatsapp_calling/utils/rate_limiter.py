@@ -0,0 +1,364 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Sliding-window limits for calls and permission requests
+
+WhatsApp allows 5 business-initiated calls per 24 hours after a customer
+grants permission, and 1 permission request per 24 hours / 2 per 7 days.
+Each (business number, customer) pair has one Redis sorted set per limit,
+holding the timestamps of its events. A Lua script drops expired events,
+checks every window and records the new event in one atomic step, so
+concurrent dials from different workers cannot slip past a limit, and a
+check costs a single Redis round trip.
+
+The counters on Call Permission (calls_in_24h, requests_in_24h,
+requests_in_7d) are a durable mirror written after each event. When Redis
+has lost a key (flush, restart without persistence), the script rebuilds
+it from the mirror passed along as seed events. For calls, the mirror also
+keeps the times of the last few events (`recent_calls`, a JSON list as
+long as the largest limit), so the 24h window can be evaluated exactly on
+read, without Redis and without any counter reset.
+
+Throughput limits (e.g. template sends per WhatsApp Number) use a token
+bucket, also one Lua script call per take.
+
+With `whatsapp_rate_limit_store: "local"` in site_config.json, or in tests,
+an in-process store with the same behaviour stands in for Redis.
+"""
+
+import asyncio
+import frappe
+import json
+import math
+import secrets
+import threading
+import time
+
+DAY = 24 * 60 * 60
+
+# Sliding-window counter in one sorted set; member scores are epoch ms.
+# KEYS[1]: the set
+# ARGV: now, member, add (0/1), seed count, seed scores..., then
+#       (window ms, limit) pairs
+# Returns {allowed (0/1), retry after ms, count per window}
+SLIDING_WINDOW_SCRIPT = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local member = ARGV[2]
+local add = tonumber(ARGV[3])
+local seeds = tonumber(ARGV[4])
+
+if seeds > 0 and redis.call('EXISTS', key) == 0 then
+	for i = 1, seeds do
+		redis.call('ZADD', key, tonumber(ARGV[4 + i]), 'seed:' .. i)
+	end
+end
+
+local allowed = 1
+local retry = 0
+local longest = 0
+local counts = {}
+
+for i = 5 + seeds, #ARGV, 2 do
+	local window = tonumber(ARGV[i])
+	local limit = tonumber(ARGV[i + 1])
+	if window > longest then longest = window end
+
+	local count = redis.call('ZCOUNT', key, '(' .. (now - window), '+inf')
+	if add == 1 and count >= limit then
+		allowed = 0
+		local oldest = redis.call('ZRANGEBYSCORE', key, '(' .. (now - window), '+inf', 'WITHSCORES', 'LIMIT', 0, count - limit + 1)
+		local wait = tonumber(oldest[#oldest]) + window - now
+		if wait > retry then retry = wait end
+	end
+	counts[#counts + 1] = count
+end
+
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - longest)
+
+if add == 1 and allowed == 1 then
+	redis.call('ZADD', key, now, member)
+	for i = 1, #counts do counts[i] = counts[i] + 1 end
+end
+
+if redis.call('EXISTS', key) == 1 then
+	redis.call('PEXPIRE', key, longest)
+end
+
+local result = {allowed, retry}
+for i = 1, #counts do result[#result + 1] = counts[i] end
+return result
+"""
+
+
+class SlidingWindowLimiter:
+	"""
+	Limits on events per subject over one or more sliding windows
+
+	Args:
+		name: limit name, part of the Redis key
+		windows: tuple of (window seconds, max events)
+	"""
+
+	def __init__(self, name, windows):
+		self.name = name
+		self.windows = tuple(windows)
+
+	def hit(self, subject, seed=None):
+		"""
+		Record an event unless it would exceed a window (atomic)
+
+		Args:
+			subject: e.g. "<business number>:<customer number>"
+			seed: epoch seconds of past events, used only if the store has
+				lost the subject (from the database mirror)
+
+		Returns:
+			dict with allowed, retry_after (seconds), counts (per window,
+			including this event when allowed), member (to undo the event)
+		"""
+		member = f"{int(time.time() * 1000)}:{secrets.token_hex(4)}"
+		result = self._apply(subject, member, True, seed)
+		result["member"] = member if result["allowed"] else None
+		return result
+
+	def peek(self, subject, seed=None):
+		"""Current counts, and whether a hit would be allowed; records nothing"""
+		result = self._apply(subject, None, False, seed)
+		result["allowed"] = all(count < limit for count, (window, limit) in zip(result["counts"], self.windows))
+		return result
+
+	def undo(self, subject, member):
+		"""Take back an event recorded by hit, e.g. when the dial failed"""
+		if member:
+			get_store().remove(self.key(subject), member)
+
+	def reset(self, subject):
+		"""Forget every event of a subject"""
+		get_store().clear(self.key(subject))
+
+	def key(self, subject):
+		return f"whatsapp_limit:{self.name}:{subject}"
+
+	def push_recent(self, recent, at=None):
+		"""
+		Add an event to a recent-events mirror
+
+		Args:
+			recent: JSON list of epoch seconds, as stored, or None
+			at: epoch seconds of the event (default: now)
+
+		Returns:
+			str: the mirror with the event, keeping as many as the largest limit
+		"""
+		events = load_recent(recent)
+		events.append(at or time.time())
+		return json.dumps(events[-max(limit for window, limit in self.windows):])
+
+	def count_recent(self, recent, now=None):
+		"""Events per window in a recent-events mirror; read-only"""
+		now = now or time.time()
+		events = load_recent(recent)
+		return [sum(1 for at in events if at > now - window) for window, limit in self.windows]
+
+	def recent_seed(self, recent, now=None):
+		"""Seed events for hit/peek from a recent-events mirror"""
+		now = now or time.time()
+		longest = max(window for window, limit in self.windows)
+		return [at for at in load_recent(recent) if at > now - longest] or None
+
+	def _apply(self, subject, member, add, seed):
+		now = int(time.time() * 1000)
+		windows = [(int(window * 1000), limit) for window, limit in self.windows]
+		seed = [int(ts * 1000) for ts in (seed or ())]
+
+		allowed, retry_ms, *counts = get_store().apply(self.key(subject), now, member or "", add, seed, windows)
+		return {
+			"allowed": bool(allowed),
+			"retry_after": (int(retry_ms) + 999) // 1000,
+			"counts": [int(count) for count in counts]
+		}
+
+
+# Token bucket in one hash (tokens, ts), refilled from Redis' own clock so
+# every worker agrees on time.
+# KEYS[1]: the bucket
+# ARGV: rate (tokens per second), burst (capacity), tokens wanted
+# Returns ms to wait before the tokens are available (0: taken now)
+TOKEN_BUCKET_SCRIPT = """
+local key = KEYS[1]
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local wanted = tonumber(ARGV[3])
+
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+
+local state = redis.call('HMGET', key, 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate / 1000)
+
+local wait = 0
+if tokens >= wanted then
+	tokens = tokens - wanted
+else
+	wait = math.ceil((wanted - tokens) * 1000 / rate)
+end
+
+redis.call('HSET', key, 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', key, math.ceil(burst * 1000 / rate) + 1000)
+return wait
+"""
+
+
+class TokenBucket:
+	"""
+	Throughput limit shared by all workers, e.g. template sends per number
+
+	Args:
+		name: bucket name, part of the Redis key
+		rate: tokens added per second
+		burst: bucket capacity (default: one second's worth)
+	"""
+
+	def __init__(self, name, rate, burst=None):
+		self.name = name
+		self.rate = float(rate)
+		self.burst = max(int(burst or rate), 1)
+
+	def take(self, subject, tokens=1):
+		"""
+		Take `tokens` (at most `burst`) if available, all or nothing
+
+		Returns:
+			float: 0 if taken, else seconds to wait before asking again
+		"""
+		tokens = min(tokens, self.burst)
+		return get_store().take(f"whatsapp_bucket:{self.name}:{subject}", self.rate, self.burst, tokens) / 1000
+
+	async def wait_async(self, subject, tokens=1):
+		"""Take `tokens`, sleeping (asyncio) until the bucket has them"""
+		while True:
+			wait = self.take(subject, tokens)
+			if not wait:
+				return
+			await asyncio.sleep(wait)
+
+
+class RedisWindowStore:
+	"""Sorted sets in the site's Redis cache, updated by SLIDING_WINDOW_SCRIPT"""
+
+	def __init__(self):
+		self.cache = frappe.cache()
+
+	def apply(self, key, now, member, add, seed, windows):
+		script = self.cache.register_script(SLIDING_WINDOW_SCRIPT)
+		args = [now, member, int(add), len(seed), *seed]
+		for window, limit in windows:
+			args += [window, limit]
+		return script(keys=[self.cache.make_key(key)], args=args)
+
+	def take(self, key, rate, burst, tokens):
+		script = self.cache.register_script(TOKEN_BUCKET_SCRIPT)
+		return int(script(keys=[self.cache.make_key(key)], args=[rate, burst, tokens]))
+
+	def remove(self, key, member):
+		self.cache.zrem(self.cache.make_key(key), member)
+
+	def clear(self, key):
+		self.cache.delete(self.cache.make_key(key))
+
+
+class LocalWindowStore:
+	"""In-process stand-in for RedisWindowStore, for tests and single-process setups"""
+
+	def __init__(self):
+		self.sets = {}
+		self.buckets = {}
+		self.lock = threading.Lock()
+
+	def apply(self, key, now, member, add, seed, windows):
+		with self.lock:
+			events = self.sets.get(key)
+			if not events and seed:
+				events = self.sets[key] = {f"seed:{i}": score for i, score in enumerate(seed, 1)}
+			events = events if events is not None else {}
+
+			allowed, retry, counts = 1, 0, []
+			for window, limit in windows:
+				scores = sorted(score for score in events.values() if score > now - window)
+				if add and len(scores) >= limit:
+					allowed = 0
+					retry = max(retry, scores[len(scores) - limit] + window - now)
+				counts.append(len(scores))
+
+			longest = max(window for window, limit in windows)
+			events = {m: score for m, score in events.items() if score > now - longest}
+
+			if add and allowed:
+				events[member] = now
+				counts = [count + 1 for count in counts]
+
+			self.sets[key] = events
+			return [allowed, retry, *counts]
+
+	def take(self, key, rate, burst, tokens):
+		with self.lock:
+			now = time.monotonic()
+			available, ts = self.buckets.get(key, (burst, now))
+			available = min(burst, available + (now - ts) * rate)
+
+			wait = 0
+			if available >= tokens:
+				available -= tokens
+			else:
+				wait = math.ceil((tokens - available) * 1000 / rate)
+
+			self.buckets[key] = (available, now)
+			return wait
+
+	def remove(self, key, member):
+		with self.lock:
+			self.sets.get(key, {}).pop(member, None)
+
+	def clear(self, key):
+		with self.lock:
+			self.sets.pop(key, None)
+
+
+_local_store = LocalWindowStore()
+
+
+def get_store():
+	if frappe.flags.in_test or frappe.conf.get("whatsapp_rate_limit_store") == "local":
+		return _local_store
+	return RedisWindowStore()
+
+
+# WhatsApp Business calling limits, per (business number, customer)
+call_limiter = SlidingWindowLimiter("calls", ((DAY, 5),))
+permission_request_limiter = SlidingWindowLimiter("permission_requests", ((DAY, 1), (7 * DAY, 2)))
+
+
+def get_subject(business_number, customer_number):
+	return f"{business_number}:{customer_number}"
+
+
+def load_recent(recent):
+	"""Event times (epoch seconds) of a recent-events mirror"""
+	try:
+		return [float(at) for at in json.loads(recent)] if recent else []
+	except (TypeError, ValueError):
+		return []
+
+
+def mirror_seed(count, last_event_at):
+	"""
+	Seed events from a Call Permission mirror: `count` events at the time of
+	the last one (conservative, as their real times are not kept)
+	"""
+	if not count or not last_event_at:
+		return None
+	return [frappe.utils.get_datetime(last_event_at).timestamp()] * int(count)
@@ -0,0 +1,314 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Pool of ready Janus AudioBridge rooms
+
+Setting up a room costs a Janus round trip on the critical path of
+make_call and answer_call. The pool keeps rooms ready in a Redis list per
+Janus node, shared by all workers, so taking one is a single LPOP.
+
+- Leases are health-checked: a room not checked recently is looked up
+  with an AudioBridge `exists` first (Janus loses rooms when it
+  restarts), and dead entries are thrown away.
+- A background job tops the pool back up when it falls to the low-water
+  mark, and the scheduler does the same every few minutes.
+- When a call ends its room is emptied (kick_all) and goes back to the
+  pool instead of being destroyed, as long as the pool is not full.
+
+Every room given to a call is recorded as leased, pooled or not, so ready
+plus leased rooms are a node's load for placement (see utils/janus_nodes).
+
+Pool size and low-water mark are set in WhatsApp Settings (Janus section)
+and apply to each node; a size of 0 disables the pool and every call sets
+up its own room. So does call recording, which must not outlive a call.
+"""
+
+import frappe
+import json
+import time
+from frappe.utils import cint
+from whatsapp_calling.whatsapp_calling.api.janus_client import JanusClient
+from whatsapp_calling.whatsapp_calling.utils.janus_nodes import get_placement_nodes, pick_node
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_janus_nodes, get_settings
+
+# Formatted with the Janus Node name, or DEFAULT_NODE for WhatsApp Settings' server
+POOL_KEY = "whatsapp_janus_room_pool:{0}"
+LEASED_KEY = "whatsapp_janus_room_leases:{0}"
+REFILL_LOCK_KEY = "whatsapp_janus_room_pool_refill"
+
+DEFAULT_NODE = "default"
+
+HEALTH_CHECK_AFTER = 30  # seconds
+REFILL_LOCK_TIMEOUT = 120
+
+
+def acquire_room():
+	"""
+	Lease a ready room for a call on the least-loaded Janus node
+
+	Falls back to setting up a room directly when the pool is disabled or
+	empty, so calls never wait for the pool.
+
+	Returns:
+		dict with session_id, handle_id, room_id, janus_node (None without
+		Janus Nodes)
+	"""
+	node = pick_node(count_rooms)
+	size, low_water = get_pool_limits()
+
+	cache = frappe.cache()
+	janus = JanusClient(node)
+	pool_key = get_pool_key(node)
+
+	room = None
+	while size and room is None:
+		raw = cache.lpop(pool_key)
+		if raw is None:
+			break
+
+		entry = json.loads(raw)
+		if is_usable(entry, janus):
+			room = entry
+		else:
+			discard_room(entry, janus)
+
+	if size and cache.llen(pool_key) <= low_water:
+		schedule_refill()
+
+	if room is None:
+		room = dict(janus.setup_call_room(), record=cint(get_settings().enable_call_recording))
+
+	room["leased_at"] = time.time()
+	cache.hset(get_leased_key(node), str(room["room_id"]), room)
+
+	return {
+		"session_id": room["session_id"],
+		"handle_id": room["handle_id"],
+		"room_id": room["room_id"],
+		"janus_node": node
+	}
+
+
+def release_room(room_id, session_id=None, node=None):
+	"""
+	Return a call's room to the pool, or destroy it if it cannot be reused
+
+	Args:
+		room_id: Janus room of the ended call
+		session_id: its Janus session, used when the lease is unknown
+		node: Janus Node the room is on (the call's janus_node)
+
+	Returns:
+		bool: True if the room went back to the pool (it now belongs to the
+		pool and may be leased to another call)
+	"""
+	if not room_id:
+		return False
+
+	cache = frappe.cache()
+	leased_key = get_leased_key(node)
+	entry = cache.hget(leased_key, str(room_id))
+	cache.hdel(leased_key, str(room_id))
+
+	janus = JanusClient(node)
+	if entry is None:
+		# Not leased (or leased before the pool existed): destroy as before
+		janus.destroy_room(session_id, room_id)
+		return False
+
+	size, low_water = get_pool_limits()
+	pool_key = get_pool_key(node)
+
+	if (
+		accepts_rooms(node)
+		and cache.llen(pool_key) < size
+		and is_usable(entry, janus)
+		and janus.kick_all(entry["room_id"])
+	):
+		entry.pop("leased_at", None)
+		entry["checked_at"] = time.time()
+		cache.rpush(pool_key, json.dumps(entry))
+		return True
+
+	discard_room(entry, janus)
+	return False
+
+
+def count_rooms(node):
+	"""Rooms a node holds: ready in its pool plus leased to calls"""
+	cache = frappe.cache()
+	return cache.llen(get_pool_key(node)) + cache.hlen(cache.make_key(get_leased_key(node)))
+
+
+def accepts_rooms(node):
+	"""
+	Whether a node may keep ready rooms (Draining and Disabled nodes may not)
+
+	WhatsApp Settings' server (None) only does while no Janus Nodes are
+	registered; once they are, it is drained like a Draining node.
+	"""
+	if node is None:
+		return not get_janus_nodes()
+	return node in get_placement_nodes()
+
+
+def get_pool_nodes():
+	"""
+	Every node that may hold rooms: the Janus Nodes and WhatsApp Settings'
+	server (None), which keeps rooms leased before nodes were registered
+	until they are released
+	"""
+	return [*get_janus_nodes(), None]
+
+
+def is_usable(entry, janus):
+	"""Health check for a pooled room; keepalive only when it may have expired"""
+	if cint(entry.get("record")) != cint(get_settings().enable_call_recording):
+		# Recording settings changed since the room was created
+		return False
+
+	if time.time() - (entry.get("checked_at") or 0) < HEALTH_CHECK_AFTER:
+		return True
+
+	if janus.room_exists(entry["room_id"]):
+		entry["checked_at"] = time.time()
+		return True
+
+	return False
+
+
+def discard_room(entry, janus):
+	janus.destroy_room(entry["session_id"], entry["room_id"])
+
+
+def schedule_refill():
+	"""Enqueue a refill unless one is already queued or running"""
+	frappe.enqueue(
+		"whatsapp_calling.whatsapp_calling.utils.room_pool.refill_room_pool",
+		queue="short",
+		job_id="whatsapp_janus_room_pool_refill",
+		deduplicate=True
+	)
+
+
+def refill_room_pool():
+	"""
+	Scheduled task: Drop pooled rooms Janus no longer has and top the pools up
+
+	Runs every few minutes and whenever an acquire leaves a pool at or
+	below the low-water mark. Nodes that stopped taking new calls
+	(Draining, Disabled or unhealthy) have their ready rooms destroyed.
+	"""
+	cache = frappe.cache()
+	lock = cache.lock(cache.make_key(REFILL_LOCK_KEY), timeout=REFILL_LOCK_TIMEOUT)
+	if not lock.acquire(blocking=False):
+		return
+
+	try:
+		size, low_water = get_pool_limits()
+		for node in get_pool_nodes():
+			if size and accepts_rooms(node):
+				refill_node(node, size)
+			else:
+				drain_node(node)
+
+	finally:
+		lock.release()
+
+
+def refill_node(node, size):
+	"""Sweep one node's pool and top it up, within the node's Max Rooms"""
+	cache = frappe.cache()
+	janus = JanusClient(node)
+	pool_key = get_pool_key(node)
+	record = cint(get_settings().enable_call_recording)
+	max_rooms = cint(get_janus_nodes()[node].max_rooms) if node else 0
+
+	# Sweep: drop entries whose room has gone
+	dropped = 0
+	for raw in cache.lrange(pool_key, 0, -1):
+		entry = json.loads(raw)
+		if cint(entry.get("record")) != record or not janus.room_exists(entry["room_id"]):
+			# LREM fails if an acquire took the entry meanwhile
+			if cache.lrem(cache.make_key(pool_key), 1, raw):
+				discard_room(entry, janus)
+				dropped += 1
+
+	created = 0
+	while cache.llen(pool_key) < size and not (max_rooms and count_rooms(node) >= max_rooms):
+		try:
+			room = dict(janus.setup_call_room(), record=record, checked_at=time.time())
+		except Exception as e:
+			frappe.log_error(message=str(e), title="Janus Room Pool Refill Error")
+			break
+
+		cache.rpush(pool_key, json.dumps(room))
+		created += 1
+
+	if created or dropped:
+		frappe.logger().info(f"Janus room pool {node or DEFAULT_NODE}: created {created}, dropped {dropped} rooms")
+
+
+def drain_node(node):
+	"""Destroy the ready rooms of a node that should not hold any"""
+	cache = frappe.cache()
+	janus = JanusClient(node) if node is None or node in get_janus_nodes() else None
+
+	drained = 0
+	while True:
+		raw = cache.lpop(get_pool_key(node))
+		if raw is None:
+			break
+
+		if janus:
+			try:
+				discard_room(json.loads(raw), janus)
+			except Exception as e:
+				frappe.log_error(message=str(e), title="Janus Room Pool Drain Error")
+		drained += 1
+
+	if drained:
+		frappe.logger().info(f"Janus room pool {node or DEFAULT_NODE}: drained {drained} rooms")
+
+
+def get_pool_key(node):
+	return POOL_KEY.format(node or DEFAULT_NODE)
+
+
+def get_leased_key(node):
+	return LEASED_KEY.format(node or DEFAULT_NODE)
+
+
+def get_pool_limits():
+	"""
+	Return (pool size, low-water mark) per node from WhatsApp Settings
+
+	A recording room keeps one recording for as long as it exists, so with
+	call recording on every call gets its own room (size 0).
+	"""
+	settings = get_settings()
+	if cint(settings.enable_call_recording):
+		return 0, 0
+
+	size = cint(settings.room_pool_size)
+	low_water = min(cint(settings.room_pool_low_water), size)
+	return size, low_water
+
+
+def get_room_pool_status():
+	"""Ready and leased room counts per node, for monitoring (bench execute)"""
+	cache = frappe.cache()
+	size, low_water = get_pool_limits()
+
+	return {
+		"size": size,
+		"low_water": low_water,
+		"nodes": {
+			node or DEFAULT_NODE: {
+				"ready": cache.llen(get_pool_key(node)),
+				"leased": cache.hlen(cache.make_key(get_leased_key(node)))
+			}
+			for node in get_pool_nodes()
+		}
+	}
@@ -0,0 +1,199 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Reconcile Janus rooms with WhatsApp Call records
+
+For each Janus node, one AudioBridge `list` gives the rooms that really
+exist. They are compared with the rooms the app knows about:
+
+- rooms of calls still in progress (one indexed query per node)
+- ready rooms in the pool, and rooms leased recently (a call is being set
+  up and its record may not be saved yet)
+
+Any other room this app created is leaked, e.g. its call ended while Janus
+was unreachable, or the call record was never written. A room is destroyed
+once it has been seen leaked on two runs in a row, so rooms created between
+the list and the lookups are never touched. Orphans are destroyed over a
+single Janus session, and room references of finished calls are cleared
+with one UPDATE.
+
+Counts of each run, and running totals, are kept in Redis for monitoring:
+see get_room_reconcile_metrics.
+"""
+
+import frappe
+import json
+import time
+from frappe.utils import cint
+from whatsapp_calling.whatsapp_calling.api.janus_client import JanusClient
+from whatsapp_calling.whatsapp_calling.utils.room_pool import (
+	DEFAULT_NODE,
+	count_rooms,
+	get_leased_key,
+	get_pool_key,
+	get_pool_nodes
+)
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_janus_nodes
+
+# Calls that may still be using their room
+ACTIVE_STATUSES = ("Initiated", "Ringing", "Answered")
+
+# Leases younger than this belong to calls being set up
+LEASE_GRACE = 5 * 60  # seconds
+
+SUSPECTS_KEY = "whatsapp_janus_room_suspects"
+METRICS_KEY = "whatsapp_janus_room_metrics"
+LOCK_KEY = "whatsapp_janus_room_reconcile"
+LOCK_TIMEOUT = 15 * 60
+
+
+def reconcile_janus_rooms():
+	"""
+	Reconcile every Janus node
+
+	Returns:
+		dict of node -> counts (rooms, leaked, destroyed, stale_leases,
+		cleared_refs, missing), or None if another run holds the lock
+	"""
+	cache = frappe.cache()
+	lock = cache.lock(cache.make_key(LOCK_KEY), timeout=LOCK_TIMEOUT)
+	if not lock.acquire(blocking=False):
+		return None
+
+	try:
+		report = {}
+		for node in get_pool_nodes():
+			if node is None and get_janus_nodes() and not count_rooms(None):
+				# WhatsApp Settings' server is retired and holds no rooms of ours
+				continue
+
+			try:
+				report[node or DEFAULT_NODE] = reconcile_node(node)
+			except Exception as e:
+				frappe.log_error(message=str(e), title=f"Janus Room Reconcile Error ({node or DEFAULT_NODE})")
+
+		record_metrics(report)
+		return report
+
+	finally:
+		lock.release()
+
+
+def reconcile_node(node):
+	"""
+	Destroy one node's leaked rooms and clear stale room references
+
+	Returns:
+		dict of counts for this run
+	"""
+	cache = frappe.cache()
+	janus = JanusClient(node)
+
+	# Listing first: anything created after this is not in `rooms`
+	rooms = janus.list_rooms()
+
+	calls = frappe.get_all(
+		"WhatsApp Call",
+		filters={
+			"janus_node": node or ["is", "not set"],
+			"janus_room_id": ["is", "set"]
+		},
+		fields=["name", "janus_room_id", "status"]
+	)
+	active = {call.janus_room_id for call in calls if call.status in ACTIVE_STATUSES}
+	finished = [call for call in calls if call.status not in ACTIVE_STATUSES]
+
+	pooled = {str(json.loads(raw)["room_id"]) for raw in cache.lrange(get_pool_key(node), 0, -1)}
+
+	# Leases older than the grace period that no active call holds are stale
+	leased_key = get_leased_key(node)
+	leases = {frappe.safe_decode(room_id): entry for room_id, entry in (cache.hgetall(leased_key) or {}).items()}
+	stale_leases = [
+		room_id for room_id, entry in leases.items()
+		if room_id not in active and time.time() - (entry.get("leased_at") or 0) > LEASE_GRACE
+	]
+	if stale_leases:
+		cache.hdel(leased_key, stale_leases)
+
+	known = active | pooled | (set(leases) - set(stale_leases))
+	leaked = set(rooms) - known
+
+	# Destroy rooms seen leaked last run too; remember the rest for next run
+	suspects = set(cache.hget(SUSPECTS_KEY, node or DEFAULT_NODE) or ())
+	orphans = sorted(leaked & suspects)
+	cache.hset(SUSPECTS_KEY, node or DEFAULT_NODE, sorted(leaked - suspects))
+
+	destroyed = janus.destroy_rooms(orphans) if orphans else 0
+
+	# Finished calls let go of their rooms: destroyed now, gone already, or
+	# leaked and destroyed on the next run. Rooms in the pool stay referenced
+	# only until end_call's own clear, so they are skipped here.
+	stale_refs = [call.name for call in finished if call.janus_room_id not in known]
+	clear_room_references(stale_refs)
+
+	counts = {
+		"rooms": len(rooms),
+		"leaked": len(leaked),
+		"destroyed": destroyed,
+		"stale_leases": len(stale_leases),
+		"cleared_refs": len(stale_refs),
+		# Active calls whose room Janus no longer has (e.g. after a restart)
+		"missing": len(active - set(rooms))
+	}
+
+	if leaked or stale_refs or counts["missing"]:
+		frappe.logger().info(f"Janus rooms on {node or DEFAULT_NODE}: {counts}")
+
+	return counts
+
+
+def clear_room_references(call_names):
+	"""Drop the Janus room of many calls in one UPDATE"""
+	if not call_names:
+		return
+
+	Call = frappe.qb.DocType("WhatsApp Call")
+	(
+		frappe.qb.update(Call)
+		.set(Call.janus_room_id, None)
+		.set(Call.janus_session_id, None)
+		.where(Call.name.isin(call_names))
+	).run()
+	frappe.db.commit()
+
+
+def record_metrics(report):
+	"""Store the last run's counts and add them to the running totals"""
+	try:
+		cache = frappe.cache()
+		key = cache.make_key(METRICS_KEY)
+		pipe = cache.pipeline(transaction=False)
+
+		pipe.hset(key, "last_run", time.time())
+		pipe.hset(key, "last_report", json.dumps(report))
+		for field in ("leaked", "destroyed", "stale_leases", "cleared_refs"):
+			pipe.hincrby(key, f"{field}_total", sum(counts[field] for counts in report.values()))
+
+		pipe.execute()
+	except Exception:
+		pass
+
+
+def get_room_reconcile_metrics():
+	"""Last reconcile run and running totals, for monitoring (bench execute)"""
+	cache = frappe.cache()
+
+	# Raw read: RedisWrapper.hgetall would unpickle the values
+	pipe = cache.pipeline(transaction=False)
+	pipe.hgetall(cache.make_key(METRICS_KEY))
+	values = {k.decode(): v.decode() for k, v in pipe.execute()[0].items()}
+
+	return {
+		"last_run": frappe.utils.flt(values.get("last_run")) or None,
+		"last_report": json.loads(values.get("last_report") or "{}"),
+		"totals": {
+			field: cint(values.get(f"{field}_total"))
+			for field in ("leaked", "destroyed", "stale_leases", "cleared_refs")
+		}
+	}
@@ -0,0 +1,190 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Process-local snapshots of WhatsApp Settings, WhatsApp Numbers and Janus Nodes
+
+Configuration is read on every call and webhook, and secrets (Janus API
+secret, access tokens) go through the password table and decryption each
+time. Snapshots keep the values, secrets already decrypted, in worker
+memory. They are read-only and tagged with a version counter kept in
+Redis; saving the configuration bumps the counter, and every process
+reloads on its next request.
+"""
+
+import frappe
+from types import MappingProxyType
+
+VERSION_KEY = "whatsapp_settings_version"
+
+# Fields written on every call; changing them does not need a reload
+NUMBER_USAGE_FIELDS = ("last_used", "current_month_usage")
+
+_snapshots = {}
+
+
+class ConfigSnapshot:
+	"""Read-only attribute access to a configuration record"""
+
+	__slots__ = ("_values",)
+
+	def __init__(self, values):
+		object.__setattr__(self, "_values", MappingProxyType(dict(values)))
+
+	def __getattr__(self, name):
+		try:
+			return self._values[name]
+		except KeyError:
+			raise AttributeError(name)
+
+	def __setattr__(self, name, value):
+		raise AttributeError("Configuration snapshots are read-only")
+
+	def get(self, name, default=None):
+		return self._values.get(name, default)
+
+	def as_dict(self):
+		return dict(self._values)
+
+
+def get_settings():
+	"""
+	WhatsApp Settings with decrypted secrets
+
+	Returns:
+		ConfigSnapshot; password fields hold plain text (None when unset)
+	"""
+	entry = _get_entry()
+	if entry["settings"] is None:
+		entry["settings"] = ConfigSnapshot(_load("WhatsApp Settings", "WhatsApp Settings"))
+	return entry["settings"]
+
+
+def get_number(name):
+	"""
+	WhatsApp Number with its decrypted access token
+
+	The number's own token falls back to the default token of WhatsApp
+	Settings, as WhatsAppNumber.get_access_token does.
+
+	Returns:
+		ConfigSnapshot, or None if the number does not exist
+	"""
+	entry = _get_entry()
+	if name not in entry["numbers"]:
+		values = _load("WhatsApp Number", name) if frappe.db.exists("WhatsApp Number", name) else None
+		if values is not None:
+			values["access_token"] = values.get("access_token") or get_settings().default_access_token
+		entry["numbers"][name] = ConfigSnapshot(values) if values is not None else None
+	return entry["numbers"][name]
+
+
+def get_company_numbers(company):
+	"""
+	A company's Active WhatsApp Numbers, for outbound number selection
+
+	Returns:
+		tuple of ConfigSnapshot (see get_number), in name order
+	"""
+	entry = _get_entry()
+	if company not in entry["companies"]:
+		names = frappe.get_all(
+			"WhatsApp Number",
+			filters={"company": company, "status": "Active"},
+			pluck="name",
+			order_by="name"
+		)
+		entry["companies"][company] = tuple(number for number in map(get_number, names) if number)
+	return entry["companies"][company]
+
+
+def get_janus_nodes():
+	"""
+	All Janus Nodes, API secrets decrypted
+
+	A node without its own API or admin secret uses the one from WhatsApp
+	Settings.
+
+	Returns:
+		read-only dict of node name -> ConfigSnapshot (empty when the app
+		runs against the single Janus server of WhatsApp Settings)
+	"""
+	entry = _get_entry()
+	if entry["janus_nodes"] is None:
+		nodes = {}
+		for name in frappe.get_all("Janus Node", pluck="name", order_by="name"):
+			values = _load("Janus Node", name)
+			values["api_secret"] = values.get("api_secret") or get_settings().janus_api_secret
+			values["admin_secret"] = values.get("admin_secret") or get_settings().janus_admin_secret
+			nodes[name] = ConfigSnapshot(values)
+		entry["janus_nodes"] = MappingProxyType(nodes)
+	return entry["janus_nodes"]
+
+
+def _load(doctype, name):
+	doc = frappe.get_doc(doctype, name)
+	values = doc.as_dict(no_default_fields=True)
+
+	for df in doc.meta.get("fields", {"fieldtype": "Password"}):
+		values[df.fieldname] = doc.get_password(df.fieldname, raise_exception=False) if doc.get(df.fieldname) else None
+
+	return values
+
+
+def _get_entry():
+	"""This site's snapshots, dropped when the shared version has moved"""
+	site = frappe.local.site
+	version = _get_version()
+	entry = _snapshots.get(site)
+
+	if entry is None or entry["version"] != version:
+		entry = _snapshots[site] = {"version": version, "settings": None, "numbers": {}, "companies": {}, "janus_nodes": None}
+
+	return entry
+
+
+def _get_version():
+	# One Redis read per request at most
+	version = getattr(frappe.local, "whatsapp_settings_version", None)
+	if version is not None:
+		return version
+
+	try:
+		cache = frappe.cache()
+		version = frappe.safe_decode(cache.get(cache.make_key(VERSION_KEY))) or "0"
+	except Exception:
+		# Without Redis, keep whatever this process has
+		entry = _snapshots.get(frappe.local.site)
+		return entry["version"] if entry else "0"
+
+	frappe.local.whatsapp_settings_version = version
+	return version
+
+
+def bump_settings_version():
+	"""Invalidate every process's snapshots, once the change is committed"""
+	def bump():
+		cache = frappe.cache()
+		cache.incr(cache.make_key(VERSION_KEY))
+		frappe.local.whatsapp_settings_version = None
+
+	# Bumping before commit would let another worker cache the old values
+	# under the new version
+	frappe.db.after_commit.add(bump)
+
+
+def is_config_change(doc, ignore=()):
+	"""
+	True unless only the `ignore` fields of a saved document changed
+
+	Call from validate: password fields still hold the new plain text then.
+	"""
+	before = doc.get_doc_before_save()
+	if not before:
+		return True
+
+	return any(
+		doc.get(df.fieldname) != before.get(df.fieldname)
+		for df in doc.meta.fields
+		if df.fieldname not in ignore
+	)
@@ -63,6 +63,42 @@ def extract_country_code(phone_number):
 	return None
 
 
+def normalize_phone_number(phone_number):
+	"""
+	Reduce a phone number to its digits
+
+	Args:
+		phone_number: Phone number in any formatting (+91 98765-43210)
+
+	Returns:
+		str: Digits only (919876543210), empty if there are none
+	"""
+	return re.sub(r'\D', '', phone_number or '')
+
+
+def get_phone_lookup_keys(phone_number):
+	"""
+	Keys under which a number is indexed for lookups
+
+	Args:
+		phone_number: Phone number in any formatting
+
+	Returns:
+		list of (key, key_type): the E.164 form and the last 10 digits,
+		which also matches numbers stored without a country code
+	"""
+	digits = normalize_phone_number(phone_number)
+	if not digits:
+		return []
+
+	keys = [(f"+{digits}", "E.164")]
+
+	suffix = digits[-10:]
+	keys.append((suffix, "National Suffix"))
+
+	return keys
+
+
 def validate_whatsapp_number(phone_number):
 	"""
 	Validate if number is a valid WhatsApp number
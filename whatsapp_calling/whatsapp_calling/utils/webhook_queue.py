@@ -0,0 +1,390 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Acknowledge-first webhook ingestion
+
+The webhook endpoint only validates and stores the raw payload, then pushes
+its events onto partitioned queues and returns 200 to Meta. Background
+workers drain the partitions. Every event is routed by its call_id, so all
+events of one call land on the same partition and are handled in arrival
+order, while different calls are processed in parallel.
+"""
+
+import frappe
+import json
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from frappe.utils import cint
+from whatsapp_calling.whatsapp_calling.utils.dedup import get_deduplicator, get_event_fingerprint
+from whatsapp_calling.whatsapp_calling.utils.settings_cache import get_settings
+
+PARTITION_KEY = "whatsapp_webhook_partition:{0}"
+PARTITION_LOCK_KEY = "whatsapp_webhook_partition_lock:{0}"
+PENDING_KEY = "whatsapp_webhook_pending"
+
+DRAIN_METHOD = "whatsapp_calling.whatsapp_calling.utils.webhook_queue.drain_partition"
+DRAIN_BATCH_SIZE = 50
+LOCK_TIMEOUT = 300  # seconds, renewed after every batch
+STALE_LOG_MINUTES = 15
+
+_local_queues = {}
+
+
+def enqueue_webhook(data, raw_body=None):
+	"""
+	Persist a webhook payload and hand its events to background workers
+
+	Args:
+		data: Parsed webhook payload
+		raw_body: Request body exactly as received
+
+	Returns:
+		dict acknowledged back to Meta
+	"""
+	from whatsapp_calling.whatsapp_calling.api.webhook import extract_events
+
+	events = extract_events(data)
+
+	# A redelivery of events already handled is acknowledged without storing
+	# it; partly new payloads are stored and deduplicated by the workers
+	fingerprints = [get_event_fingerprint(event) for event in events]
+	if events and all(get_deduplicator().seen(fingerprints)):
+		return {"status": "success"}
+
+	log = frappe.get_doc({
+		"doctype": "WhatsApp Webhook Log",
+		"status": "Queued" if events else "Processed",
+		"received_at": frappe.utils.now(),
+		"event_count": len(events),
+		"payload": raw_body or json.dumps(data)
+	})
+	log.insert(ignore_permissions=True)
+	frappe.db.commit()
+
+	if events:
+		get_queue().push(log.name, events)
+
+	return {"status": "success"}
+
+
+def requeue_log(log_name):
+	"""Push a stored webhook payload through the queue again"""
+	from whatsapp_calling.whatsapp_calling.api.webhook import extract_events
+
+	payload = frappe.db.get_value("WhatsApp Webhook Log", log_name, "payload")
+	events = extract_events(json.loads(payload))
+
+	frappe.db.set_value("WhatsApp Webhook Log", log_name, {
+		"status": "Queued" if events else "Processed",
+		"error": None
+	}, update_modified=False)
+	frappe.db.commit()
+
+	if events:
+		get_queue().push(log_name, events)
+
+
+def get_queue():
+	"""Return the configured queue backend for this site"""
+	settings = get_settings()
+	concurrency = cint(settings.webhook_worker_concurrency) or 4
+
+	# Local stand-in for tests and single-process setups without RQ workers
+	if frappe.conf.get("whatsapp_webhook_queue_backend") == "local":
+		site = frappe.local.site
+		if site not in _local_queues:
+			_local_queues[site] = LocalWebhookQueue(concurrency, handler=_site_handler(site))
+		return _local_queues[site]
+
+	return RedisWebhookQueue(concurrency, queue=settings.webhook_queue or "short")
+
+
+def get_partition(key, concurrency):
+	"""Map an ordering key (call_id) to a partition number"""
+	return zlib.crc32((key or "").encode()) % max(cint(concurrency), 1)
+
+
+class WebhookQueue(ABC):
+	"""Shared bookkeeping for queue backends"""
+
+	def __init__(self, concurrency):
+		self.concurrency = max(cint(concurrency), 1)
+
+	def split(self, log_name, events):
+		"""Group events by partition, keeping their order within the payload"""
+		partitions = {}
+		for event in events:
+			partition = get_partition(event["key"], self.concurrency)
+			partitions.setdefault(partition, []).append({"log": log_name, "event": event})
+		return partitions
+
+	def handle(self, items):
+		"""Process a batch of queued items and settle their webhook logs"""
+		results = process_queued_events(items)
+		for log_name, (count, error) in results.items():
+			remaining = self.decrement_pending(log_name, count)
+			settle_log(log_name, finished=remaining <= 0, error=error)
+
+	@abstractmethod
+	def push(self, log_name, events):
+		"""Queue a webhook log's events on their partitions"""
+
+	@abstractmethod
+	def decrement_pending(self, log_name, count):
+		"""
+		Count `count` of a log's events as handled
+
+		Returns:
+			int: events of the log still outstanding
+		"""
+
+
+class RedisWebhookQueue(WebhookQueue):
+	"""Partitions stored as Redis lists and drained by RQ jobs"""
+
+	def __init__(self, concurrency, queue="short"):
+		super().__init__(concurrency)
+		self.queue = queue
+		self.cache = frappe.cache()
+
+	def push(self, log_name, events):
+		partitions = self.split(log_name, events)
+
+		pipe = self.cache.pipeline()
+		pipe.hset(self.cache.make_key(PENDING_KEY), log_name, len(events))
+		for partition, items in partitions.items():
+			pipe.rpush(
+				self.cache.make_key(PARTITION_KEY.format(partition)),
+				*[json.dumps(item) for item in items]
+			)
+		pipe.execute()
+
+		# One wake-up job per touched partition. Jobs that find the partition
+		# already owned by another worker exit immediately.
+		for partition in partitions:
+			frappe.enqueue(DRAIN_METHOD, queue=self.queue, partition=partition)
+
+	def drain(self, partition):
+		key = self.cache.make_key(PARTITION_KEY.format(partition))
+
+		while True:
+			lock = self.cache.lock(
+				self.cache.make_key(PARTITION_LOCK_KEY.format(partition)),
+				timeout=LOCK_TIMEOUT
+			)
+			if not lock.acquire(blocking=False):
+				return
+
+			try:
+				while True:
+					pipe = self.cache.pipeline()
+					pipe.lrange(key, 0, DRAIN_BATCH_SIZE - 1)
+					pipe.ltrim(key, DRAIN_BATCH_SIZE, -1)
+					items = pipe.execute()[0]
+
+					if not items:
+						break
+
+					self.handle([json.loads(item) for item in items])
+					lock.reacquire()
+			finally:
+				try:
+					lock.release()
+				except Exception:
+					pass
+
+			# Events pushed while we were releasing the lock would otherwise
+			# wait for the next webhook, so look once more before leaving.
+			if not self.cache.llen(PARTITION_KEY.format(partition)):
+				return
+
+	def decrement_pending(self, log_name, count):
+		key = self.cache.make_key(PENDING_KEY)
+		remaining = self.cache.hincrby(key, log_name, -count)
+		if remaining <= 0:
+			self.cache.hdel(PENDING_KEY, log_name)
+		return remaining
+
+
+class LocalWebhookQueue(WebhookQueue):
+	"""
+	In-process stand-in for RedisWebhookQueue
+
+	Uses a thread pool instead of RQ workers but keeps the same guarantee:
+	at most one thread drains a partition at a time, in push order.
+	"""
+
+	def __init__(self, concurrency, handler=None):
+		super().__init__(concurrency)
+		self.handler = handler or self.handle
+		self.partitions = [deque() for _ in range(self.concurrency)]
+		self.partition_locks = [threading.Lock() for _ in range(self.concurrency)]
+		self.pending = {}
+		self.pending_lock = threading.Lock()
+		self.executor = ThreadPoolExecutor(
+			max_workers=self.concurrency,
+			thread_name_prefix="whatsapp_webhook"
+		)
+
+	def push(self, log_name, events):
+		partitions = self.split(log_name, events)
+
+		with self.pending_lock:
+			self.pending[log_name] = len(events)
+
+		for partition, items in partitions.items():
+			self.partitions[partition].extend(items)
+			self.executor.submit(self.drain, partition)
+
+	def drain(self, partition):
+		queue = self.partitions[partition]
+		lock = self.partition_locks[partition]
+
+		while True:
+			if not lock.acquire(blocking=False):
+				return
+
+			try:
+				while queue:
+					batch = []
+					while queue and len(batch) < DRAIN_BATCH_SIZE:
+						batch.append(queue.popleft())
+					self.handler(batch)
+			finally:
+				lock.release()
+
+			if not queue:
+				return
+
+	def decrement_pending(self, log_name, count):
+		with self.pending_lock:
+			remaining = self.pending.get(log_name, 0) - count
+			if remaining <= 0:
+				self.pending.pop(log_name, None)
+			else:
+				self.pending[log_name] = remaining
+		return remaining
+
+	def join(self):
+		"""Wait for all submitted work (used by tests)"""
+		self.executor.shutdown(wait=True)
+
+
+def _site_handler(site):
+	"""Wrap LocalWebhookQueue.handle so it runs with a site connection"""
+	def handler(items):
+		frappe.init(site=site)
+		frappe.connect()
+		try:
+			get_queue().handle(items)
+		finally:
+			frappe.destroy()
+
+	return handler
+
+
+def drain_partition(partition):
+	"""Background job: process queued events of one partition in order"""
+	get_queue().drain(cint(partition))
+
+
+def process_queued_events(items):
+	"""
+	Run queued events through the webhook handlers
+
+	The whole batch is handled in one transaction. If that fails, the events
+	are retried one by one so a single bad event cannot sink the others.
+
+	Args:
+		items: list of {"log": log name, "event": event dict}
+
+	Returns:
+		dict of log name -> (events handled, last error or None)
+	"""
+	from whatsapp_calling.whatsapp_calling.api.webhook import handle_events
+
+	results = {}
+	for item in items:
+		count = results.get(item["log"], (0, None))[0]
+		results[item["log"]] = (count + 1, None)
+
+	try:
+		handle_events([item["event"] for item in items])
+		return results
+	except Exception:
+		frappe.db.rollback()
+
+	for item in items:
+		try:
+			handle_events([item["event"]])
+		except Exception:
+			frappe.db.rollback()
+			error = frappe.get_traceback()
+			frappe.log_error(message=error, title="Webhook Worker Error")
+			results[item["log"]] = (results[item["log"]][0], error)
+
+	return results
+
+
+def settle_log(log_name, finished, error=None):
+	"""Record the outcome of a webhook log once its events are handled"""
+	if error:
+		frappe.db.set_value("WhatsApp Webhook Log", log_name, {
+			"status": "Failed",
+			"error": error
+		}, update_modified=False)
+	elif finished:
+		# Only a log that never failed can become Processed
+		frappe.db.sql("""
+			UPDATE `tabWhatsApp Webhook Log`
+			SET status = 'Processed', processed_at = %s
+			WHERE name = %s AND status = 'Queued'
+		""", (frappe.utils.now(), log_name))
+
+	frappe.db.commit()
+
+
+def recover_stalled_webhooks():
+	"""
+	Scheduled task: Restart draining of abandoned partitions and re-queue
+	logs whose events were lost (e.g. a worker died mid-batch)
+	"""
+	try:
+		if frappe.conf.get("whatsapp_webhook_queue_backend") == "local":
+			return
+
+		queue = get_queue()
+		cache = queue.cache
+
+		backlog = False
+		pattern = cache.make_key(PARTITION_KEY.format("*"))
+		for key in cache.scan_iter(match=pattern):
+			partition = key.decode().rsplit(":", 1)[-1]
+			frappe.enqueue(DRAIN_METHOD, queue=queue.queue, partition=cint(partition))
+			backlog = True
+
+		cutoff = frappe.utils.add_to_date(frappe.utils.now(), minutes=-STALE_LOG_MINUTES)
+		stalled = frappe.get_all(
+			"WhatsApp Webhook Log",
+			filters={"status": "Queued", "received_at": ["<", cutoff]},
+			pluck="name"
+		)
+
+		requeued = 0
+		for log_name in stalled:
+			# With empty partitions nothing can still be waiting for these
+			# events, so an outstanding pending count means they were lost.
+			if not backlog or not cache.hexists(PENDING_KEY, log_name):
+				cache.hdel(PENDING_KEY, log_name)
+				requeue_log(log_name)
+				requeued += 1
+
+		if requeued:
+			frappe.logger().info(f"Re-queued {requeued} stalled webhook payloads")
+
+	except Exception as e:
+		frappe.log_error(message=str(e), title="Recover Stalled Webhooks Error")
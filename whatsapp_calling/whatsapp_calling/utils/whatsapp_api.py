@@ -2,44 +2,46 @@
 # For license information, please see license.txt
 
 import frappe
-import requests
 from frappe import _
+from whatsapp_calling.whatsapp_calling.utils.http import get_session, get_timeout
 
 
 class WhatsAppAPI:
 	BASE_URL = "https://graph.facebook.com/v18.0"
 
-	def __init__(self, phone_number_id, access_token):
+	def __init__(self, phone_number_id, access_token, base_url=None):
 		self.phone_number_id = phone_number_id
 		self.access_token = access_token
+		# Overridable for tests against a mock Graph server
+		self.base_url = base_url or self.BASE_URL
 		self.headers = {
 			"Authorization": f"Bearer {access_token}",
 			"Content-Type": "application/json"
 		}
+		# Keep-alive connections shared by every WhatsAppAPI in this worker
+		self.session = get_session("graph")
 
-	def make_call(self, to_number):
+	def make_call(self, to_number, timeout=None):
 		"""
 		Initiate outbound call
 
 		Args:
 			to_number: Customer's WhatsApp number
+			timeout: (connect, read) seconds, instead of the session default
 
 		Returns:
 			dict with call id and status
 		"""
-		url = f"{self.BASE_URL}/{self.phone_number_id}/calls"
+		url = f"{self.base_url}/{self.phone_number_id}/calls"
 
-		payload = {
-			"to": to_number,
-			"type": "voice"
-		}
+		payload = call_payload(to_number)
 
-		response = requests.post(url, json=payload, headers=self.headers, timeout=10)
+		response = self.session.post(url, json=payload, headers=self.headers, timeout=timeout or self.session.default_timeout)
 
 		if response.status_code == 200:
 			return response.json()
 		else:
-			error_msg = response.json().get("error", {}).get("message", "Unknown error")
+			error_msg = get_error_message(response)
 			raise Exception(f"WhatsApp API Error: {error_msg}")
 
 	def answer_call(self, call_id, janus_config):
@@ -50,7 +52,7 @@ class WhatsAppAPI:
 			call_id: WhatsApp call ID
 			janus_config: Dict with janus_url and room_id
 		"""
-		url = f"{self.BASE_URL}/{self.phone_number_id}/calls/{call_id}/answer"
+		url = f"{self.base_url}/{self.phone_number_id}/calls/{call_id}/answer"
 
 		payload = {
 			"media_server": {
@@ -60,22 +62,22 @@ class WhatsAppAPI:
 			}
 		}
 
-		response = requests.post(url, json=payload, headers=self.headers, timeout=10)
+		response = self.session.post(url, json=payload, headers=self.headers)
 
 		if response.status_code != 200:
-			error_msg = response.json().get("error", {}).get("message", "Unknown error")
+			error_msg = get_error_message(response)
 			raise Exception(f"Failed to answer call: {error_msg}")
 
 		return response.json()
 
 	def end_call(self, call_id):
 		"""End active call"""
-		url = f"{self.BASE_URL}/{self.phone_number_id}/calls/{call_id}/end"
+		url = f"{self.base_url}/{self.phone_number_id}/calls/{call_id}/end"
 
-		response = requests.post(url, headers=self.headers, timeout=10)
+		response = self.session.post(url, headers=self.headers)
 
 		if response.status_code != 200:
-			error_msg = response.json().get("error", {}).get("message", "Unknown error")
+			error_msg = get_error_message(response)
 			frappe.log_error(message=error_msg, title="End Call Error")
 
 	def send_template(self, to_number, template_name, components=None):
@@ -83,25 +85,14 @@ class WhatsAppAPI:
 		Send WhatsApp template message
 		Used for call permission requests
 		"""
-		url = f"{self.BASE_URL}/{self.phone_number_id}/messages"
-
-		payload = {
-			"messaging_product": "whatsapp",
-			"to": to_number,
-			"type": "template",
-			"template": {
-				"name": template_name,
-				"language": {"code": "en"},
-			}
-		}
+		url = f"{self.base_url}/{self.phone_number_id}/messages"
 
-		if components:
-			payload["template"]["components"] = components
+		payload = template_payload(to_number, template_name, components)
 
-		response = requests.post(url, json=payload, headers=self.headers, timeout=10)
+		response = self.session.post(url, json=payload, headers=self.headers)
 
 		if response.status_code != 200:
-			error_msg = response.json().get("error", {}).get("message", "Unknown error")
+			error_msg = get_error_message(response)
 			raise Exception(f"Failed to send template: {error_msg}")
 
 		return response.json()
@@ -117,23 +108,16 @@ class WhatsAppAPI:
 		Returns:
 			dict with message id
 		"""
-		url = f"{self.BASE_URL}/{self.phone_number_id}/messages"
+		url = f"{self.base_url}/{self.phone_number_id}/messages"
 
-		payload = {
-			"messaging_product": "whatsapp",
-			"to": to_number,
-			"type": "text",
-			"text": {
-				"body": message_text
-			}
-		}
+		payload = text_payload(to_number, message_text)
 
-		response = requests.post(url, json=payload, headers=self.headers, timeout=10)
+		response = self.session.post(url, json=payload, headers=self.headers)
 
 		if response.status_code == 200:
 			return response.json()
 		else:
-			error_msg = response.json().get("error", {}).get("message", "Unknown error")
+			error_msg = get_error_message(response)
 			raise Exception(f"Failed to send message: {error_msg}")
 
 	def get_media_url(self, media_id):
@@ -146,15 +130,15 @@ class WhatsAppAPI:
 		Returns:
 			str: Media URL
 		"""
-		url = f"{self.BASE_URL}/{media_id}"
+		url = f"{self.base_url}/{media_id}"
 
-		response = requests.get(url, headers=self.headers, timeout=10)
+		response = self.session.get(url, headers=self.headers)
 
 		if response.status_code == 200:
 			data = response.json()
 			return data.get("url")
 		else:
-			error_msg = response.json().get("error", {}).get("message", "Unknown error")
+			error_msg = get_error_message(response)
 			raise Exception(f"Failed to get media URL: {error_msg}")
 
 	def download_media(self, media_url, save_path):
@@ -168,7 +152,7 @@ class WhatsAppAPI:
 		Returns:
 			bool: Success status
 		"""
-		response = requests.get(media_url, headers=self.headers, timeout=30)
+		response = self.session.get(media_url, headers=self.headers, timeout=get_timeout(read=30))
 
 		if response.status_code == 200:
 			with open(save_path, 'wb') as f:
@@ -176,3 +160,43 @@ class WhatsAppAPI:
 			return True
 		else:
 			return False
+
+
+def call_payload(to_number):
+	return {
+		"to": to_number,
+		"type": "voice"
+	}
+
+
+def template_payload(to_number, template_name, components=None):
+	payload = {
+		"messaging_product": "whatsapp",
+		"to": to_number,
+		"type": "template",
+		"template": {
+			"name": template_name,
+			"language": {"code": "en"},
+		}
+	}
+
+	if components:
+		payload["template"]["components"] = components
+
+	return payload
+
+
+def text_payload(to_number, message_text):
+	return {
+		"messaging_product": "whatsapp",
+		"to": to_number,
+		"type": "text",
+		"text": {
+			"body": message_text
+		}
+	}
+
+
+def get_error_message(response):
+	"""Graph error message of a failed response (requests or httpx)"""
+	return response.json().get("error", {}).get("message", "Unknown error")
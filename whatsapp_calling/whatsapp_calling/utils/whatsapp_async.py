@@ -0,0 +1,173 @@
+# Copyright (c) 2024, Your Company and contributors
+# For license information, please see license.txt
+
+"""
+Asyncio WhatsApp Graph API client for bulk work
+
+WhatsAppAPI sends one request at a time, so a few thousand template sends
+take a few thousand round trips back to back. AsyncWhatsAppAPI keeps up to
+`concurrency` requests in flight over one pooled HTTP/1.1 client, so bulk
+jobs are limited by bandwidth and Meta's rate limits instead of latency.
+
+Meant for background jobs; use run_async() to drive it from synchronous
+code, e.g.:
+
+	async def send_all(api, numbers):
+		async with api:
+			return await api.gather(api.send_template(n, "call_permission_request") for n in numbers)
+
+	results = run_async(send_all(AsyncWhatsAppAPI(number_id, token), numbers))
+"""
+
+import asyncio
+import httpx
+import random
+from whatsapp_calling.whatsapp_calling.utils.http import BACKOFF_FACTOR, MAX_JITTER, RETRY_STATUSES, get_timeout
+from whatsapp_calling.whatsapp_calling.utils.whatsapp_api import (
+	WhatsAppAPI,
+	call_payload,
+	get_error_message,
+	template_payload,
+	text_payload
+)
+
+DEFAULT_CONCURRENCY = 20
+RETRIES = 2
+
+
+class AsyncWhatsAppAPI:
+	"""
+	Async counterpart of WhatsAppAPI
+
+	Use as an async context manager; the HTTP client and its connection
+	pool live for the duration of the block.
+	"""
+
+	BASE_URL = WhatsAppAPI.BASE_URL
+
+	def __init__(self, phone_number_id, access_token, concurrency=DEFAULT_CONCURRENCY, base_url=None, transport=None):
+		"""
+		Args:
+			phone_number_id: Meta phone number ID of the sending number
+			access_token: Graph API token
+			concurrency: maximum requests in flight
+			base_url: Graph API root, overridable for a mock server
+			transport: optional httpx transport (e.g. httpx.MockTransport)
+		"""
+		self.phone_number_id = phone_number_id
+		self.base_url = base_url or self.BASE_URL
+		self.concurrency = concurrency
+		self.transport = transport
+		self.headers = {
+			"Authorization": f"Bearer {access_token}",
+			"Content-Type": "application/json"
+		}
+		self.client = None
+		self.semaphore = None
+
+	async def __aenter__(self):
+		connect, read = get_timeout()
+		self.client = httpx.AsyncClient(
+			headers=self.headers,
+			timeout=httpx.Timeout(read, connect=connect),
+			limits=httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency),
+			transport=self.transport
+		)
+		self.semaphore = asyncio.Semaphore(self.concurrency)
+		return self
+
+	async def __aexit__(self, *exc):
+		await self.client.aclose()
+		self.client = None
+
+	async def make_call(self, to_number):
+		"""Initiate outbound call; returns dict with call id and status"""
+		response = await self._request("POST", f"{self.base_url}/{self.phone_number_id}/calls", json=call_payload(to_number))
+
+		if response.status_code == 200:
+			return response.json()
+		raise Exception(f"WhatsApp API Error: {get_error_message(response)}")
+
+	async def send_template(self, to_number, template_name, components=None):
+		"""Send a pre-approved template message"""
+		response = await self._request(
+			"POST",
+			f"{self.base_url}/{self.phone_number_id}/messages",
+			json=template_payload(to_number, template_name, components)
+		)
+
+		if response.status_code != 200:
+			raise Exception(f"Failed to send template: {get_error_message(response)}")
+		return response.json()
+
+	async def send_message(self, to_number, message_text):
+		"""Send text message; returns dict with message id"""
+		response = await self._request(
+			"POST",
+			f"{self.base_url}/{self.phone_number_id}/messages",
+			json=text_payload(to_number, message_text)
+		)
+
+		if response.status_code == 200:
+			return response.json()
+		raise Exception(f"Failed to send message: {get_error_message(response)}")
+
+	async def get_media_url(self, media_id):
+		"""Resolve a media ID to its download URL"""
+		response = await self._request("GET", f"{self.base_url}/{media_id}")
+
+		if response.status_code == 200:
+			return response.json().get("url")
+		raise Exception(f"Failed to get media URL: {get_error_message(response)}")
+
+	async def download_media(self, media_url, save_path):
+		"""
+		Stream a media file to disk
+
+		Returns:
+			bool: Success status
+		"""
+		connect, read = get_timeout(read=30)
+
+		async with self.semaphore:
+			async with self.client.stream("GET", media_url, timeout=httpx.Timeout(read, connect=connect)) as response:
+				if response.status_code != 200:
+					return False
+
+				with open(save_path, "wb") as f:
+					async for chunk in response.aiter_bytes():
+						f.write(chunk)
+				return True
+
+	async def gather(self, coroutines):
+		"""
+		Run many requests concurrently (bounded by `concurrency`)
+
+		Returns:
+			list of results in input order; failed requests yield their exception
+		"""
+		return await asyncio.gather(*coroutines, return_exceptions=True)
+
+	async def _request(self, method, url, **kwargs):
+		for attempt in range(RETRIES + 1):
+			last = attempt == RETRIES
+
+			async with self.semaphore:
+				try:
+					response = await self.client.request(method, url, **kwargs)
+				except httpx.ConnectError:
+					# Nothing reached the server, so any method is safe to retry
+					if last:
+						raise
+				else:
+					# Only GETs are retried on 429/5xx: a replayed POST could
+					# call or message the customer twice
+					if method != "GET" or response.status_code not in RETRY_STATUSES or last:
+						return response
+
+			await asyncio.sleep(BACKOFF_FACTOR * (2 ** attempt) + random.uniform(0, MAX_JITTER))
+
+
+def run_async(coroutine):
+	"""Run a coroutine to completion from synchronous code (e.g. an RQ job)"""
+	return asyncio.run(coroutine)